@@ -0,0 +1,121 @@
+"""simple benchmarks, nothing is executed remotely.
+
+    python benchmark.py output [number-of-lines]
+    python benchmark.py spawn [number-of-commands]
+
+`output` measures how quickly command output can be processed, in lines per-second. output is written to /dev/null.
+`spawn` measures how quickly `local` can start commands, in commands per-second, as the memory used by the
+parent process grows."""
+
+import contextlib
+import os
+import sys
+import time
+from threadbare import operations, state
+
+LINES = 1000000
+SPAWNS = 200
+
+
+@contextlib.contextmanager
+def devnull_output():
+    "temporarily replaces stdout and stderr with /dev/null"
+    with open(os.devnull, "w") as fh:
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = fh
+        try:
+            yield
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+
+def lines_per_second(fn, num_lines):
+    "calls `fn` with `num_lines` lines of output, returning the number of lines processed per-second."
+    lines = ["line %s of some typical command output" % i for i in range(num_lines)]
+    with devnull_output():
+        start = time.perf_counter()
+        fn(lines)
+        elapsed = time.perf_counter() - start
+    return num_lines / elapsed
+
+
+def print_line(lines):
+    "each line printed individually with `_print_line`, resolving settings every time"
+    for line in lines:
+        operations._print_line(sys.stdout, line)
+
+
+def iter_all_output(lines):
+    "lines printed and captured as `remote` does"
+    result = {"stdout": lines, "stderr": []}
+    for _ in operations._iter_all_output(result):
+        pass
+
+
+def output(num_lines=LINES):
+    cases = [
+        ("_print_line, per-line", {}, print_line),
+        ("remote output", {}, iter_all_output),
+        ("remote output, unbuffered", {"output_buffer_bytes": 0}, iter_all_output),
+        (
+            "remote output, timestamped template",
+            {"line_template": "{hour}:{minute}:{second} [{host}] {pipe}: {line}\n"},
+            iter_all_output,
+        ),
+        ("remote output, quiet", {"quiet": True}, iter_all_output),
+    ]
+    print("%s lines" % num_lines)
+    for label, settings, fn in cases:
+        with state.settings(host_string="1.2.3.4", **settings):
+            rate = lines_per_second(fn, num_lines)
+        print("%-40s %12.0f lines/s" % (label, rate))
+
+
+def rss_mb():
+    "returns the resident memory of this process in MB"
+    with open("/proc/self/status") as fh:
+        for line in fh:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) // 1024
+
+
+def spawns_per_second(num_spawns, command="true", **kwargs):
+    "runs `command` with `local` `num_spawns` times, returning the number of commands run per-second."
+    start = time.perf_counter()
+    for _ in range(num_spawns):
+        operations.local(command, capture=True, display_running=False, **kwargs)
+    return num_spawns / (time.perf_counter() - start)
+
+
+def spawn(num_spawns=SPAWNS):
+    cases = [
+        ("fork, login shell", {}),
+        ("fork, non-login shell", {"login_shell": False}),
+        ("fork, no shell", {"command": ["true"], "use_shell": False}),
+        (
+            "posix_spawn, non-login shell",
+            {"login_shell": False, "use_posix_spawn": True},
+        ),
+        (
+            "posix_spawn, no shell",
+            {"command": ["true"], "use_shell": False, "use_posix_spawn": True},
+        ),
+    ]
+    ballast = bytearray()
+    print("%s commands" % num_spawns)
+    for ballast_mb in [0, 512, 2048]:
+        # written to, so the memory is actually resident
+        ballast.extend(b"x" * (ballast_mb * 2**20 - len(ballast)))
+        print("parent RSS %sMB" % rss_mb())
+        for label, settings in cases:
+            rate = spawns_per_second(num_spawns, **settings)
+            print("    %-36s %8.0f commands/s" % (label, rate))
+
+
+def main(mode="output", *args):
+    modes = {"output": output, "spawn": spawn}
+    modes[mode](*map(int, args))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
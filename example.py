@@ -1,4 +1,5 @@
 import contextlib
+import hashlib
 import pytest
 import os, shutil, tempfile
 from os.path import join, basename
@@ -311,6 +312,33 @@ def test_run_many_remote_commands():
             assert result["succeeded"]
 
 
+def test_preconnect_to_many_hosts():
+    "connections to many hosts can be opened concurrently ahead of time and re-used by later `remote` commands"
+    with _test_settings():
+        result = operations.preconnect([HOST, "localhost"])
+        assert result == {HOST: None, "localhost": None}
+        for host in [HOST, "localhost"]:
+            assert remote("echo hi!", host_string=host)["succeeded"]
+
+
+def test_preconnect_to_unreachable_hosts():
+    "unreachable hosts are reported together"
+    with _test_settings(warn_only=True):
+        result = operations.preconnect([HOST, "unknown-host.invalid"])
+        assert result[HOST] is None
+        assert result["unknown-host.invalid"] is not None
+
+
+def test_run_many_remote_commands_in_a_session():
+    "many small commands can be run within a single long-lived shell rather than starting a new shell per-command"
+    with _test_settings(use_session=True):
+        for i in range(10):
+            result = remote("echo %s" % i)
+            assert result["stdout"] == [str(i)]
+        result = remote("cd /root && echo tapdance in $(pwd)", use_sudo=True)
+        assert result["stdout"] == ["tapdance in /root"]
+
+
 def test_run_many_remote_commands_singly():
     "multiple commands can be concatenated into a single command"
     command_list = [
@@ -324,6 +352,97 @@ def test_run_many_remote_commands_singly():
         assert result["succeeded"]
 
 
+def test_run_many_remote_commands_concurrently():
+    "many independent commands can be run on a single host at once, each over a separate channel of the same connection"
+    command_list = ["sleep 1 && echo %s" % i for i in range(5)]
+    with _test_settings(quiet=True):
+        results = operations.remote_many(command_list, max_channels=5)
+        assert [result["stdout"] for result in results] == [
+            ["0"],
+            ["1"],
+            ["2"],
+            ["3"],
+            ["4"],
+        ]
+
+
+def test_run_many_remote_commands_in_a_batch():
+    "many commands can be run in a single execution while keeping their results separate"
+    command_list = ["echo all", "exit 1", "echo executed"]
+    with _test_settings(warn_only=True):
+        results = operations.remote_batch(command_list, stop_on_failure=False)
+        assert [result["stdout"] for result in results] == [["all"], [], ["executed"]]
+        assert [result["return_code"] for result in results] == [0, 1, 0]
+
+
+def test_wait_until_remote_condition():
+    "a remote host can be polled for a condition without a round trip per-attempt"
+    with _test_settings(quiet=True):
+        remote("(sleep 1.5; touch /tmp/threadbare-ready) > /dev/null 2>&1 &")
+        result = operations.wait_until(
+            "test -e /tmp/threadbare-ready", max_wait=10, interval=0.2, backoff=1.5
+        )
+        assert result["succeeded"]
+        assert result["attempts"] > 1
+        remote("rm /tmp/threadbare-ready")
+
+
+def test_stream_remote_command_output():
+    "the output of a remote command can be processed line by line as it arrives without accumulating it"
+    with _test_settings(quiet=True):
+        total = 0
+        for pipe, line in operations.remote_stream("seq 1 10000"):
+            total += int(line)
+        assert total == 50005000
+
+
+def test_remote_command_interleaved_output():
+    "stdout and stderr are read at the same time and can be returned in the order they were written"
+    command = "echo one; sleep 0.1; >&2 echo two; sleep 0.1; echo three"
+    with _test_settings(combine_stderr=False, interleave_output=True):
+        result = remote(command)
+        assert result["stdout"] == ["one", "three"]
+        assert result["stderr"] == ["two"]
+        assert [line for _, _, line in result["output"]] == ["one", "two", "three"]
+
+
+def test_remote_command_bounded_output():
+    "only the first and last lines of a command's output need to be kept"
+    with _test_settings(quiet=True, capture_head=1, capture_tail=1):
+        result = remote("seq 1 100000")
+        assert result["stdout"] == ["1", "100000"]
+        assert result["stdout"].dropped == 99998
+
+
+def test_remote_command_timeout():
+    "remote commands that time out are killed on the remote host, along with anything they started"
+    with _test_settings(quiet=True, warn_only=True):
+        result = remote("sleep 7.123 & sleep 7.123; echo done", timeout=1)
+        assert result["timed_out"]
+        assert result["return_code"] is None
+
+        # nothing left running. the brackets stop `pgrep` matching it's own shell
+        result = remote("pgrep -f 'sleep 7[.]123'")
+        assert result["return_code"] == 1
+
+
+def test_remote_command_until():
+    "remote commands can be left running once their output shows they've started"
+    with _test_settings(quiet=True):
+        command = "echo starting; sleep 0.5; echo ready; sleep 7.456"
+        result = remote(command, until="^ready$", detach=True, timeout=10)
+        assert result["matched"] == "ready"
+        assert result["stdout"] == ["starting", "ready"]
+
+        # still running, it's output still being written
+        pid = result["detached"]["pid"]
+        assert remote("kill -0 %s" % pid)["succeeded"]
+        remote("kill %s" % pid)
+
+        result = remote("sleep 7.456", idle_timeout=0.5, warn_only=True)
+        assert result["timed_out"]
+
+
 def test_run_many_remote_commands_serially():
     """run a list of `remote` commands serially. The `execute` module is aimed at
     running commands in parallel.
@@ -366,6 +485,27 @@ def test_run_many_remote_commands_in_parallel():
         assert results[-2]["stdout"] == ["are executed"]
 
 
+def test_run_many_remote_commands_in_parallel_with_a_broker():
+    """run a list of `remote` commands in parallel, sharing a single ssh connection owned by a broker process.
+    the broker authenticates once rather than once per-process."""
+    command_list = [
+        "echo all",
+        "echo these commands",
+        "echo share a",
+        "echo single connection",
+    ]
+
+    @execute.parallel
+    def myfn():
+        return remote(state.ENV["cmd"])
+
+    with _test_settings(quiet=True):
+        with execute.ssh_broker():
+            results = execute.execute(myfn, param_key="cmd", param_values=command_list)
+        assert len(results) == len(command_list)
+        assert results[-2]["stdout"] == ["share a"]
+
+
 def test_remote_exceptions_in_parallel__raise_errors():
     """Remote commands that raise exceptions while executing in parallel are re-raised when encountered in the results."""
 
@@ -412,6 +552,20 @@ def test_check_remote_files():
             assert not remote_file_exists(file_that_does_not_exist)
 
 
+def test_check_remote_files_at_once():
+    "many remote files can be checked with a single command and the results cached"
+    with remote_fixture() as remote_env:
+        with _test_settings(stat_cache=True):
+            file_that_exists = join(remote_env["temp-files"]["small-file"])
+            file_that_does_not_exist = join(remote_env["temp-dir"], "doesnot.exist")
+            result = operations.remote_files_exist(
+                [file_that_exists, file_that_does_not_exist]
+            )
+            assert result == {file_that_exists: True, file_that_does_not_exist: False}
+            # answered from the cache, no command is run
+            assert remote_file_exists(file_that_exists)
+
+
 def _test_upload_and_download_a_file(transfer_protocol):
     """write a local file, upload it to the remote server, modify it remotely, download it, modify it locally,
     assert it's contents are as expected"""
@@ -452,20 +606,85 @@ def _test_upload_and_download_a_file(transfer_protocol):
 
 
 def test_upload_and_download_a_file_coverage_bump():
-    """tests uploading and downloading a file using all three transfer protocols.
+    """tests uploading and downloading a file using all four transfer protocols.
     this is covered more thoroughly in the `./project-tests.sh` script and is
     just to bump test coverage."""
-    for transfer_protocol in ["scp", "sftp", "rsync"]:
+    for transfer_protocol in ["scp", "sftp", "rsync", "pipe"]:
         _test_upload_and_download_a_file(transfer_protocol)
 
 
-def test_upload_a_directory():  # you can't
-    "attempting to upload a directory raises an exception"
+def test_upload_and_download_identical_files():
+    "files with the same contents are not transferred again"
+    with empty_local_fixture() as local_env:
+        with empty_remote_fixture() as remote_env:
+            with _test_settings(skip_identical=True, stat_cache=True):
+                local_file = join(local_env["temp-dir"], "foo.txt")
+                remote_file = join(remote_env["temp-dir"], "foo.txt")
+                local('echo "foo" > %s' % local_file)
+                upload(local_file, remote_file)
+
+                operations.reset_metrics()
+                # the checksums of every remote file are fetched at once and cached
+                operations.remote_checksums([remote_file])
+                upload(local_file, remote_file)
+                download(remote_file, local_file)
+                metrics = operations.metrics()[HOST]
+                assert metrics["transfers-skipped"] == 2
+
+
+def test_upload_and_download_compressed():
+    "large files and command output can be compressed in transit"
+    with empty_local_fixture() as local_env:
+        with empty_remote_fixture() as remote_env:
+            with _test_settings(compression=True):
+                local_file = join(local_env["temp-dir"], "foo.log")
+                remote_file = join(remote_env["temp-dir"], "foo.log")
+                local("seq 1 100000 > %s" % local_file)
+
+                operations.reset_metrics()
+                upload(local_file, remote_file)
+                download(remote_file, local_file + ".2")
+                result = remote("cat %s" % remote_file)
+                assert len(result["stdout"]) == 100000
+                assert local("cmp %s %s.2" % (local_file, local_file))["succeeded"]
+                assert operations.metrics()[HOST]["compressed-transfers"] == 3
+                assert operations.compression_report()[HOST]["ratio"] > 1
+
+
+def test_upload_and_download_a_directory():
+    "directories are uploaded and downloaded as a single compressed tar archive"
+    with empty_local_fixture() as local_env:
+        with empty_remote_fixture() as remote_env:
+            with _test_settings(compress=True):
+                local_dir = join(local_env["temp-dir"], "foo")
+                local(
+                    "mkdir -p %s/bar && echo baz > %s/bar/baz" % (local_dir, local_dir)
+                )
+                remote_dir = join(remote_env["temp-dir"], "foo")
+                upload(local_dir, remote_dir)
+                assert remote("cat %s/bar/baz" % remote_dir)["stdout"] == ["baz"]
+
+                new_local_dir = join(local_env["temp-dir"], "foo2")
+                download(remote_dir, new_local_dir)
+                with open(join(new_local_dir, "bar", "baz")) as fh:
+                    assert fh.read() == "baz\n"
+
+
+def test_upload_a_directory_as_root():
+    "directories can be uploaded and downloaded as root"
     with empty_local_fixture() as local_env:
         with empty_remote_fixture() as remote_env:
             with _test_settings():
-                with pytest.raises(ValueError):
-                    upload(local_env["temp-dir"], remote_env["temp-dir"])
+                local("echo foo > %s/foo" % local_env["temp-dir"])
+                remote_dir = join(remote_env["temp-dir"], "root-dir")
+                upload(local_env["temp-dir"], remote_dir, use_sudo=True)
+                result = remote('stat -c "%%U" %s/foo' % remote_dir)
+                assert result["stdout"] == ["root"]
+
+                local_dir = join(local_env["temp-dir"], "downloaded")
+                download(remote_dir, local_dir, use_sudo=True)
+                with open(join(local_dir, "foo")) as fh:
+                    assert fh.read() == "foo\n"
 
 
 def test_upload_to_extant_remote_file():
@@ -697,6 +916,27 @@ def test_upload_and_download_a_file_using_byte_buffers():
             assert download_unicode_buffer.getvalue() == payload
 
 
+def test_upload_a_file_from_a_generator():
+    "chunks of a file can be generated and uploaded as they are generated, in constant memory"
+    with empty_remote_fixture() as remote_env:
+        with _test_settings(quiet=True):
+            remote_file_name = join(remote_env["temp-dir"], "generated")
+            upload(("line %s\n" % i for i in range(100000)), remote_file_name)
+            result = remote('wc -l "%s"' % remote_file_name)
+            assert result["stdout"][-1].split()[0] == "100000"
+
+
+def test_download_a_file_into_a_callback():
+    "a remote file can be processed as it is downloaded without being written anywhere"
+    with empty_remote_fixture() as remote_env:
+        with _test_settings(quiet=True):
+            remote_file_name = join(remote_env["temp-dir"], "hashed")
+            upload(BytesIO(b"foo"), remote_file_name)
+            digest = hashlib.sha256()
+            download(remote_file_name, digest.update)
+            assert digest.hexdigest() == hashlib.sha256(b"foo").hexdigest()
+
+
 def test_upload_a_file_using_string_buffers():
     """contents of a StringIO buffer can be uploaded to a remote file,
     and the contents of a remote file can be downloaded to a StringIO buffer."""
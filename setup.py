@@ -9,7 +9,7 @@ setup(
     url="https://github.com/elifesciences/threadbare",
     maintainer="Luke",
     maintainer_email="lsh-0@users.noreply.github.com",
-    install_requires=["parallel-ssh>=2.12.0"],
+    install_requires=["parallel-ssh>=2.12.0,<2.13"],
     packages=["threadbare"],
     classifiers=[
         "Intended Audience :: System Administrators",
@@ -1,3 +1,5 @@
+import subprocess
+import time
 import pytest
 from threadbare import common
 
@@ -67,6 +69,55 @@ def test__shell_escape_bad_cases():
             common._shell_escape(given)
 
 
+def test_shell_wrap_command():
+    cases = [
+        [{}, '/bin/bash -l -c "echo \\$HOME"'],
+        [{"login": False}, '/bin/bash -c "echo \\$HOME"'],
+    ]
+    for kwargs, expected in cases:
+        assert expected == common.shell_wrap_command("echo $HOME", **kwargs)
+
+
+def test_detach_wrap_command():
+    "a detached command is run in a new session, it's output followed from a temporary file"
+    actual = common.detach_wrap_command("echo $HOME", "marker")
+    assert 'setsid nohup /bin/sh -c "echo \\$HOME" > "$log"' in actual
+    assert "printf '%s %d %s\\n' 'marker' $pid \"$log\"" in actual
+    assert actual.endswith('exec tail -n +1 -f --pid=$pid "$log"')
+
+
+def test_compress_wrap_command():
+    "output of a wrapped command is compressed as it's produced, once there is enough of it"
+    actual = common.compress_wrap_command("exit 3", "marker", "gzip -c", 100)
+    assert "( exit 3\n) 2>&1 3>&- 4>&-; echo $? >&3;" in actual
+    assert 'head -c 100 > "$head"' in actual
+    assert (
+        "-ge 100 ]; then echo 'marker'; cat \"$head\" - | gzip -c | base64;" in actual
+    )
+    assert actual.endswith("exit $rc")
+
+    actual = common.compress_wrap_command("foo", "marker", "gzip -c", 100, False)
+    assert "( foo\n) 3>&- 4>&-;" in actual
+
+
+def test_compress_wrap_command_streamed():
+    "compressed output arrives while the command is still running and the return code is preserved"
+    command = common.compress_wrap_command(
+        "seq 1 200000; sleep 2; exit 3", "marker", "gzip -c", 100
+    )
+    start = time.time()
+    with subprocess.Popen(["/bin/sh", "-c", command], stdout=subprocess.PIPE) as proc:
+        assert proc.stdout.readline() == b"marker\n"
+        assert proc.stdout.readline()
+        assert time.time() - start < 2
+        proc.stdout.read()
+    assert proc.returncode == 3
+
+    command = common.compress_wrap_command("echo foo; exit 4", "marker", "gzip -c", 100)
+    proc = subprocess.run(["/bin/sh", "-c", command], stdout=subprocess.PIPE)
+    assert (proc.stdout, proc.returncode) == (b"foo\n", 4)
+
+
 def test_is_int():
     true_cases = [1, 2, 3, 4, 5, -1, -2, -3, -4]
     for case in true_cases:
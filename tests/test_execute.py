@@ -1,8 +1,9 @@
 import pytest
 import time
 import logging
+import gevent.event
 from unittest.mock import patch
-from threadbare import execute, operations
+from threadbare import execute, operations, state
 from threadbare.state import settings
 from threadbare.common import PromptedException
 
@@ -401,3 +402,111 @@ def test_execute_process_not_terminating(caplog):
 
     expected_warning_text = "process is still alive despite worker having completed. terminating process: process--1"
     assert expected_warning_text == log_msg
+
+
+class FakeHostOutput:
+    def __init__(self, command):
+        if command == "explode":
+            raise ValueError("boom")
+        self.stdout = [command, "clients=%s" % FakeSSHClient.instances]
+        self.stderr = ["err"]
+        self.exit_code = 0
+        if command == "stderr-first":
+            self.stdout, self.stderr = self._stderr_first()
+
+    def _stderr_first(self):
+        "a command whose stdout doesn't finish until all of it's stderr has been read"
+        stderr_read = gevent.event.Event()
+
+        def stdout():
+            yield "out"
+            stderr_read.wait()
+            yield "done"
+
+        def stderr():
+            yield from ["err"] * 1000
+            stderr_read.set()
+
+        return stdout(), stderr()
+
+
+class FakeSSHClient:
+    "stands in for `operations.SSHClient` within the broker process, counting the number of connections made"
+    instances = 0
+
+    def __init__(self, **kwargs):
+        FakeSSHClient.instances += 1
+
+    def run_command(self, command, *args):
+        return FakeHostOutput(command)
+
+    def wait_finished(self, host_output):
+        pass
+
+    def alive(self):
+        return True
+
+    def disconnect(self):
+        pass
+
+
+def test_ssh_broker():
+    "parallel workers share a single connection per-host owned by the broker process"
+
+    @execute.parallel
+    def workerfn():
+        return operations.remote(
+            state.ENV["cmd"], host_string="testhost", quiet=True, combine_stderr=False
+        )
+
+    command_list = ["echo foo", "echo bar", "echo baz"]
+    with patch("threadbare.operations.SSHClient", FakeSSHClient):
+        with execute.ssh_broker():
+            results = execute.execute(
+                workerfn, param_key="cmd", param_values=command_list
+            )
+
+    for command, result in zip(command_list, results):
+        wrapped_command = '/bin/bash -l -c "%s"' % command
+        assert result["stdout"] == [wrapped_command, "clients=1"]
+        assert result["stderr"] == ["err"]
+        assert result["succeeded"]
+
+
+def test_ssh_broker_exceptions():
+    "exceptions raised by the broker while executing a command are re-raised in the worker"
+    with patch("threadbare.operations.SSHClient", FakeSSHClient):
+        with execute.ssh_broker():
+            with pytest.raises(ValueError):
+                operations.remote("explode", host_string="testhost", use_shell=False)
+
+
+def test_ssh_broker_stopped_early():
+    "a broker that has already exited doesn't hide an exception raised within the context manager"
+    stop = execute.SSHBroker.stop
+
+    def stop_twice(broker):
+        stop(broker)
+        # the broker has already closed the connection
+        raise EOFError("connection to broker closed unexpectedly")
+
+    with patch("threadbare.operations.SSHClient", FakeSSHClient):
+        with patch.object(execute.SSHBroker, "stop", stop_twice):
+            with pytest.raises(ValueError):
+                with execute.ssh_broker():
+                    raise ValueError("boom")
+
+
+def test_ssh_broker_drains_concurrently():
+    "the broker reads a command's stdout and stderr at the same time, so neither can stall the other"
+    with patch("threadbare.operations.SSHClient", FakeSSHClient):
+        with execute.ssh_broker():
+            result = operations.remote(
+                "stderr-first",
+                host_string="testhost",
+                use_shell=False,
+                combine_stderr=False,
+                quiet=True,
+            )
+    assert result["stdout"] == ["out", "done"]
+    assert len(result["stderr"]) == 1000
@@ -3,6 +3,21 @@
 import unittest.mock as mock
 from unittest.mock import patch
 from io import StringIO
+import os
+import pickle
+import re
+import socket
+import subprocess
+import tarfile
+import signal
+import tempfile
+import time
+import gevent
+import hashlib
+import io
+import gevent.event
+import pssh.exceptions
+from ssh2.error_codes import LIBSSH2_ERROR_EAGAIN
 import pytest
 from threadbare import operations, state
 from threadbare.common import merge, cwd, PromptedException
@@ -48,6 +63,7 @@ def test_rcd():
         "key_filename": PEM,
         "use_pty": True,
         "timeout": None,
+        "keepalive_seconds": None,
         "command": '/bin/bash -l -c "cd \\"/tmp\\" && pwd"',
     }
     mockobj.assert_called_with(**expected_kwargs)
@@ -102,6 +118,115 @@ def test_stateful__ssh_client():
             m2.assert_not_called()
 
 
+def test__ssh_client_keepalive():
+    "the interval between keepalive messages can be configured"
+    with patch("threadbare.operations.SSHClient") as m:
+        operations._ssh_client(host_string="localhost", keepalive_seconds=15)
+    assert m.call_args.kwargs["keepalive_seconds"] == 15
+
+
+def test_remote_keepalive():
+    "the interval between keepalive messages can be given to a single command"
+    client = mock.MagicMock()
+    client.run_command.return_value.stdout = []
+    client.run_command.return_value.stderr = []
+    client.run_command.return_value.exit_code = 0
+    with patch("threadbare.operations.SSHClient", return_value=client) as m:
+        with state.settings(host_string=HOST, quiet=True):
+            operations.remote("true", keepalive_seconds=15)
+            operations.remote("true")
+    assert m.call_count == 2
+    assert m.call_args_list[0].kwargs["keepalive_seconds"] == 15
+    assert "keepalive_seconds" not in m.call_args_list[1].kwargs
+
+
+def test_ssh_client_alive():
+    "a client whose connection has been closed by the remote end is not alive"
+    client = operations.SSHClient.__new__(operations.SSHClient)
+    local_end, remote_end = socket.socketpair()
+    client.session, client.sock = object(), local_end
+    assert client.alive()
+    remote_end.close()
+    assert not client.alive()
+    local_end.close()
+
+
+def test_stateful__ssh_client_dead_connection():
+    "a cached SSHClient that is no longer alive is replaced with a new one"
+    operations.reset_metrics()
+    with state.settings():
+        with patch("threadbare.operations.SSHClient"):
+            client = operations._ssh_client(host_string="localhost")
+        client.alive.return_value = False
+        with patch("threadbare.operations.SSHClient") as m2:
+            new_client = operations._ssh_client(host_string="localhost")
+            m2.assert_called_once()
+        client.disconnect.assert_called_once()
+        assert new_client is not client
+        assert operations._ssh_client(host_string="localhost") is new_client
+    assert operations.metrics() == {"localhost": {"ssh-reconnects": 1}}
+
+
+def test_remote_reconnects_dead_session():
+    "a command that fails because the cached connection has died is re-run once on a new connection"
+    operations.reset_metrics()
+    kwargs = {"host_string": HOST, "port": PORT, "user": USER, "key_filename": PEM}
+    dead_client = mock.MagicMock()
+    dead_client.run_command = mock.Mock(side_effect=ConnectionResetError("gone"))
+    live_client = mock.MagicMock()
+    live_client.run_command.return_value.stdout = ["hello"]
+    live_client.run_command.return_value.stderr = []
+    live_client.run_command.return_value.exit_code = 0
+    with state.settings(quiet=True):
+        with patch(
+            "threadbare.operations.SSHClient", side_effect=[dead_client, live_client]
+        ):
+            result = operations.remote("echo hello", **kwargs)
+    assert result["stdout"] == ["hello"]
+    assert operations.metrics() == {HOST: {"ssh-reconnects": 1}}
+
+
+def test_preconnect():
+    "`preconnect` opens a client for each host and stores them for later use"
+    with state.settings(user="joe", key_filename=PEM, port=PORT):
+        with patch("threadbare.operations.SSHClient") as m1:
+            result = operations.preconnect(["host1", "host2"])
+            assert result == {"host1": None, "host2": None}
+            assert m1.call_count == 2
+
+        # clients are re-used once warm
+        with patch("threadbare.operations.SSHClient") as m2:
+            operations._ssh_client(host_string="host1")
+            operations.preconnect(["host1", "host2"])
+            m2.assert_not_called()
+
+
+def test_preconnect_unreachable_hosts():
+    "`preconnect` reports all unreachable hosts together"
+
+    def fake_client(host, **kwargs):
+        if host == "host2":
+            raise ConnectionRefusedError("whom?")
+        return mock.MagicMock()
+
+    with state.settings():
+        with patch("threadbare.operations.SSHClient", side_effect=fake_client):
+            with pytest.raises(RuntimeError) as err:
+                operations.preconnect(["host1", "host2"])
+            assert "host2 (ConnectionRefusedError: whom?)" in str(err.value)
+            assert list(err.value.result.keys()) == ["host1", "host2"]
+
+            result = operations.preconnect(["host1", "host2"], warn_only=True)
+            assert result["host1"] is None
+            assert isinstance(result["host2"], ConnectionRefusedError)
+
+
+def test_preconnect_outside_of_context():
+    "`preconnect` refuses to open connections that would be immediately discarded"
+    with pytest.raises(EnvironmentError):
+        operations.preconnect(["host1"])
+
+
 def test_remote_args_to_execute():
     "`operations.remote` calls `operations._execute` with the correct arguments"
     with patch("threadbare.operations._execute") as mockobj:
@@ -117,6 +242,7 @@ def test_remote_args_to_execute():
         "key_filename": PEM,
         "use_pty": True,
         "timeout": None,
+        "keepalive_seconds": None,
         "command": '/bin/bash -l -c "echo hello"',
     }
     mockobj.assert_called_with(**expected_kwargs)
@@ -137,14 +263,1125 @@ def test_remote_sudo_args_to_execute():
         "key_filename": PEM,
         "use_pty": True,
         "timeout": None,
+        "keepalive_seconds": None,
         "command": 'sudo --non-interactive /bin/bash -l -c "echo hello"',
     }
     mockobj.assert_called_with(**expected_kwargs)
 
 
+def _slow_execute(command, **kwargs):
+    "stands in for `operations._execute`, taking a little while to produce it's output"
+    gevent.sleep(0.2)
+    return {
+        "return_code": lambda: 1 if "fail" in command else 0,
+        "command": command,
+        "stdout": [command],
+        "stderr": [],
+    }
+
+
+def test_remote_many():
+    "`remote_many` runs many commands concurrently on a single host, returning results in order"
+    command_list = ["echo %s" % i for i in range(5)]
+    kwargs = {"host_string": HOST, "quiet": True, "use_shell": False}
+    with patch("threadbare.operations.SSHClient") as m:
+        with patch("threadbare.operations._execute", side_effect=_slow_execute):
+            start = time.time()
+            results = operations.remote_many(command_list, **kwargs)
+            assert time.time() - start < 0.5
+    m.assert_called_once()  # a single connection is made
+    assert [r["stdout"] for r in results] == [[c] for c in command_list]
+
+
+def test_remote_many_max_channels():
+    "`remote_many` runs at most `max_channels` commands at once"
+    command_list = ["echo %s" % i for i in range(3)]
+    kwargs = {"host_string": HOST, "quiet": True, "use_shell": False}
+    with patch("threadbare.operations.SSHClient"):
+        with patch("threadbare.operations._execute", side_effect=_slow_execute):
+            start = time.time()
+            operations.remote_many(command_list, max_channels=1, **kwargs)
+            assert time.time() - start >= 0.6
+
+
+def test_remote_many_failures():
+    "`remote_many` raises the first failure once all commands have finished, unless `warn_only` is `True`"
+    command_list = ["echo foo", "fail", "echo bar"]
+    kwargs = {"host_string": HOST, "quiet": True, "use_shell": False}
+    with patch("threadbare.operations.SSHClient"):
+        with patch("threadbare.operations._execute", side_effect=_slow_execute):
+            with pytest.raises(RuntimeError):
+                operations.remote_many(command_list, **kwargs)
+
+            results = operations.remote_many(command_list, warn_only=True, **kwargs)
+            assert [r["succeeded"] for r in results] == [True, False, True]
+
+
+class LocalShellClient:
+    "stands in for a `SSHClient`, running commands in a local process rather than on a remote host"
+
+    def __init__(self):
+        self.commands = []
+
+    def run_command(self, command, use_pty=False):
+        self.commands.append(command)
+        # a login shell may emit unexpected output and sudo may not be available
+        command = command.replace("/bin/bash -l", "/bin/bash")
+        command = command.replace("sudo --non-interactive ", "")
+        proc = subprocess.Popen(
+            command,
+            shell=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+        def write(data):
+            proc.stdin.write(data)
+            proc.stdin.flush()
+
+        host_output = mock.Mock()
+        host_output.channel.write = write
+        host_output.stdout = (line.decode().rstrip("\n") for line in proc.stdout)
+        host_output.stderr = (line.decode().rstrip("\n") for line in proc.stderr)
+        return host_output
+
+    def eagain_write(self, write_fn, data):
+        write_fn(data)
+
+    def close_channel(self, channel):
+        pass
+
+
+class LocalChannel:
+    """stands in for a `ssh2.channel.Channel`, running a command in a local process rather than on a remote host.
+    like a channel of a non-blocking session, reads and writes return `LIBSSH2_ERROR_EAGAIN` rather than waiting.
+    """
+
+    def __init__(self, command):
+        self.proc = subprocess.Popen(
+            command,
+            shell=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        for pipe in [self.proc.stdin, self.proc.stdout, self.proc.stderr]:
+            os.set_blocking(pipe.fileno(), False)
+
+    def write(self, data):
+        try:
+            written = os.write(self.proc.stdin.fileno(), data)
+        except BlockingIOError:
+            return LIBSSH2_ERROR_EAGAIN, 0
+        return 0, written
+
+    def send_eof(self):
+        self.proc.stdin.close()
+
+    def _read(self, pipe):
+        try:
+            data = os.read(pipe.fileno(), 65536)
+        except BlockingIOError:
+            return LIBSSH2_ERROR_EAGAIN, b""
+        return len(data), data
+
+    def read(self):
+        return self._read(self.proc.stdout)
+
+    def read_stderr(self):
+        return self._read(self.proc.stderr)
+
+    def wait_eof(self):
+        self.proc.wait()
+
+    def wait_closed(self):
+        pass
+
+    def get_exit_status(self):
+        return self.proc.returncode
+
+
+class LocalChannelClient(LocalShellClient):
+    "stands in for a `SSHClient` whose channels are used directly"
+
+    # unused transfer methods
+    copy_file = scp_send = copy_remote_file = scp_recv = mock.Mock()
+
+    def execute(self, command):
+        self.commands.append(command)
+        # sudo may not be available
+        return LocalChannel(command.replace("sudo --non-interactive ", ""))
+
+    def _eagain(self, fn, *args):
+        return fn(*args)
+
+    def poll(self):
+        time.sleep(0.001)
+
+
+def test_pipe_execute_stderr():
+    "a command writing a lot to stderr before reading it's stdin doesn't stall"
+    payload = os.urandom(1000000)
+    command = "head -c 1000000 /dev/zero >&2; cat"
+    return_code, stdout, stderr = operations._pipe_execute(
+        LocalChannelClient(), command, stdin=[payload]
+    )
+    assert return_code == 0
+    assert stdout == payload
+    assert stderr == bytes(1000000)
+
+
+def test_pipe_upload_download(tmp_path):
+    "files can be uploaded and downloaded with a single command each"
+    payload = os.urandom(200000)
+    local_file = tmp_path / "local"
+    local_file.write_bytes(payload)
+    remote_file = tmp_path / "remote" / "dir" / "file"
+    downloaded = tmp_path / "downloaded"
+
+    client = LocalChannelClient()
+    with patch("threadbare.operations._ssh_client", return_value=client):
+        with patch("threadbare.operations._execute") as execute:
+            with state.settings(host_string=HOST, transfer_protocol="pipe"):
+                operations.upload(str(local_file), str(remote_file))
+                operations._transfer_fn(client, "download")(
+                    str(remote_file), str(downloaded)
+                )
+    assert len(client.commands) == 2
+    # run the same whatever the remote user's login shell is
+    assert all(command.startswith("/bin/bash -c ") for command in client.commands)
+    assert not execute.called
+    assert remote_file.read_bytes() == payload
+    assert downloaded.read_bytes() == payload
+
+
+def test_pipe_upload_overwrite(tmp_path):
+    "a 'pipe' upload refuses to replace an existing remote file when `overwrite` is `False`"
+    local_file = tmp_path / "local"
+    local_file.write_bytes(b"new")
+    remote_file = tmp_path / "remote"
+    remote_file.write_bytes(b"old")
+
+    client = LocalChannelClient()
+    upload = operations._transfer_fn(
+        client, "upload", transfer_protocol="pipe", overwrite=False
+    )
+    with pytest.raises(operations.NetworkError):
+        upload(str(local_file), str(remote_file))
+    assert remote_file.read_bytes() == b"old"
+    assert len(client.commands) == 1
+
+
+def test_pipe_upload_failure(tmp_path):
+    "a 'pipe' upload that can't write the remote file raises an error"
+    local_file = tmp_path / "local"
+    local_file.write_bytes(b"foo")
+    # a file can't be created beneath another file
+    remote_file = local_file / "remote"
+
+    upload = operations._transfer_fn(
+        LocalChannelClient(), "upload", transfer_protocol="pipe"
+    )
+    with pytest.raises(operations.NetworkError) as err:
+        upload(str(local_file), str(remote_file))
+    assert "failed to upload file" in str(err.value)
+
+
+def test_pipe_upload_replaces_file(tmp_path):
+    "a 'pipe' upload replaces the remote file only once it's complete, keeping it's mode"
+    remote_file = tmp_path / "remote"
+    remote_file.write_bytes(b"original")
+    remote_file.chmod(0o640)
+
+    def chunks():
+        yield b"x" * 100
+        # long enough for the remote command to have started writing
+        time.sleep(0.2)
+        raise IOError("interrupted")
+
+    client = LocalChannelClient()
+    with pytest.raises(IOError):
+        operations._pipe_upload(client, chunks(), str(remote_file))
+    assert remote_file.read_bytes() == b"original"
+
+    operations._pipe_upload(client, [b"new"], str(remote_file))
+    assert remote_file.read_bytes() == b"new"
+    assert remote_file.stat().st_mode & 0o777 == 0o640
+    # the temporary files are gone
+    assert os.listdir(tmp_path) == ["remote"]
+
+
+def test_pipe_download_failure(tmp_path):
+    "a 'pipe' download that fails leaves any existing local file as it was"
+    local_file = tmp_path / "local"
+    local_file.write_bytes(b"original")
+    local_file.chmod(0o640)
+    remote_file = tmp_path / "remote"
+
+    client = LocalChannelClient()
+    with pytest.raises(operations.NetworkError):
+        operations._pipe_download(client, str(remote_file), str(local_file))
+    assert local_file.read_bytes() == b"original"
+
+    remote_file.write_bytes(b"new")
+    operations._pipe_download(client, str(remote_file), str(local_file))
+    assert local_file.read_bytes() == b"new"
+    assert local_file.stat().st_mode & 0o777 == 0o640
+    assert sorted(os.listdir(tmp_path)) == ["local", "remote"]
+
+
+def test_upload_stream(tmp_path):
+    "file-like objects and iterables of chunks are streamed to the remote file without a temporary file"
+    remote_file = tmp_path / "remote"
+
+    def chunks():
+        yield b"foo"
+        yield ""
+        yield "bar"
+
+    cases = [
+        (io.BytesIO(b"foo"), b"foo"),
+        (io.StringIO("foo"), b"foo"),
+        (chunks(), b"foobar"),
+    ]
+    client = LocalChannelClient()
+    with patch("threadbare.operations._ssh_client", return_value=client):
+        with patch("tempfile.mkstemp", side_effect=AssertionError):
+            with state.settings(host_string=HOST):
+                for stream, expected in cases:
+                    operations.upload(stream, str(remote_file))
+                    assert remote_file.read_bytes() == expected
+    assert len(client.commands) == len(cases)
+
+
+def test_download_stream(tmp_path):
+    "a remote file can be downloaded into any writable object or callback without a temporary file"
+    payload = "ünïcödé " * 20000
+    remote_file = tmp_path / "remote"
+    remote_file.write_text(payload)
+
+    bytes_buffer, string_buffer, digest = io.BytesIO(), io.StringIO(), hashlib.sha256()
+    client = LocalChannelClient()
+    with patch("threadbare.operations._ssh_client", return_value=client):
+        with patch("threadbare.operations._execute", side_effect=_local_execute):
+            with patch("tempfile.mkstemp", side_effect=AssertionError):
+                with state.settings(host_string=HOST, use_shell=False):
+                    for target in [bytes_buffer, string_buffer, digest.update]:
+                        result = operations.download(str(remote_file), target)
+                        assert result is target
+    assert bytes_buffer.getvalue() == payload.encode("utf-8")
+    assert string_buffer.getvalue() == payload
+    assert digest.hexdigest() == hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    assert len(client.commands) == 3
+
+
+def test_download_stream_truncated(tmp_path):
+    "a remote file that ends part way through a character can't be downloaded into a text stream"
+    remote_file = tmp_path / "remote"
+    remote_file.write_bytes("foo é".encode("utf-8")[:-1])
+    with pytest.raises(UnicodeDecodeError):
+        operations._pipe_download(LocalChannelClient(), str(remote_file), StringIO())
+
+
+def test_stream_chunks():
+    "streams are read in chunks of a fixed size"
+    stream = io.BytesIO(b"x" * 10)
+    stream.read(5)
+    assert list(operations._stream_chunks(stream, chunk_size=4)) == [
+        b"xxxx",
+        b"xxxx",
+        b"xx",
+    ]
+
+
+def test_directory_upload_download(tmp_path):
+    "directories are uploaded and downloaded as a tar archive with a single command each, preserving permissions"
+    local_dir = tmp_path / "local"
+    (local_dir / "sub").mkdir(parents=True)
+    for i in range(100):
+        (local_dir / "sub" / str(i)).write_text("file %s" % i)
+    script = local_dir / "script.sh"
+    script.write_text("echo hi")
+    script.chmod(0o750)
+    remote_dir = tmp_path / "remote" / "dir"
+    downloaded = tmp_path / "downloaded"
+
+    for compress in [False, True]:
+        client = LocalChannelClient()
+        with patch("threadbare.operations._ssh_client", return_value=client):
+            with patch("threadbare.operations._execute", side_effect=_local_execute):
+                with state.settings(
+                    host_string=HOST, use_shell=False, compress=compress
+                ):
+                    operations.upload(str(local_dir), str(remote_dir))
+                    operations.download(str(remote_dir), str(downloaded))
+        assert len(client.commands) == 2
+        assert client.commands[1].startswith(
+            '/bin/bash -c "tar -c %s' % ("-z" if compress else "")
+        )
+        for path in [remote_dir, downloaded]:
+            assert (path / "sub" / "99").read_text() == "file 99"
+            assert len(list((path / "sub").iterdir())) == 100
+            assert (path / "script.sh").stat().st_mode & 0o777 == 0o750
+
+
+def test_directory_upload_overwrite(tmp_path):
+    "a directory upload refuses to write to an existing remote directory when `overwrite` is `False`"
+    local_dir = tmp_path / "local"
+    local_dir.mkdir()
+    (local_dir / "foo").write_text("foo")
+    remote_dir = tmp_path / "remote"
+    remote_dir.mkdir()
+
+    with patch("threadbare.operations._ssh_client", return_value=LocalChannelClient()):
+        with state.settings(host_string=HOST):
+            with pytest.raises(operations.NetworkError):
+                operations.upload(str(local_dir), str(remote_dir), overwrite=False)
+    assert list(remote_dir.iterdir()) == []
+
+
+def test_directory_download_failure(tmp_path):
+    "a directory download that fails on the remote host raises an error with the reason"
+    client = LocalChannelClient()
+    with pytest.raises(operations.NetworkError) as err:
+        operations._tar_download(
+            client, str(tmp_path / "missing"), str(tmp_path / "downloaded")
+        )
+    assert "missing" in str(err.value)
+
+
+def test_directory_download_contained(tmp_path, monkeypatch):
+    "without extraction filters, archive members that would be written or link outside of the local directory are refused"
+    monkeypatch.delattr(tarfile, "tar_filter", raising=False)
+    local_dir = tmp_path / "downloaded"
+    local_dir.mkdir()
+
+    def archive(*member_list):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            for name, kind, linkname in member_list:
+                member = tarfile.TarInfo(name)
+                member.type, member.linkname = kind, linkname
+                tar.addfile(member)
+        buffer.seek(0)
+        return tarfile.open(fileobj=buffer, mode="r|")
+
+    bad_cases = [
+        ("../evil", tarfile.REGTYPE, ""),
+        ("/evil", tarfile.REGTYPE, ""),
+        ("link", tarfile.SYMTYPE, "../evil"),
+        ("link", tarfile.SYMTYPE, "/etc/passwd"),
+        ("sub/link", tarfile.SYMTYPE, "../../evil"),
+        ("link", tarfile.LNKTYPE, "../evil"),
+    ]
+    for case in bad_cases:
+        with pytest.raises(tarfile.TarError):
+            list(operations._contained_tar_members(archive(case), str(local_dir)))
+
+    good_cases = [
+        ("./file", tarfile.REGTYPE, ""),
+        ("./sub/link", tarfile.SYMTYPE, "../file"),
+        ("./hardlink", tarfile.LNKTYPE, "./file"),
+    ]
+    members = operations._contained_tar_members(archive(*good_cases), str(local_dir))
+    assert [member.name for member in members] == [name for name, _, _ in good_cases]
+
+    # a remote symlink pointing outside of the directory being downloaded
+    remote_dir = tmp_path / "remote"
+    remote_dir.mkdir()
+    (remote_dir / "link").symlink_to("/etc/passwd")
+    with pytest.raises(operations.NetworkError) as err:
+        operations._tar_download(LocalChannelClient(), str(remote_dir), str(local_dir))
+    assert "refusing to extract" in str(err.value)
+    assert not os.path.lexists(local_dir / "link")
+
+
+def test_sudo_transfers(tmp_path):
+    "files and directories are transferred as root through a remote `sudo`, without temporary copies"
+    local_file = tmp_path / "local"
+    local_file.write_bytes(b"foo")
+    local_dir = tmp_path / "local-dir"
+    local_dir.mkdir()
+    (local_dir / "bar").write_bytes(b"bar")
+    remote_file = tmp_path / "remote" / "file"
+    remote_dir = tmp_path / "remote" / "dir"
+    buffer = io.BytesIO()
+
+    client = LocalChannelClient()
+    with patch("threadbare.operations._ssh_client", return_value=client):
+        with patch("threadbare.operations.remote") as remote:
+            # `test -d` and `test -e`
+            remote.side_effect = [{"succeeded": False}, {"return_code": 0}] * 2 + [
+                {"succeeded": True}
+            ]
+            with patch("tempfile.mkstemp", side_effect=AssertionError):
+                with state.settings(host_string=HOST):
+                    operations.upload(str(local_file), str(remote_file), use_sudo=True)
+                    operations.upload(str(local_dir), str(remote_dir), use_sudo=True)
+                    operations.download(
+                        str(remote_file), str(tmp_path / "downloaded"), use_sudo=True
+                    )
+                    operations.download(str(remote_file), buffer, use_sudo=True)
+                    operations.download(
+                        str(remote_dir), str(tmp_path / "downloaded-dir"), use_sudo=True
+                    )
+    assert len(client.commands) == 5
+    assert all(
+        command.startswith("sudo --non-interactive ") for command in client.commands
+    )
+    assert remote_file.read_bytes() == b"foo"
+    assert (remote_dir / "bar").read_bytes() == b"bar"
+    assert (tmp_path / "downloaded").read_bytes() == b"foo"
+    assert buffer.getvalue() == b"foo"
+    assert (tmp_path / "downloaded-dir" / "bar").read_bytes() == b"bar"
+
+
+def test_compression_codec():
+    "the compression codec is negotiated once per-host, preferring zstd when it's available locally"
+    with patch.dict(operations.COMPRESSION_COMMANDS, clear=True):
+        with patch("threadbare.operations.remote") as remote:
+            remote.return_value = {"stdout": ["/usr/bin/zstd", "/bin/gzip"]}
+            with state.settings(host_string=HOST):
+                assert operations._compression_codec() is None
+                with patch("threadbare.operations.zstandard", None):
+                    assert (
+                        operations._compression_codec(compression=True)["name"]
+                        == "gzip"
+                    )
+                with patch("threadbare.operations.zstandard"):
+                    assert (
+                        operations._compression_codec(compression=True)["name"]
+                        == "zstd"
+                    )
+                    assert (
+                        operations._compression_codec(compression="gzip")["name"]
+                        == "gzip"
+                    )
+                with pytest.raises(ValueError):
+                    operations._compression_codec(compression="bzip2")
+            assert remote.call_count == 1
+
+            # nothing in common
+            remote.return_value = {"stdout": []}
+            assert (
+                operations._compression_codec(host_string="otherhost", compression=True)
+                is None
+            )
+
+
+def test_remote_compressed_output():
+    "large `remote` output is compressed on the remote host and decompressed as it's read"
+    operations.reset_metrics()
+    calls = []
+
+    def execute(command, **kwargs):
+        calls.append(command)
+        return _local_execute(command, **kwargs)
+
+    with patch.dict(operations.COMPRESSION_COMMANDS, clear=True):
+        with patch("threadbare.operations._execute", side_effect=execute):
+            with state.settings(
+                host_string=HOST, compression=True, use_shell=False, quiet=True
+            ):
+                result = operations.remote(
+                    "seq 1 20000; echo done >&2; exit 3", warn_only=True
+                )
+                assert result["stdout"] == [str(i) for i in range(1, 20001)] + ["done"]
+                assert result["return_code"] == 3
+                # the command given, not the one wrapped for compression
+                assert result["command"] == "seq 1 20000; echo done >&2; exit 3"
+
+                # below the threshold
+                assert operations.remote("echo foo")["stdout"] == ["foo"]
+
+                # given to `on_line` as it arrives
+                lines = []
+                operations.remote(
+                    "seq 1 20000", on_line=lambda pipe, line: lines.append(line)
+                )
+                assert len(lines) == 20000
+
+                # stopped early
+                operations.remote("echo foo", until="foo")
+    assert "gzip -c" in calls[1]
+    assert ["gzip -c" in command for command in calls[-2:]] == [False, False]
+    report = operations.compression_report()[HOST]
+    assert report["ratio"] > 1
+    assert operations.metrics()[HOST]["compressed-transfers"] == 1
+
+
+def test_compressed_transfers(tmp_path):
+    "uploads and downloads are compressed in transit when they're large enough"
+    payload = b"foo bar baz\n" * 20000
+    local_file = tmp_path / "local"
+    local_file.write_bytes(payload)
+    small_file = tmp_path / "small"
+    small_file.write_bytes(b"foo")
+    remote_dir = tmp_path / "remote"
+
+    operations.reset_metrics()
+    client = LocalChannelClient()
+    with patch.dict(operations.COMPRESSION_COMMANDS, clear=True):
+        with patch("threadbare.operations._ssh_client", return_value=client):
+            with patch("threadbare.operations._execute", side_effect=_local_execute):
+                with state.settings(
+                    host_string=HOST, compression=True, use_shell=False
+                ):
+                    operations.upload(str(local_file), str(remote_dir / "large"))
+                    operations.upload(str(small_file), str(remote_dir / "small"))
+                    operations.upload(io.BytesIO(payload), str(remote_dir / "stream"))
+                    operations.download(
+                        str(remote_dir / "large"), str(tmp_path / "large")
+                    )
+                    operations.download(
+                        str(remote_dir / "small"), str(tmp_path / "small-2")
+                    )
+    assert (remote_dir / "large").read_bytes() == payload
+    assert (remote_dir / "stream").read_bytes() == payload
+    assert (remote_dir / "small").read_bytes() == b"foo"
+    assert (tmp_path / "large").read_bytes() == payload
+    assert (tmp_path / "small-2").read_bytes() == b"foo"
+    assert ["gzip -d -c" in command for command in client.commands] == [
+        True,
+        False,
+        True,
+        False,
+        False,
+    ]
+
+    host_metrics = operations.metrics()[HOST]
+    assert host_metrics["compressed-transfers"] == 3
+    assert host_metrics["compression-bytes-uncompressed"] == len(payload) * 3
+    assert host_metrics["compression-bytes-compressed"] < len(payload)
+
+
+def test_skip_identical(tmp_path):
+    "uploads and downloads are skipped when both files have the same contents, the bytes saved are counted"
+    local_file = tmp_path / "local"
+    local_file.write_bytes(b"foo")
+    remote_file = tmp_path / "remote"
+    remote_file.write_bytes(b"foo")
+
+    operations.reset_metrics()
+    client = LocalChannelClient()
+    with patch("threadbare.operations._ssh_client", return_value=client):
+        with patch("threadbare.operations._execute", side_effect=_local_execute):
+            with state.settings(
+                host_string=HOST,
+                transfer_protocol="pipe",
+                skip_identical=True,
+                use_shell=False,
+            ):
+                operations.upload(str(local_file), str(remote_file))
+                operations.download(str(remote_file), str(local_file))
+                assert client.commands == []
+
+                local_file.write_bytes(b"bar")
+                operations.upload(str(local_file), str(remote_file))
+                assert len(client.commands) == 1
+    assert remote_file.read_bytes() == b"bar"
+    assert operations.metrics()[HOST] == {
+        "transfers-skipped": 2,
+        "transfer-bytes-skipped": 6,
+    }
+
+
+def test_skip_identical_directory(tmp_path):
+    "directory transfers checksum every file with a single command and only send the files that differ"
+    local_dir = tmp_path / "local"
+    remote_dir = tmp_path / "remote"
+    for path in [local_dir, remote_dir]:
+        (path / "sub").mkdir(parents=True)
+        for i in range(20):
+            (path / "sub" / str(i)).write_text("file %s" % i)
+    # files that are sent again would have their modification time replaced
+    os.utime(remote_dir / "sub" / "2", (0, 0))
+    os.utime(local_dir / "sub" / "3", (0, 0))
+
+    operations.reset_metrics()
+    client = LocalChannelClient()
+    with patch("threadbare.operations._ssh_client", return_value=client):
+        with patch(
+            "threadbare.operations._execute", side_effect=_local_execute
+        ) as execute:
+            with state.settings(host_string=HOST, skip_identical=True, use_shell=False):
+                operations.upload(str(local_dir), str(remote_dir))
+                assert execute.call_count == 1
+                assert client.commands == []
+
+                (local_dir / "sub" / "0").write_text("changed")
+                operations.upload(str(local_dir), str(remote_dir))
+                assert execute.call_count == 2
+
+                (remote_dir / "sub" / "1").write_text("changed remotely")
+                (remote_dir / "new").write_text("new")
+                operations.download(str(remote_dir), str(local_dir))
+                # `test -d` and the checksums
+                assert execute.call_count == 4
+    assert len(client.commands) == 2
+    assert "--no-recursion" in client.commands[1]
+    assert (remote_dir / "sub" / "0").read_text() == "changed"
+    assert (local_dir / "sub" / "1").read_text() == "changed remotely"
+    assert (local_dir / "new").read_text() == "new"
+    assert (remote_dir / "sub" / "2").stat().st_mtime == 0
+    assert (local_dir / "sub" / "3").stat().st_mtime == 0
+    assert operations.metrics()[HOST] == {
+        "transfers-skipped": 20 + 19 + 19,
+        "transfer-bytes-skipped": 130 + 124 + 125,
+    }
+
+
+def test_remote_checksums(tmp_path):
+    "`remote_checksums` checksums many remote files with a single command"
+    remote_file = tmp_path / "remote"
+    remote_file.write_bytes(b"foo")
+    expected = "2c26b46b68ffc68ff99b453c1d30413413422d706483bfa0f98a5e886266e7ae"
+    with patch("threadbare.operations._execute", side_effect=_local_execute) as ex:
+        with state.settings(host_string=HOST, use_shell=False, quiet=True):
+            result = operations.remote_checksums([str(remote_file), str(tmp_path)])
+    assert ex.call_count == 1
+    assert result == {str(remote_file): expected, str(tmp_path): None}
+
+
+def test_stat_cache_upload(tmp_path):
+    "paths uploaded to and their parents are forgotten by the stat cache, even though `upload` uses it's own context manager"
+    local_file = tmp_path / "local"
+    local_file.write_bytes(b"foo")
+    remote_dir = str(tmp_path / "remote")
+    remote_file = str(tmp_path / "remote" / "file")
+
+    client = LocalChannelClient()
+    with patch("threadbare.operations._ssh_client", return_value=client):
+        with patch("threadbare.operations._execute", side_effect=_local_execute):
+            with state.settings(
+                host_string=HOST, stat_cache=True, use_shell=False, quiet=True
+            ):
+                assert not operations.remote_file_exists(remote_file)
+                assert not operations.remote_file_exists(remote_dir)
+                operations.upload(
+                    str(local_file), remote_file, transfer_protocol="pipe"
+                )
+                assert operations.remote_file_exists(remote_file)
+                # created by the upload
+                assert operations.remote_file_exists(remote_dir)
+
+
+def test_stat_cache_directory_upload(tmp_path):
+    "the files within an uploaded directory are forgotten by the stat cache"
+    local_dir = tmp_path / "local"
+    local_dir.mkdir()
+    (local_dir / "foo").write_bytes(b"new")
+    remote_dir = tmp_path / "remote"
+    remote_dir.mkdir()
+    (remote_dir / "foo").write_bytes(b"old")
+    remote_file = str(remote_dir / "foo")
+    missing_file = str(remote_dir / "bar")
+
+    client = LocalChannelClient()
+    with patch("threadbare.operations._ssh_client", return_value=client):
+        with patch("threadbare.operations._execute", side_effect=_local_execute):
+            with state.settings(
+                host_string=HOST, stat_cache=True, use_shell=False, quiet=True
+            ):
+                assert not operations.remote_file_exists(missing_file)
+                old_checksum = operations.remote_checksums([remote_file])[remote_file]
+                (local_dir / "bar").write_bytes(b"bar")
+                operations.upload(str(local_dir), str(remote_dir))
+                assert operations.remote_file_exists(missing_file)
+                assert (
+                    operations.remote_checksums([remote_file])[remote_file]
+                    != old_checksum
+                )
+
+
+def test_remote_session():
+    "commands can be run within a single long-lived shell, with the same results as `remote`"
+    client = LocalShellClient()
+    with patch("threadbare.operations._ssh_client", return_value=client):
+        with state.settings(use_session=True, quiet=True, host_string=HOST):
+            result = operations.remote("cd /tmp; foo=bar; echo $PWD $foo")
+            assert result["stdout"] == ["/tmp bar"]
+            assert result["command"] == "cd /tmp; foo=bar; echo $PWD $foo"
+
+            # commands are isolated from each other
+            result = operations.remote('echo "$PWD ${foo:-unset}"')
+            assert result["stdout"] == ["%s unset" % cwd()]
+
+            # output without a trailing newline
+            result = operations.remote("printf foo")
+            assert result["stdout"] == ["foo"]
+
+            result = operations.remote("echo out; >&2 echo err", combine_stderr=False)
+            assert result["stdout"] == ["out"]
+            assert result["stderr"] == ["err"]
+
+            result = operations.remote("echo out; >&2 echo err")
+            assert result["stdout"] == ["out", "err"]
+
+            with pytest.raises(RuntimeError):
+                operations.remote("exit 3")
+
+            result = operations.remote("exit 3", warn_only=True)
+            assert result["return_code"] == 3
+            assert result["failed"]
+
+            # commands that aren't valid shell fail by themselves, leaving the session usable
+            with gevent.Timeout(5):
+                for command in ["echo 'unterminated", "echo ok )"]:
+                    assert operations.remote(command, warn_only=True)["failed"]
+                # an unfinished heredoc is ended by the end of the command, with a warning
+                result = operations.remote("cat <<EOF\nfoo", combine_stderr=False)
+                assert result["stdout"] == ["foo"]
+            result = operations.remote("echo hi # comment")
+            assert result["stdout"] == ["hi"]
+
+            # a second shell is used for commands run as root
+            operations.remote("echo hi", use_sudo=True)
+
+    assert client.commands == ["/bin/bash -l", "sudo --non-interactive /bin/bash -l"]
+
+
+def test_remote_session_timeout():
+    "a command with a `timeout` isn't run within a session, so it's killed like any other when it times out"
+    calls = []
+    client = LocalShellClient()
+    with patch("threadbare.operations._ssh_client", return_value=client):
+        with patch(
+            "threadbare.operations._execute", side_effect=_timeout_execute(calls)
+        ):
+            with state.settings(use_session=True, quiet=True, host_string=HOST):
+                result = operations.remote("sleep 5", timeout=1, warn_only=True)
+                assert result["timed_out"]
+                assert calls[1] == "kill -s KILL -- -1234"
+                assert operations.remote("echo hi")["stdout"] == ["hi"]
+    assert client.commands == ["/bin/bash -l"]
+
+
+def _local_execute(command, **kwargs):
+    "stands in for `operations._execute`, running the command locally rather than on a remote host"
+    proc = subprocess.Popen(
+        command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    stdout, stderr = proc.communicate()
+    return {
+        "return_code": lambda: proc.returncode,
+        "command": command,
+        "stdout": stdout.decode().splitlines(),
+        "stderr": stderr.decode().splitlines(),
+    }
+
+
+def test_remote_batch():
+    "`remote_batch` runs many commands in a single execution, returning a result per-command"
+    command_list = ["echo foo", "printf bar; >&2 echo baz", "echo bup # comment"]
+    with patch("threadbare.operations._execute", side_effect=_local_execute):
+        results = operations.remote_batch(
+            command_list, host_string=HOST, combine_stderr=False, quiet=True
+        )
+    assert [r["command"] for r in results] == command_list
+    assert [r["stdout"] for r in results] == [["foo"], ["bar"], ["bup"]]
+    assert [r["stderr"] for r in results] == [[], ["baz"], []]
+    assert [r["return_code"] for r in results] == [0, 0, 0]
+    assert all(r["duration"] >= 0 for r in results)
+
+
+def test_remote_batch_failures():
+    "`remote_batch` stops at the first failed command unless `stop_on_failure` is `False`"
+    command_list = ["echo foo", "exit 2", "echo bar"]
+    with patch("threadbare.operations._execute", side_effect=_local_execute):
+        with state.settings(host_string=HOST, quiet=True):
+            with pytest.raises(RuntimeError) as err:
+                operations.remote_batch(command_list)
+            assert [r["return_code"] for r in err.value.result] == [0, 2]
+
+            results = operations.remote_batch(
+                command_list, stop_on_failure=False, warn_only=True
+            )
+            assert [r["return_code"] for r in results] == [0, 2, 0]
+            assert [r["stdout"] for r in results] == [["foo"], [], ["bar"]]
+            assert [r["succeeded"] for r in results] == [True, False, True]
+
+
+def test_remote_batch_script_failures():
+    "a batch whose script dies part way through fails, along with the command it was running"
+    cases = [
+        # syntax error
+        ["echo a", "echo 'unbalanced", "echo c"],
+        # killed
+        ["echo a", "kill -9 $$", "echo c"],
+    ]
+    with patch("threadbare.operations._execute", side_effect=_local_execute):
+        with state.settings(host_string=HOST, quiet=True, use_shell=False):
+            for command_list in cases:
+                with pytest.raises(RuntimeError) as err:
+                    operations.remote_batch(command_list)
+                results = err.value.result
+                assert [r["command"] for r in results] == command_list[:2]
+                assert [r["succeeded"] for r in results] == [True, False]
+
+                results = operations.remote_batch(command_list, warn_only=True)
+                assert results[-1]["failed"]
+
+
 # remote calls with non-default args
 
 
+def test_remote_on_line():
+    "`remote` calls `on_line` with each line of output as it is read"
+    seen = []
+    with patch("threadbare.operations._execute", side_effect=_local_execute):
+        result = operations.remote(
+            "echo foo; echo bar; >&2 echo baz",
+            host_string=HOST,
+            combine_stderr=False,
+            quiet=True,
+            use_shell=False,
+            on_line=lambda pipe, line: seen.append((pipe, line)),
+        )
+    assert seen == [("out", "foo"), ("out", "bar"), ("err", "baz")]
+    assert result["stdout"] == ["foo", "bar"]
+
+
+def test_wait_until():
+    "`wait_until` polls a condition on the remote host in a single execution, returning the final attempt"
+    path = tempfile.mktemp()
+    with patch("threadbare.operations._execute", side_effect=_local_execute) as ex:
+        gevent.spawn_later(0.5, open, path, "w")
+        result = operations.wait_until(
+            "cat %s && echo found" % path,
+            max_wait=5,
+            interval=0.1,
+            host_string=HOST,
+            use_shell=False,
+            quiet=True,
+        )
+    os.unlink(path)
+    assert ex.call_count == 1
+    assert result["succeeded"] and not result["timed_out"]
+    assert result["attempts"] > 1
+    assert result["stdout"] == ["found"]
+
+
+def test_wait_until_timeout():
+    "`wait_until` gives up after `max_wait` seconds, backing off between attempts"
+    with patch("threadbare.operations._execute", side_effect=_local_execute):
+        result = operations.wait_until(
+            "echo nope; false",
+            max_wait=1,
+            interval=0.2,
+            backoff=2,
+            host_string=HOST,
+            use_shell=False,
+            quiet=True,
+            warn_only=True,
+        )
+        with pytest.raises(RuntimeError):
+            operations.wait_until(
+                "false", max_wait=1, host_string=HOST, use_shell=False, quiet=True
+            )
+    assert result["timed_out"] and result["failed"]
+    assert result["return_code"] == 1
+    assert 1 < result["attempts"] < 6
+    assert result["stdout"] == ["nope"]
+
+
+def test_wait_until_read_timeout():
+    "a `timeout` given to `wait_until` bounds reading it's output, like `remote`"
+    with patch("threadbare.operations._execute", side_effect=_local_execute) as ex:
+        operations.wait_until(
+            "true",
+            max_wait=5,
+            timeout=30,
+            host_string=HOST,
+            use_shell=False,
+            quiet=True,
+        )
+    assert ex.call_args.kwargs["timeout"] == 30
+
+
+def test_remote_files_exist():
+    "`remote_files_exist` checks many remote paths with a single command"
+    path_list = [os.path.abspath(__file__), "/does/not/exist", "/tmp"]
+    with patch("threadbare.operations._execute", side_effect=_local_execute) as ex:
+        with state.settings(host_string=HOST, use_shell=False, quiet=True):
+            result = operations.remote_files_exist(path_list)
+    assert ex.call_count == 1
+    assert result == {path_list[0]: True, "/does/not/exist": False, "/tmp": True}
+
+
+def test_stat_cache():
+    "remote paths are only checked once within a context manager when `stat_cache` is `True`"
+    path = os.path.abspath(__file__)
+    with patch("threadbare.operations._execute", side_effect=_local_execute) as ex:
+        with state.settings(host_string=HOST, use_shell=False, quiet=True):
+            with state.settings(stat_cache=True):
+                assert operations.remote_files_exist([path, "/tmp"])
+                assert operations.remote_file_exists(path)
+                assert operations.remote_files_exist([path]) == {path: True}
+                assert ex.call_count == 1
+
+                # checked again once written to
+                operations._stat_cache_forget([path])
+                assert operations.remote_file_exists(path)
+                assert ex.call_count == 2
+
+                # and when checked as a different user
+                operations.remote_file_exists(path, use_sudo=True)
+                assert ex.call_count == 3
+
+            # the cache doesn't outlive the context manager
+            assert operations.remote_file_exists(path)
+            assert ex.call_count == 4
+
+
+def test_remote_stream():
+    "`remote_stream` yields each line of output as it arrives and returns the final result"
+    with patch("threadbare.operations._execute", side_effect=_local_execute):
+        stream = operations.remote_stream(
+            "echo foo; >&2 echo bar; exit 3",
+            host_string=HOST,
+            combine_stderr=False,
+            quiet=True,
+            use_shell=False,
+            warn_only=True,
+        )
+        assert next(stream) == ("out", "foo")
+        assert next(stream) == ("err", "bar")
+        with pytest.raises(StopIteration) as exc:
+            next(stream)
+    result = exc.value.value
+    assert result["return_code"] == 3
+    assert result["failed"]
+    assert result["stdout"] is None
+
+
+def test_remote_stream_failure():
+    "`remote_stream` raises an exception once the output is consumed if the command failed"
+    with patch("threadbare.operations._execute", side_effect=_local_execute):
+        with pytest.raises(RuntimeError):
+            list(
+                operations.remote_stream(
+                    "exit 1", host_string=HOST, quiet=True, use_shell=False
+                )
+            )
+
+
+def _fake_execute(stdout, stderr, return_code=0):
+    "returns a stand-in for `operations._execute` whose output is read from the given iterables"
+
+    def execute(command, **kwargs):
+        return {
+            "return_code": lambda: return_code,
+            "command": command,
+            "stdout": stdout,
+            "stderr": stderr,
+        }
+
+    return execute
+
+
+def test_remote_interleave_output():
+    "`remote` reads `stdout` and `stderr` concurrently and can return lines in the order they arrived"
+
+    def stdout():
+        yield "foo"
+        gevent.sleep(0.05)
+        yield "baz"
+
+    def stderr():
+        gevent.sleep(0.02)
+        yield "bar"
+
+    seen = []
+    execute = _fake_execute(stdout(), stderr())
+    with patch("threadbare.operations._execute", side_effect=execute):
+        result = operations.remote(
+            "foo",
+            host_string=HOST,
+            combine_stderr=False,
+            quiet=True,
+            interleave_output=True,
+            on_line=lambda pipe, line: seen.append(line),
+        )
+    assert seen == ["foo", "bar", "baz"]
+    assert result["stdout"] == ["foo", "baz"]
+    assert result["stderr"] == ["bar"]
+    assert [(pipe, line) for _, pipe, line in result["output"]] == [
+        ("out", "foo"),
+        ("err", "bar"),
+        ("out", "baz"),
+    ]
+    timestamps = [timestamp for timestamp, _, _ in result["output"]]
+    assert timestamps == sorted(timestamps)
+
+
+def test_remote_stderr_not_starved():
+    "`remote` doesn't stall on a command that won't write to `stdout` until it's `stderr` has been read"
+    stderr_read = gevent.event.Event()
+
+    def stdout():
+        stderr_read.wait()
+        yield "foo"
+
+    def stderr():
+        yield "bar"
+        stderr_read.set()
+
+    execute = _fake_execute(stdout(), stderr())
+    with patch("threadbare.operations._execute", side_effect=execute):
+        with gevent.Timeout(2):
+            result = operations.remote(
+                "foo", host_string=HOST, combine_stderr=False, quiet=True
+            )
+    assert result["stdout"] == ["foo"]
+    assert result["stderr"] == ["bar"]
+    assert "output" not in result
+
+
+def test_remote_output_exception():
+    "exceptions reading output, like timeouts, are raised by `remote`"
+
+    def stdout():
+        yield "foo"
+        raise pssh.exceptions.Timeout()
+
+    execute = _fake_execute(stdout(), [])
+    with patch("threadbare.operations._execute", side_effect=execute):
+        with pytest.raises(pssh.exceptions.Timeout):
+            operations.remote("foo", host_string=HOST, quiet=True)
+
+
+def test_remote_capture_tail():
+    "`remote` can capture just the last lines of output"
+    execute = _fake_execute(map(str, range(1000)), ["foo", "bar"])
+    with patch("threadbare.operations._execute", side_effect=execute):
+        result = operations.remote(
+            "foo",
+            host_string=HOST,
+            combine_stderr=False,
+            quiet=True,
+            capture_tail=2,
+            interleave_output=True,
+        )
+    assert result["stdout"] == ["998", "999"]
+    assert result["stdout"].dropped == 998
+    assert result["stderr"] == ["foo", "bar"]
+    assert len(result["output"]) == 2
+
+
+def test_discarding_buffer():
+    "output read from a command isn't kept in memory"
+    buf = operations._DiscardingRWBuffer()
+    buf.write(b"foo")
+    assert buf.read() == b"foo"
+    assert buf._buffer.getvalue() == b""
+    buf.write(b"bar")
+    buf.write(b"baz")
+    assert buf.read() == b"barbaz"
+    assert buf.read() is None
+
+
 def test_remote_non_default_args():
     "`operations.remote` calls `operations._execute` with the correct arguments"
     base = {
@@ -154,6 +1391,7 @@ def test_remote_non_default_args():
         "key_filename": PEM,
         "command": "echo hello",
         "timeout": None,
+        "keepalive_seconds": None,
     }
 
     # given args, expected args
@@ -205,10 +1443,15 @@ def test_remote_non_default_args():
             {"remote_working_dir": "/tmp", "command": "pwd", "use_shell": True},
             {"use_pty": True, "command": '/bin/bash -l -c "cd \\"/tmp\\" && pwd"'},
         ],
-        # timeout
+        # timeout, command prints it's process group ID so it can be killed
         [
             {"command": "sleep 5", "timeout": 1},
-            {"use_pty": True, "command": '/bin/bash -l -c "sleep 5"', "timeout": 1},
+            {
+                "use_pty": True,
+                "command": "printf '%s %d\\n' '__threadbare_pgid_abc__' $$; "
+                + '/bin/bash -l -c "sleep 5"',
+                "timeout": 1,
+            },
         ],
         # edge cases
         # shell, non-tty command
@@ -223,6 +1466,7 @@ def test_remote_non_default_args():
             {"use_pty": False, "command": '/bin/bash -l -c "echo hello"'},
         ],
     ]
+    uuid = mock.Mock(hex="abc")
     for given_kwargs, expected_kwargs in cases:
         with patch("threadbare.operations._execute") as mockobj:
             mockobj.return_value = {
@@ -230,10 +1474,228 @@ def test_remote_non_default_args():
                 "stdout": [],
                 "stderr": [],
             }
-            operations.remote(**merge(base, given_kwargs))
+            with patch("threadbare.operations.uuid.uuid4", return_value=uuid):
+                operations.remote(**merge(base, given_kwargs))
             mockobj.assert_called_with(**merge(base, expected_kwargs))
 
 
+def _timeout_execute(calls, pgid_line=True, preamble=""):
+    """returns a stand-in for `operations._execute` where the first command prints it's process group ID and some
+    output before timing out. subsequent commands succeed. every command is appended to `calls`.
+    the process group ID is preceded by any `preamble`, like a login shell's profile might print.
+    """
+
+    def execute(command, **kwargs):
+        calls.append(command)
+        if len(calls) > 1:
+            return {"return_code": lambda: 0, "stdout": [], "stderr": []}
+        marker = re.search(r"'(__threadbare_pgid_\w+__)'", command).group(1)
+
+        def stdout():
+            lines = (preamble + "%s 1234" % marker).split("\n")
+            if pgid_line:
+                yield from lines
+            yield "foo"
+            raise pssh.exceptions.Timeout()
+
+        return {"return_code": lambda: None, "stdout": stdout(), "stderr": []}
+
+    return execute
+
+
+def test_remote_timeout_kills_process_group():
+    "a `remote` command that times out has it's process group killed and the result says so"
+    calls = []
+    with patch("threadbare.operations._execute", side_effect=_timeout_execute(calls)):
+        result = operations.remote(
+            "sleep 5", host_string=HOST, timeout=1, warn_only=True, quiet=True
+        )
+    assert calls[1] == "kill -s KILL -- -1234"
+    assert result["timed_out"]
+    assert result["return_code"] is None
+    assert result["failed"] and not result["succeeded"]
+    assert result["stdout"] == ["foo"]
+    assert "kill" not in result
+
+
+def test_remote_timeout_login_output():
+    "output printed before a `remote` command's process group ID doesn't stop the process group being killed"
+    calls = []
+    execute = _timeout_execute(calls, preamble="welcome\nno newline")
+    with patch("threadbare.operations._execute", side_effect=execute):
+        result = operations.remote(
+            "sleep 5", host_string=HOST, timeout=1, warn_only=True, quiet=True
+        )
+    assert calls[1] == "kill -s KILL -- -1234"
+    assert result["stdout"] == ["welcome", "no newline", "foo"]
+
+
+def test_remote_timeout_raises():
+    "a `remote` command that times out raises an error unless `warn_only` is `True`"
+    calls = []
+    with patch("threadbare.operations._execute", side_effect=_timeout_execute(calls)):
+        with pytest.raises(RuntimeError) as err:
+            operations.remote("sleep 5", host_string=HOST, timeout=1, quiet=True)
+    assert "timed out" in str(err.value)
+    assert err.value.result["timed_out"]
+
+
+def test_remote_timeout_unknown_pgid():
+    "a timed out `remote` command can't be killed if it never printed it's process group ID"
+    calls = []
+    execute = _timeout_execute(calls, pgid_line=False)
+    with patch("threadbare.operations._execute", side_effect=execute):
+        result = operations.remote(
+            "sleep 5", host_string=HOST, timeout=1, warn_only=True, quiet=True
+        )
+    assert len(calls) == 1
+    assert result["stdout"] == ["foo"]
+    assert result["timed_out"]
+
+
+def test_remote_no_timeout():
+    "a `remote` command with a timeout that finishes in time has the process group ID removed from it's output"
+    calls = []
+
+    def execute(command, **kwargs):
+        calls.append(command)
+        marker = re.search(r"'(__threadbare_pgid_\w+__)'", command).group(1)
+        lines = ["%s 1234" % marker, "foo"]
+        return {"return_code": lambda: 0, "stdout": lines, "stderr": []}
+
+    with patch("threadbare.operations._execute", side_effect=execute):
+        result = operations.remote(
+            "echo foo", host_string=HOST, timeout=1, use_sudo=True, quiet=True
+        )
+    assert result["stdout"] == ["foo"]
+    assert result["timed_out"] is False
+    assert "kill" not in result
+    assert len(calls) == 1
+
+
+def _pgid_execute(calls, lines, detached=False):
+    """returns a stand-in for `operations._execute` where the first command prints it's process group ID, and it's
+    process ID and output file if `detached`, before the given `lines`. subsequent commands succeed.
+    """
+
+    def execute(command, **kwargs):
+        calls.append(command)
+        if len(calls) > 1:
+            return {"return_code": lambda: 0, "stdout": [], "stderr": []}
+        marker = re.search(r"'(__threadbare_pgid_\w+__)'", command).group(1)
+
+        def stdout():
+            yield "%s 1234" % marker
+            if detached:
+                yield "%s 1240 /tmp/tmp.abc" % marker
+            yield from lines()
+
+        return {"return_code": lambda: None, "stdout": stdout(), "stderr": []}
+
+    return execute
+
+
+def test_remote_idle_timeout():
+    "a `remote` command that produces no output for `idle_timeout` seconds is killed"
+
+    def lines():
+        yield "foo"
+        gevent.sleep(5)
+        yield "bar"
+
+    calls = []
+    with patch(
+        "threadbare.operations._execute", side_effect=_pgid_execute(calls, lines)
+    ):
+        with pytest.raises(RuntimeError) as err:
+            operations.remote("foo", host_string=HOST, idle_timeout=0.1, quiet=True)
+    assert "without output" in str(err.value)
+    assert calls[1] == "kill -s KILL -- -1234"
+    result = err.value.result
+    assert result["timed_out"]
+    assert result["stdout"] == ["foo"]
+
+
+def test_remote_stream_idle_timeout():
+    "a `remote_stream` command that produces no output for `idle_timeout` seconds is killed"
+
+    def lines():
+        gevent.sleep(5)
+        yield "foo"
+
+    calls = []
+    with patch(
+        "threadbare.operations._execute", side_effect=_pgid_execute(calls, lines)
+    ):
+        stream = operations.remote_stream(
+            "foo", host_string=HOST, idle_timeout=0.1, warn_only=True, quiet=True
+        )
+        with pytest.raises(StopIteration) as exc:
+            next(stream)
+    assert exc.value.value["timed_out"]
+    assert len(calls) == 2
+
+
+def test_remote_until():
+    "a `remote` command stops being read and is killed as soon as a line of output matches `until`"
+
+    def lines():
+        yield "starting"
+        yield "listening on port 8000"
+        gevent.sleep(5)
+        yield "request 1"
+
+    calls = []
+    with patch(
+        "threadbare.operations._execute", side_effect=_pgid_execute(calls, lines)
+    ):
+        result = operations.remote(
+            "server", host_string=HOST, until=r"listening on port \d+", quiet=True
+        )
+    assert result["matched"] == "listening on port 8000"
+    assert result["stdout"] == ["starting", "listening on port 8000"]
+    assert result["succeeded"] and not result["timed_out"]
+    assert result["return_code"] is None
+    assert calls[1] == "kill -s KILL -- -1234"
+
+
+def test_remote_until_no_match():
+    "a `remote` command whose output never matches `until` finishes as normal"
+    calls = []
+
+    def execute(command, **kwargs):
+        calls.append(command)
+        marker = re.search(r"'(__threadbare_pgid_\w+__)'", command).group(1)
+        lines = ["%s 1234" % marker, "foo"]
+        return {"return_code": lambda: 0, "stdout": lines, "stderr": []}
+
+    with patch("threadbare.operations._execute", side_effect=execute):
+        result = operations.remote("foo", host_string=HOST, until="bar", quiet=True)
+    assert result["matched"] is None
+    assert result["return_code"] == 0
+    assert len(calls) == 1
+
+
+def test_remote_detach():
+    "a detached `remote` command is left running once `until` matches, only the reading of it's output is stopped"
+
+    def lines():
+        yield "ready"
+        yield "never read"
+
+    calls = []
+    execute = _pgid_execute(calls, lines, detached=True)
+    with patch("threadbare.operations._execute", side_effect=execute):
+        result = operations.remote(
+            "server", host_string=HOST, until="ready", detach=True, quiet=True
+        )
+    assert "setsid nohup" in calls[0]
+    assert result["stdout"] == ["ready"]
+    assert result["detached"] == {"pid": 1240, "output_file": "/tmp/tmp.abc"}
+    # the process group killed is the one following the detached command's output
+    assert calls[1] == "kill -s KILL -- -1234"
+
+
 def test_remote_command_exception():
     """exceptions from the parallel-ssh client are passed through.
     previously they were caught and wrapped in an `operations.NetworkError`."""
@@ -420,6 +1882,192 @@ def test_local_command_split_stderr():
     assert expected == actual
 
 
+def test_local_capture_head_and_tail():
+    "`local` can capture just the first and last lines of output"
+    result = operations.local(
+        ["seq", "1", "100"],
+        capture=True,
+        use_shell=False,
+        capture_head=2,
+        capture_tail=3,
+    )
+    assert result["stdout"] == ["1", "2", "98", "99", "100"]
+    assert result["stdout"].dropped == 95
+
+
+def test_local_capture_spill():
+    "`local` output exceeding `capture_spill_bytes` is written to a temporary file and read back lazily"
+    result = operations.local(
+        ["seq", "1", "1000"], capture=True, use_shell=False, capture_spill_bytes=100
+    )
+    stdout = result["stdout"]
+    assert isinstance(stdout, operations.SpilledLines)
+    assert len(stdout) == 1000
+    assert stdout[0] == "1" and stdout[-1] == "1000"
+    assert stdout[10:12] == ["11", "12"]
+    assert list(stdout) == [str(i) for i in range(1, 1001)]
+    path = stdout.path
+    stdout.close()
+    assert not os.path.exists(path)
+
+
+def test_local_capture_below_spill_threshold():
+    "output below the `capture_spill_bytes` threshold is kept in memory"
+    result = operations.local(
+        ["echo", "foo"], capture=True, use_shell=False, capture_spill_bytes=100
+    )
+    assert result["stdout"] == ["foo"]
+
+
+def test_capture_policy_conflict():
+    "bounded capture and spilled capture can't be used together"
+    with pytest.raises(ValueError):
+        operations.local(
+            ["echo", "foo"],
+            capture=True,
+            use_shell=False,
+            capture_tail=1,
+            capture_spill_bytes=100,
+        )
+
+
+def test_spilled_lines_pickle():
+    "the process that unpickles spilled output becomes responsible for removing it"
+    capture = operations._capture_buffer(capture_spill_bytes=0)
+    capture.append("foo")
+    spilled = capture.finish()
+    copied = pickle.loads(pickle.dumps(spilled))
+    del spilled
+    assert list(copied) == ["foo"]
+    path = copied.path
+    del copied
+    assert not os.path.exists(path)
+
+
+def test_local_stream(capsys):
+    "`local` output can be printed as it arrives, formatted like `remote` output, and captured at the same time"
+    seen = []
+    result = operations.local(
+        ["sh", "-c", "echo foo; >&2 echo bar; echo baz"],
+        use_shell=False,
+        stream=True,
+        combine_stderr=False,
+        display_running=False,
+        capture_tail=1,
+        on_line=lambda pipe, line: seen.append((pipe, line)),
+    )
+    assert sorted(seen) == [("err", "bar"), ("out", "baz"), ("out", "foo")]
+    assert result["stdout"] == ["baz"]
+    assert result["stderr"] == ["bar"]
+    captured = capsys.readouterr()
+    assert captured.out == "[localhost] out: foo\n[localhost] out: baz\n"
+    assert captured.err == "[localhost] err: bar\n"
+
+
+def test_local_stream_quiet(capsys):
+    "`local` output is captured but not printed when streaming quietly"
+    result = operations.local(["echo", "foo"], use_shell=False, stream=True, quiet=True)
+    assert result["stdout"] == ["foo"]
+    assert capsys.readouterr().out == ""
+
+
+def test_local_many():
+    "`local_many` runs commands concurrently and returns their results in order"
+    command_list = [["sh", "-c", "sleep 0.%s; echo %s" % (i, i)] for i in [3, 2, 1]]
+    start = time.time()
+    results = operations.local_many(
+        command_list, use_shell=False, quiet=True, max_concurrency=3
+    )
+    assert time.time() - start < 0.55
+    assert [result["stdout"] for result in results] == [["3"], ["2"], ["1"]]
+
+
+def test_local_many_max_concurrency():
+    "`local_many` runs at most `max_concurrency` commands at once"
+    command_list = [["sleep", "0.2"]] * 4
+    start = time.time()
+    operations.local_many(command_list, use_shell=False, quiet=True, max_concurrency=2)
+    assert time.time() - start >= 0.4
+
+
+def test_local_many_failures():
+    "`local_many` raises the first failure once all commands have finished"
+    command_list = [["sh", "-c", "exit 2"], ["sleep", "0.1"], ["sh", "-c", "exit 3"]]
+    with pytest.raises(RuntimeError) as err:
+        operations.local_many(command_list, use_shell=False, quiet=True)
+    assert err.value.result["return_code"] == 2
+
+    results = operations.local_many(
+        command_list, use_shell=False, quiet=True, warn_only=True
+    )
+    assert [result["return_code"] for result in results] == [2, 0, 3]
+
+
+def test_local_many_fail_fast():
+    "`local_many` kills running commands and starts no more after the first failure when `fail_fast` is `True`"
+    command_list = [["sleep", "5"], ["sh", "-c", "exit 1"], ["sleep", "5"]]
+    start = time.time()
+    results = operations.local_many(
+        command_list,
+        use_shell=False,
+        quiet=True,
+        warn_only=True,
+        fail_fast=True,
+        max_concurrency=2,
+    )
+    assert time.time() - start < 1
+    assert results[0] is None and results[2] is None
+    assert results[1]["return_code"] == 1
+
+
+def test_local_posix_spawn():
+    "`local` commands can be started with `posix_spawn` rather than `fork`"
+    result = operations.local(
+        'echo "standard out"; >&2 echo "standard error"; exit 3',
+        capture=True,
+        combine_stderr=False,
+        login_shell=False,
+        use_posix_spawn=True,
+        warn_only=True,
+    )
+    assert result["command"] == (
+        '/bin/bash -c "echo \\"standard out\\"; >&2 echo \\"standard error\\"; exit 3"'
+    )
+    assert result["stdout"] == ["standard out"]
+    assert result["stderr"] == ["standard error"]
+    assert result["return_code"] == 3
+
+    result = operations.local(
+        ["sh", "-c", ">&2 echo foo"],
+        use_shell=False,
+        capture=True,
+        use_posix_spawn=True,
+    )
+    assert result["stdout"] == ["foo"]
+
+
+def test_exit_code():
+    "wait statuses are decoded into return codes, negative if the process was killed by a signal"
+    for command, expected in [("exit 3", 3), ("kill -TERM $$", -signal.SIGTERM)]:
+        proc = subprocess.Popen(["sh", "-c", command])
+        _, status = os.waitpid(proc.pid, 0)
+        assert operations._exit_code(status) == expected
+    with patch("os.waitstatus_to_exitcode", side_effect=AttributeError, create=True):
+        result = operations.local(
+            ["sh", "-c", "kill -TERM $$"],
+            use_shell=False,
+            use_posix_spawn=True,
+            warn_only=True,
+        )
+    assert result["return_code"] == -signal.SIGTERM
+
+
+def test_local_posix_spawn_missing_command():
+    "`local` commands started with `posix_spawn` that don't exist raise the same error as `subprocess.Popen`"
+    with pytest.raises(FileNotFoundError):
+        operations.local(["not-a-command"], use_shell=False, use_posix_spawn=True)
+
+
 def test_local_command_non_zero_exit():
     "`local` commands raise a generic `RuntimeError` if the command they execute exits with a non-zero result"
     with pytest.raises(RuntimeError) as err:
@@ -491,11 +2139,54 @@ def test_local_command_timeout():
         "command": '/bin/bash -l -c "sleep 5"',
         "stdout": [],
         "stderr": [],
+        "timed_out": True,
     }
     actual = operations.local(command, capture=True, timeout=0.1, warn_only=True)
     assert expected == actual
 
 
+def test_local_command_timeout_process_group():
+    "`local` commands that time out have everything they started killed as well"
+    for use_posix_spawn in [False, True]:
+        start = time.time()
+        # the backgrounded `sleep` holds on to `stdout` and would keep it open after the shell was killed
+        result = operations.local(
+            "sleep 5 & sleep 5",
+            capture=True,
+            login_shell=False,
+            use_posix_spawn=use_posix_spawn,
+            timeout=0.2,
+            warn_only=True,
+        )
+        assert time.time() - start < 2
+        assert result["timed_out"]
+        assert result["return_code"] == -9
+
+
+def test_local_command_no_timeout():
+    "`local` results report whether the command timed out when a timeout is given"
+    result = operations.local(["true"], use_shell=False, timeout=5)
+    assert result["timed_out"] is False
+    assert "timed_out" not in operations.local(["true"], use_shell=False)
+
+
+def test_kill_process_not_permitted():
+    "a process group that can't be killed, like one started with sudo, falls back to killing the process itself"
+    proc = mock.Mock(pid=1234)
+    proc.poll.return_value = None
+    with patch("os.killpg", side_effect=PermissionError) as killpg:
+        operations._kill_process(proc, process_group=True)
+    killpg.assert_called_once_with(1234, signal.SIGKILL)
+    proc.kill.assert_called_once()
+
+    # neither can be killed, the failure is logged rather than lost
+    proc.kill.side_effect = PermissionError
+    with patch("os.killpg", side_effect=PermissionError):
+        with patch("threadbare.operations.LOG") as log:
+            operations._kill_process(proc, process_group=True)
+    assert log.warning.call_count == 2
+
+
 def test_single_command():
     "joins multiple commands into a single command to be run"
     cases = [
@@ -592,6 +2283,52 @@ def test_formatted_output_display_prefix():
                 assert expected_return == result
 
 
+def test_compiled_line_template():
+    "line templates are compiled once and only calculate the fields they use"
+    operations._compile_line_template.cache_clear()
+    render = operations._compile_line_template("[{host}] {pipe}: {line}\n")
+    assert render is operations._compile_line_template("[{host}] {pipe}: {line}\n")
+    with patch("threadbare.operations.datetime") as mock_datetime:
+        assert render("foo", "out", "1.2.3.4") == "[1.2.3.4] out: foo\n"
+        assert not mock_datetime.now.called
+
+    render = operations._compile_line_template("{year:04d} {line!r}")
+    assert render("foo", "out", "1.2.3.4").endswith(" 'foo'")
+
+
+def test_buffered_output():
+    "printed output is written in batches and flushed once there is nothing more to read"
+    strbuffer = mock.MagicMock()
+    writer = operations._BufferedWriter(strbuffer, max_bytes=10)
+    writer.write("foo\n")
+    writer.write("bar\n")
+    assert not strbuffer.write.called
+    writer.write("baz\n")
+    strbuffer.write.assert_called_once_with("foo\nbar\nbaz\n")
+    writer.write("bup\n")
+    writer.flush()
+    strbuffer.write.assert_called_with("bup\n")
+    assert strbuffer.flush.called
+
+
+def test_drain_concurrently_on_idle():
+    "`on_idle` is called once all lines read so far have been consumed"
+    events = []
+
+    def stdout():
+        yield "foo"
+        yield "bar"
+        gevent.sleep(0.01)
+        yield "baz"
+
+    buffers = [("out", stdout()), ("err", [])]
+    for pipe, line, _ in operations._drain_concurrently(
+        buffers, on_idle=lambda: events.append("idle")
+    ):
+        events.append(line)
+    assert events == ["idle", "foo", "bar", "idle", "baz"]
+
+
 def test_formatted_output_display_running():
     "the 'print running' function obeys formatting rules"
     cases = [
@@ -658,6 +2395,27 @@ def test_abort_display_aborts_message_when_quiet():
             mock.assert_not_called()
 
 
+def test_rsync_upload_parent_checked_once(tmp_path):
+    "the parent directory of an rsync upload is checked along with the remote file, not again by `rsync_upload`"
+    local_file = tmp_path / "local"
+    local_file.write_bytes(b"foo")
+    remote_file = tmp_path / "remote" / "file"
+
+    def rsync(command):
+        remote_file.write_bytes(local_file.read_bytes())
+
+    with patch("threadbare.operations._execute", side_effect=_local_execute) as ex:
+        with patch("threadbare.operations.execute_rsync_command", side_effect=rsync):
+            with state.settings(host_string=HOST, use_shell=False, quiet=True):
+                upload = operations._transfer_fn(LocalChannelClient(), "upload")
+                # the parent directory is created, then the upload is checked
+                upload(str(local_file), str(remote_file))
+                assert ex.call_count == 3
+                upload(str(local_file), str(remote_file))
+                assert ex.call_count == 5
+    assert remote_file.read_bytes() == b"foo"
+
+
 def test_rsync_upload_command():
     "rsync invocations are generated correctly"
     expected = "rsync --rsh='ssh -i /example/path/id_rsa -p 23 -o StrictHostKeyChecking=no' /local/foo elife@1.2.3.4:/remote/bar"
@@ -79,14 +79,15 @@ def _shell_escape(string):
 
 
 # https://github.com/mathiasertl/fabric/blob/master/fabric/state.py#L253-L256
-def shell_wrap_command(command):
+def shell_wrap_command(command, login=True):
     """wraps the given command in a shell invocation.
     default shell is /bin/bash (like Fabric)
-    no support for configurable shell at present"""
+    no support for configurable shell at present.
+    a non-`login` shell starts faster but doesn't read the user's profile."""
 
     # '-l' is 'login' shell
     # '-c' is 'run command'
-    shell_prefix = "/bin/bash -l -c"
+    shell_prefix = "/bin/bash -l -c" if login else "/bin/bash -c"
 
     escaped_command = _shell_escape(command)
     escaped_wrapped_command = '"%s"' % escaped_command
@@ -94,6 +95,52 @@ def shell_wrap_command(command):
     return "%s %s" % (shell_prefix, escaped_wrapped_command)
 
 
+def pgid_wrap_command(command, marker):
+    """prefixes the given command with one that prints the `marker` and the ID of the process group it's running in.
+    sshd starts each command as the leader of a new session, so the process group contains the command and anything
+    it starts."""
+    return "printf '%%s %%d\\n' '%s' $$; %s" % (marker, command)
+
+
+def detach_wrap_command(command, marker):
+    """runs the given command in a new session so it carries on running once we stop reading it's output.
+    it's output is written to a temporary file that is followed until the command finishes.
+    the `marker`, the ID of the detached process and the path to the temporary file are printed first.
+    """
+    # started from a subshell so the command isn't left a zombie child of `tail` once it finishes.
+    return (
+        'log=$(mktemp); pid=$(setsid nohup /bin/sh -c "%s" > "$log" 2>&1 < /dev/null & echo $!); '
+        "printf '%%s %%d %%s\\n' '%s' $pid \"$log\"; "
+        'exec tail -n +1 -f --pid=$pid "$log"'
+    ) % (_shell_escape(command), marker)
+
+
+def compress_wrap_command(
+    command, marker, compress_command, threshold, combine_stderr=True
+):
+    """pipes the output of the given command through `compress_command` as it's produced.
+    once the output reaches `threshold` bytes the `marker` is printed and the output is compressed and printed as
+    base64. smaller output is printed as-is once the command finishes. the command's return code is preserved.
+    stderr is compressed as well when `combine_stderr` is `True`.
+    only the first `threshold` bytes are held in a temporary file while the size is unknown.
+    """
+    # the return code is written to fd 3, captured by `$(...)`, while the output is piped to fd 4, the original stdout.
+    # run in a subshell so an `exit` within the command doesn't skip printing it's output.
+    return (
+        "exec 4>&1; rc=$( { { ( %s\n)%s 3>&- 4>&-; echo $? >&3; } | { "
+        'head=$(mktemp) || exit 1; head -c %d > "$head"; '
+        'if [ $(wc -c < "$head") -ge %d ]; then echo \'%s\'; cat "$head" - | %s | base64; else cat "$head"; fi; '
+        'rm -f "$head"; } >&4; } 3>&1 ); exit $rc'
+    ) % (
+        command,
+        " 2>&1" if combine_stderr else "",
+        threshold,
+        threshold,
+        marker,
+        compress_command,
+    )
+
+
 def sudo_wrap_command(command):
     """adds a 'sudo' prefix to command to run as root.
     no support for sudo'ing to configurable users/groups"""
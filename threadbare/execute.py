@@ -1,9 +1,20 @@
 import traceback
 import copy
-from multiprocessing import Process, Queue
+import contextlib
+import collections
+import os
+import shutil
+import tempfile
+from multiprocessing import Process, Queue, Pipe
+import pickle
+import socket
+import struct
 import time
-from .common import first
-from . import state
+import gevent
+import gevent.event
+import gevent.lock
+from .common import first, subdict
+from . import state, operations
 import logging
 
 LOG = logging.getLogger(__name__)
@@ -248,3 +259,267 @@ def execute_with_hosts(func, hosts=None, raise_unhandled_errors=True):
     )
     # results are ordered so we can do this
     return dict(zip(host_list, results))  # {'192.168.0.1': [], '192.169.0.3': []}
+
+
+#
+# connection broker
+#
+
+
+class SSHBroker:
+    """a handle on a running broker process that owns one SSH connection per-host.
+    it's safe to copy and to pass to other processes, it only knows where the broker can be found.
+    `operations.remote` sends it's commands here when `ssh_broker` is present in the `state.ENV`.
+    """
+
+    def __init__(self, address):
+        # path to a unix socket in a directory only the current user can access
+        self.address = address
+
+    def _connect(self):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(self.address)
+        return conn
+
+    def execute(self, **kwargs):
+        """sends a command to the broker to be executed and returns the same shape of result as `operations._execute`.
+        output is streamed back from the broker as it's read."""
+        conn = self._connect()
+        _broker_send(conn, ("execute", kwargs))
+        response = _BrokeredCommand(conn)
+        return {
+            "return_code": response.get_return_code,
+            "command": kwargs["command"],
+            "stdout": response.lines("stdout"),
+            "stderr": response.lines("stderr"),
+        }
+
+    def stop(self):
+        "tells the broker to disconnect all of it's clients and exit."
+        conn = self._connect()
+        try:
+            _broker_send(conn, ("stop", None))
+            _broker_recv(conn)
+        finally:
+            conn.close()
+
+
+class _BrokeredCommand:
+    "reads the messages for a single command from a connection to the broker, separating them by output pipe."
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.pending = {"stdout": collections.deque(), "stderr": collections.deque()}
+        self.finished = set()
+        self.return_code = None
+        # both pipes may be read at the same time but only one reader can receive from the connection
+        self.lock = gevent.lock.Semaphore()
+
+    def _recv(self):
+        pipe, value = _broker_recv(self.conn)
+        if pipe == "error":
+            self.conn.close()
+            raise value
+        if pipe == "return_code":
+            self.conn.close()
+            self.return_code = value
+            self.finished.update(["stdout", "stderr", "return_code"])
+        elif value is None:
+            self.finished.add(pipe)
+        else:
+            self.pending[pipe].append(value)
+
+    def lines(self, pipe):
+        while True:
+            if self.pending[pipe]:
+                yield self.pending[pipe].popleft()
+            elif pipe in self.finished:
+                return
+            else:
+                with self.lock:
+                    if not self.pending[pipe] and pipe not in self.finished:
+                        self._recv()
+
+    def get_return_code(self):
+        while "return_code" not in self.finished:
+            with self.lock:
+                if "return_code" not in self.finished:
+                    self._recv()
+        return self.return_code
+
+
+def _broker_send(conn, message):
+    "sends a single length-prefixed, pickled, `message` over the given socket."
+    data = pickle.dumps(message)
+    conn.sendall(struct.pack("!I", len(data)) + data)
+
+
+def _broker_recv_exactly(conn, size):
+    buf = b""
+    while len(buf) < size:
+        chunk = conn.recv(size - len(buf))
+        if not chunk:
+            raise EOFError("connection to broker closed unexpectedly")
+        buf += chunk
+    return buf
+
+
+def _broker_recv(conn):
+    "receives a single message sent with `_broker_send` from the given socket."
+    (size,) = struct.unpack("!I", _broker_recv_exactly(conn, 4))
+    return pickle.loads(_broker_recv_exactly(conn, size))
+
+
+def _broker_client(pool, client_kwargs, reconnect=False):
+    "returns a connected client from the `pool` for the given `client_kwargs`, creating a new one if necessary."
+    client_key = operations._ssh_client_key(client_kwargs)
+    with pool["locks"][client_key]:
+        client = pool["clients"].get(client_key)
+        if client and (reconnect or not client.alive()):
+            client.disconnect()
+            operations._incr_metric(client_kwargs["host"], "ssh-reconnects")
+            client = None
+        if not client:
+            client = operations.SSHClient(**client_kwargs)
+            pool["clients"][client_key] = client
+        return client
+
+
+def _broker_execute(pool, conn, request):
+    "executes a single command on behalf of a worker, streaming output back to the worker as it's read."
+    client_kwargs = operations._ssh_client_kwargs(
+        **subdict(
+            request,
+            ["user", "host_string", "key_filename", "port", "keepalive_seconds"],
+        )
+    )
+    shell = False  # handled by `remote`
+    sudo = False  # handled by `remote`
+    user = None  # user to sudo to
+    encoding = "utf-8"
+    args = (
+        request["command"],
+        sudo,
+        user,
+        request["use_pty"],
+        shell,
+        encoding,
+        request["timeout"],
+    )
+    client = _broker_client(pool, client_kwargs)
+    try:
+        host_output = client.run_command(*args)
+    except operations.DEAD_SESSION_EXCEPTIONS:
+        client = _broker_client(pool, client_kwargs, reconnect=True)
+        host_output = client.run_command(*args)
+
+    buffers = [("stdout", host_output.stdout), ("stderr", host_output.stderr)]
+    for pipe, line, _ in operations._drain_concurrently(buffers):
+        _broker_send(conn, (pipe, line))
+    _broker_send(conn, ("stdout", None))
+    _broker_send(conn, ("stderr", None))
+    client.wait_finished(host_output)
+    _broker_send(conn, ("return_code", host_output.exit_code))
+
+
+def _broker_serve(pool, conn, stop_event):
+    "handles a single request from a worker."
+    try:
+        action, request = _broker_recv(conn)
+        if action == "stop":
+            stop_event.set()
+            _broker_send(conn, ("stopped", None))
+            return
+        _broker_execute(pool, conn, request)
+    except BaseException as exc:
+        try:
+            _broker_send(conn, ("error", exc))
+        except BaseException:
+            # the worker has gone away or the exception can't be pickled
+            LOG.exception("broker failed to return error to worker")
+    finally:
+        conn.close()
+
+
+def _broker_main(address, ready_conn):
+    """this function is executed in another process. it accepts connections from workers and serves each one in a
+    separate greenlet until it's told to stop."""
+    # the broker shares nothing with the process that started it
+    state.DEPTH = 0
+    state.set_defaults()
+
+    pool = {
+        "clients": {},
+        "locks": collections.defaultdict(gevent.lock.RLock),
+    }
+    stop_event = gevent.event.Event()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(address)
+    listener.listen()
+    ready_conn.send(True)
+    ready_conn.close()
+
+    def accept_loop():
+        while True:
+            conn, _ = listener.accept()
+            gevent.spawn(_broker_serve, pool, conn, stop_event)
+
+    acceptor = gevent.spawn(accept_loop)
+    try:
+        stop_event.wait()
+    finally:
+        acceptor.kill()
+        listener.close()
+        for client in pool["clients"].values():
+            client.disconnect()
+
+
+def start_broker():
+    """starts a new broker process, returning a pair of `(SSHBroker, Process)`.
+    see `ssh_broker` for a context manager that also stops the broker process."""
+    # only the current user may access this directory
+    sockdir = tempfile.mkdtemp(suffix="-threadbare")
+    address = os.path.join(sockdir, "broker.sock")
+    ready_recv, ready_send = Pipe(duplex=False)
+    process = Process(
+        name="threadbare-broker",
+        target=_broker_main,
+        kwargs={"address": address, "ready_conn": ready_send},
+        daemon=True,
+    )
+    process.start()
+    ready_send.close()
+    ready = ready_recv.poll(10) and ready_recv.recv()
+    ready_recv.close()
+    if not ready:
+        process.terminate()
+        shutil.rmtree(sockdir, ignore_errors=True)
+        raise EnvironmentError("broker process failed to start")
+    return SSHBroker(address), process
+
+
+@contextlib.contextmanager
+def ssh_broker():
+    """starts a broker process that owns a single SSH connection per-host and shares it between workers.
+
+    `remote` commands run within this context manager, including those run by `execute` in parallel workers, are
+    sent to the broker rather than each worker opening and authenticating their own connection.
+    uploads and downloads are not brokered.
+    connections are closed and the broker process is stopped when the context manager is left.
+    """
+    broker, process = start_broker()
+    try:
+        with state.settings(ssh_broker=broker):
+            yield broker
+    finally:
+        try:
+            broker.stop()
+        except (OSError, EOFError):
+            # the broker has already gone away, don't hide any exception raised within the context manager
+            LOG.warning(
+                "broker process could not be stopped cleanly: %s" % process.name
+            )
+        process.join(5)
+        if process.is_alive():
+            process.terminate()
+        shutil.rmtree(os.path.dirname(broker.address), ignore_errors=True)
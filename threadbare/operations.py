@@ -1,33 +1,85 @@
-from functools import wraps, partial
+from functools import wraps, partial, lru_cache
 from datetime import datetime
 import tempfile
+import tarfile
 import contextlib
 import subprocess
-from threading import Timer
 import getpass
+import hashlib
 import pssh.exceptions
+import ssh2.exceptions
 import os, sys
+import time
+import math
+import select
+import signal
+import socket
+import uuid
 from pssh.clients.native import SSHClient as PSSHClient
+from pssh.clients.base.single import Stdin
+from pssh.clients.reader import ConcurrentRWBuffer
+from pssh.output import HostOutput, HostOutputBuffers, BufferData
+from ssh2.error_codes import LIBSSH2_ERROR_EAGAIN
 import gevent
+import gevent.event
+import gevent.fileobject
+import gevent.lock
+import gevent.pool
+import gevent.queue
 import io
+import codecs
+import zlib
+import base64
+import re
+import string
+import array
+import collections
+import collections.abc
+import mmap
+import weakref
 import logging
 from . import state
 from .common import (
     PromptedException,
     merge,
+    first,
     subdict,
     rename,
     cwd,
     sudo_wrap_command,
     cwd_wrap_command,
     shell_wrap_command,
+    pgid_wrap_command,
+    detach_wrap_command,
+    compress_wrap_command,
     ensure,
 )
 
+try:
+    import zstandard
+except ImportError:
+    # optional. without it transfers and output are compressed with gzip
+    zstandard = None
+
 
 LOG = logging.getLogger(__name__)
 
 
+class _DiscardingRWBuffer(ConcurrentRWBuffer):
+    """a `ConcurrentRWBuffer` that releases data once it has been read.
+    the pssh buffer keeps a copy of all output for the lifetime of the command, regardless of what is captured.
+    relies on pssh internals, which is why `parallel-ssh` is pinned to 2.12.x in `setup.py`.
+    """
+
+    def read(self):
+        with self._lock:
+            data = super().read()
+            if self._write_pos and self._read_pos == self._write_pos:
+                self._buffer = io.BytesIO()
+                self._read_pos = self._write_pos = 0
+        return data
+
+
 class SSHClient(PSSHClient):
     def __deepcopy__(self, memo):
         # do not copy.deepcopy ourselves or the pssh SSHClient object, just
@@ -35,6 +87,102 @@ class SSHClient(PSSHClient):
         # - https://docs.python.org/3/library/copy.html
         return self
 
+    def disconnect(self):
+        # the pssh SSHClient can't be disconnected twice.
+        # a client may be disconnected early when it's replaced by a new connection.
+        if self.session is None and self.sock is None:
+            return
+        super().disconnect()
+
+    def alive(self):
+        """returns `False` if the connection has obviously been closed, either by us or the remote end.
+        this is cheap and involves no round trip, so a connection silently dropped by a firewall may still appear alive.
+        """
+        if self.session is None or self.sock is None or self.sock.closed:
+            return False
+        try:
+            # a readable socket with nothing to read has reached EOF
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if readable and not self.sock.recv(1, socket.MSG_PEEK):
+                return False
+        except OSError:
+            return False
+        return True
+
+    def _make_host_output(self, channel, encoding, read_timeout):
+        # same as pssh's `BaseSSHClient._make_host_output` but output isn't kept once read.
+        stdout_buffer = _DiscardingRWBuffer()
+        stderr_buffer = _DiscardingRWBuffer()
+        stdout_reader, stderr_reader = self._make_output_readers(
+            channel, stdout_buffer, stderr_buffer
+        )
+        stdout_reader.start()
+        stderr_reader.start()
+        buffers = HostOutputBuffers(
+            stdout=BufferData(rw_buffer=stdout_buffer, reader=stdout_reader),
+            stderr=BufferData(rw_buffer=stderr_buffer, reader=stderr_reader),
+        )
+        return HostOutput(
+            host=self.host,
+            alias=self.alias,
+            channel=channel,
+            stdin=Stdin(channel, self),
+            client=self,
+            encoding=encoding,
+            read_timeout=read_timeout,
+            buffers=buffers,
+        )
+
+
+# exceptions raised when attempting to use a connection that has died
+DEAD_SESSION_EXCEPTIONS = (
+    pssh.exceptions.SessionError,
+    ssh2.exceptions.SocketDisconnectError,
+    ssh2.exceptions.SocketSendError,
+    ssh2.exceptions.SocketRecvError,
+    ConnectionError,
+)
+
+# per-process counters, see `metrics`
+METRICS = {}
+
+# per-process map of host to the compression commands available there, see `_compression_codec`
+COMPRESSION_COMMANDS = {}
+
+
+def _incr_metric(host, name, amount=1):
+    "increments the counter `name` for the given `host` by `amount`."
+    host_metrics = METRICS.setdefault(host, {})
+    host_metrics[name] = host_metrics.get(name, 0) + amount
+
+
+def metrics():
+    """returns a copy of the counters collected by this process, grouped by host.
+    for example: `{'1.2.3.4': {'ssh-reconnects': 1}}`"""
+    return {host: dict(host_metrics) for host, host_metrics in METRICS.items()}
+
+
+def reset_metrics():
+    "discards all counters collected by this process."
+    METRICS.clear()
+
+
+def compression_report():
+    """returns the overall compression ratio and the estimated wall time saved by compression for each host that has
+    compressed something, derived from `metrics`. for example: `{'1.2.3.4': {'ratio': 4.2, 'seconds-saved': 12.5}}`
+    the time saved assumes transfers are bound by the network, so it's negative when compression made things bigger.
+    """
+    report = {}
+    for host, host_metrics in metrics().items():
+        compressed = host_metrics.get("compression-bytes-compressed")
+        if not compressed:
+            continue
+        report[host] = {
+            "ratio": host_metrics["compression-bytes-uncompressed"] / compressed,
+            "seconds-saved": host_metrics["compression-seconds-saved"],
+        }
+    return report
+
 
 class NetworkError(Exception):
     "generic 'died while doing something network-related' catch-all exception class."
@@ -122,8 +270,12 @@ def _ssh_default_settings():
         # uses the first one it finds or the most common if none found.
         "key_filename": pem_key(),
         "port": 22,
+        # seconds between keepalive messages. `None` uses the parallel-ssh default (60), `0` disables them.
+        "keepalive_seconds": None,
         "use_shell": True,
         "use_sudo": False,
+        # run commands in a long-lived shell on the remote host rather than starting a new one per-command.
+        "use_session": False,
         "combine_stderr": True,
         "quiet": False,
         "remote_working_dir": None,
@@ -133,53 +285,216 @@ def _ssh_default_settings():
     }
 
 
-def _ssh_client(**kwargs):
-    """returns an instance of pssh.clients.native.SSHClient
-    if within a state context, looks for a client already in use and returns that if found.
-    if not found, creates a new one and stores it for later use."""
+def _capture_default_settings():
+    "default settings for capturing command output. see `_capture_buffer`."
+    return {
+        # keep only the first `capture_head` lines and/or the last `capture_tail` lines.
+        "capture_head": None,
+        "capture_tail": None,
+        # write output to a temporary file once it exceeds this many bytes.
+        "capture_spill_bytes": None,
+    }
+
+
+def _compression_default_settings():
+    "default settings for compressing transfers and command output. see `_compression_codec`."
+    return {
+        # `True` (zstd if available, otherwise gzip), 'zstd' or 'gzip'.
+        "compression": False,
+        # anything smaller than this many bytes isn't compressed.
+        "compression_threshold": 65536,
+    }
 
+
+def _ssh_client_kwargs(**kwargs):
+    "returns the keyword arguments used to initialise a `SSHClient` given the current `state.ENV` and any overrides."
     # parameters we're interested in and their default values
     base_kwargs = subdict(
-        _ssh_default_settings(), ["user", "host_string", "key_filename", "port"]
+        _ssh_default_settings(),
+        ["user", "host_string", "key_filename", "port", "keepalive_seconds"],
     )
     global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
     final_kwargs["password"] = None  # always private keys
+    if final_kwargs["keepalive_seconds"] is None:
+        del final_kwargs["keepalive_seconds"]
     rename(final_kwargs, [("key_filename", "pkey"), ("host_string", "host")])
+    return final_kwargs
+
+
+def _ssh_client_key(client_kwargs):
+    "returns a hashable key that identifies a `SSHClient` initialised with the given `client_kwargs`."
+    client_key = subdict(
+        client_kwargs, ["user", "host", "pkey", "port", "timeout", "keepalive_seconds"]
+    )
+    return tuple(sorted(client_key.items()))
+
+
+def _store_ssh_client(client_key, client):
+    """stores the given `client` in the current `state.ENV` under `client_key` and ensures
+    it's disconnected when the current context manager is left."""
+    env = state.ENV
+    client_map_key = "ssh_client"
+    client_map = env.get(client_map_key, {})
+
+    # disconnect session when leaving context manager
+    state.add_cleanup(lambda: client.disconnect())
+
+    client_map[client_key] = client
+    env[client_map_key] = client_map
+
+
+def _ssh_client(**kwargs):
+    """returns an instance of pssh.clients.native.SSHClient
+    if within a state context, looks for a client already in use and returns that if found.
+    if not found, creates a new one and stores it for later use."""
+
+    final_kwargs = _ssh_client_kwargs(**kwargs)
 
     # if we're not using global state, return the new client as-is
     env = state.ENV
     if env.read_only:
         return SSHClient(**final_kwargs)
 
-    client_map_key = "ssh_client"
-    client_key = subdict(final_kwargs, ["user", "host", "pkey", "port", "timeout"])
-    client_key = tuple(sorted(client_key.items()))
+    client_key = _ssh_client_key(final_kwargs)
 
     # otherwise, check to see if a previous client is available for this host
-    client_map = env.get(client_map_key, {})
+    client_map = env.get("ssh_client", {})
     if client_key in client_map:
-        return client_map[client_key]
+        client = client_map[client_key]
+        liveness_check = handle({"ssh_liveness_check": True}, kwargs)[2]
+        if not liveness_check["ssh_liveness_check"] or client.alive():
+            return client
+        LOG.warning("ssh connection to %s has died, reconnecting" % client.host)
+        return _ssh_client_reconnect(**kwargs)
 
     # if not, create a new one and store it in the state
 
     # https://parallel-ssh.readthedocs.io/en/latest/native_single.html#pssh.clients.native.single.SSHClient
     client = SSHClient(**final_kwargs)
+    _store_ssh_client(client_key, client)
+    return client
 
-    # disconnect session when leaving context manager
-    state.add_cleanup(lambda: client.disconnect())
-
-    client_map[client_key] = client
-    env[client_map_key] = client_map
 
+def _ssh_client_reconnect(**kwargs):
+    """disconnects any client in the current `state.ENV` matching the given `kwargs` and replaces it with a new one.
+    the number of reconnections per-host are available in `metrics`."""
+    final_kwargs = _ssh_client_kwargs(**kwargs)
+    client_key = _ssh_client_key(final_kwargs)
+    old_client = state.ENV.get("ssh_client", {}).get(client_key)
+    if old_client:
+        old_client.disconnect()
+    client = SSHClient(**final_kwargs)
+    _store_ssh_client(client_key, client)
+    _incr_metric(final_kwargs["host"], "ssh-reconnects")
     return client
 
 
-def _execute(command, user, key_filename, host_string, port, use_pty, timeout):
-    """creates an SSHClient object and executes given `command` with the given parameters."""
-    client = _ssh_client(
-        user=user, host_string=host_string, key_filename=key_filename, port=port
+def preconnect(hosts=None, **kwargs):
+    """opens and authenticates a SSH connection to each host in `hosts` concurrently.
+    connections are stored in the current `state.ENV` and re-used by any operations within the same context manager.
+    must be called within a `state.settings` context manager, otherwise the connections would be immediately discarded.
+
+    hosts that cannot be connected to are reported together after all connection attempts have finished.
+    returns a map of `{host: exception-or-None, ...}`, or raises an error if `warn_only` is `False`. see `abort`.
+    """
+    base_kwargs = {
+        "quiet": False,
+        "warn_only": False,
+        "display_aborts": True,
+        "abort_exception": RuntimeError,
+    }
+    global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
+
+    host_list = hosts or state.ENV.get("hosts") or []
+    ensure(
+        isinstance(host_list, list) and host_list, "'hosts' must be a non-empty list"
+    )
+    ensure(
+        not state.ENV.read_only,
+        "`preconnect` must be called within a `state.settings` context manager",
+        EnvironmentError,
+    )
+
+    def connect(client_kwargs):
+        # exceptions are returned rather than raised so gevent doesn't print them as unhandled
+        try:
+            return SSHClient(**client_kwargs), None
+        except Exception as exc:
+            return None, exc
+
+    client_map = state.ENV.get("ssh_client", {})
+    pending = {}  # {host: (client-key, greenlet), ...}
+    for host in host_list:
+        client_kwargs = _ssh_client_kwargs(**merge(kwargs, {"host_string": host}))
+        client_key = _ssh_client_key(client_kwargs)
+        if client_key in client_map or host in pending:
+            # already warm
+            continue
+        # the SSHClient connects and authenticates as it's initialised.
+        # gevent's hub will switch between greenlets while they wait on the network.
+        pending[host] = (client_key, gevent.spawn(connect, client_kwargs))
+
+    gevent.joinall([greenlet for _, greenlet in pending.values()])
+
+    result = {host: None for host in host_list}
+    for host, (client_key, greenlet) in pending.items():
+        client, exc = greenlet.value
+        if client:
+            _store_ssh_client(client_key, client)
+        else:
+            result[host] = exc
+
+    unreachable = [host for host, exc in result.items() if exc]
+    if not unreachable:
+        return result
+
+    err_msg = "preconnect() failed to connect to %s host(s): %s" % (
+        len(unreachable),
+        ", ".join(
+            "%s (%s: %s)" % (host, type(result[host]).__name__, result[host])
+            for host in unreachable
+        ),
     )
 
+    # if `warn_only` is True this function may still return a result
+    return abort(result, err_msg, **final_kwargs)
+
+
+def _execute(
+    command,
+    user,
+    key_filename,
+    host_string,
+    port,
+    use_pty,
+    timeout,
+    keepalive_seconds=None,
+):
+    """creates an SSHClient object and executes given `command` with the given parameters.
+    if a connection broker is present in the `state.ENV`, the command is executed by the broker instead.
+    """
+    broker = state.ENV.get("ssh_broker")
+    if broker:
+        return broker.execute(
+            command=command,
+            user=user,
+            key_filename=key_filename,
+            host_string=host_string,
+            port=port,
+            use_pty=use_pty,
+            timeout=timeout,
+            keepalive_seconds=keepalive_seconds,
+        )
+
+    client_kwargs = {
+        "user": user,
+        "host_string": host_string,
+        "key_filename": key_filename,
+        "port": port,
+        "keepalive_seconds": keepalive_seconds,
+    }
+    client = _ssh_client(**client_kwargs)
+
     shell = False  # handled ourselves
     sudo = False  # handled ourselves
     user = None  # user to sudo to
@@ -187,9 +502,22 @@ def _execute(command, user, key_filename, host_string, port, use_pty, timeout):
 
     # https://parallel-ssh.readthedocs.io/en/latest/native_single.html#pssh.clients.native.single.SSHClient.run_command
     # https://github.com/ParallelSSH/parallel-ssh/blob/master/pssh/output.py
-    host_output = client.run_command(
+    run_command = lambda client: client.run_command(
         command, sudo, user, use_pty, shell, encoding, timeout
     )
+    try:
+        host_output = run_command(client)
+    except DEAD_SESSION_EXCEPTIONS as exc:
+        # a connection held in the current `state.ENV` may have been dropped since it was last used.
+        # nothing has been executed on the remote host yet so it's safe to try once more on a new connection.
+        reconnect = handle({"ssh_reconnect": True}, {})[2]["ssh_reconnect"]
+        if state.ENV.read_only or not reconnect:
+            raise
+        LOG.warning(
+            "ssh connection to %s failed (%r), reconnecting" % (host_string, exc)
+        )
+        client = _ssh_client_reconnect(**client_kwargs)
+        host_output = run_command(client)
 
     host_string = host_output.host
     stdout = host_output.stdout
@@ -209,55 +537,339 @@ def _execute(command, user, key_filename, host_string, port, use_pty, timeout):
     }
 
 
-def _print_line(output_pipe, line, **kwargs):
-    """writes the given `line` (string) to the given `output_pipe` (file-like object)
-    if `quiet` is True, `line` is *not* written to `output_pipe`.
-    if `discard_output` is True, `line` is *not* returned and output does *not* accumulate in memory.
+class RemoteShellSession:
+    """a long-lived login shell on a remote host that commands are written to, one at a time.
+    the output of each command is followed by a unique sentinel and the command's exit code.
+    see `remote` and the `use_session` setting."""
+
+    def __init__(self, client, use_sudo=False):
+        self.client = client
+        self.sentinel = "__threadbare_%s__" % uuid.uuid4().hex
+        command = "/bin/bash -l"
+        if use_sudo:
+            command = sudo_wrap_command(command)
+        # a pty would echo our input back to us
+        self.host_output = client.run_command(command, use_pty=False)
+        # these generators are consumed across many commands
+        self.stdout = self.host_output.stdout
+        self.stderr = self.host_output.stderr
+        self.lock = gevent.lock.Semaphore()
+        self.alive = True
+
+    def close(self):
+        "exits the remote shell and closes the channel."
+        if not self.alive:
+            return
+        self.alive = False
+        try:
+            self.host_output.stdin.write(b"exit\n")
+            self.client.close_channel(self.host_output.channel)
+        except Exception:
+            # the connection may have already been closed
+            pass
+
+    def _read_until_sentinel(self, lines, deadline):
+        "yields lines from the given `lines` generator until the sentinel is found, then returns whatever followed it."
+        while True:
+            try:
+                if deadline is None:
+                    line = next(lines)
+                else:
+                    remaining = max(deadline - time.time(), 0)
+                    with gevent.Timeout(remaining, pssh.exceptions.Timeout):
+                        line = next(lines)
+            except StopIteration:
+                self.alive = False
+                raise NetworkError("remote shell session ended unexpectedly")
+            except BaseException:
+                # whatever the command was doing, the session can't be trusted to be at a command prompt any more
+                self.close()
+                raise
+            idx = line.find(self.sentinel)
+            if idx == -1:
+                yield line
+                continue
+            if idx > 0:
+                # command output didn't end with a newline
+                yield line[:idx]
+            return line[idx + len(self.sentinel) :].strip()
+
+    def execute(self, command, combine_stderr=True, timeout=None):
+        """writes the given `command` to the remote shell and returns the same shape of result as `_execute`.
+        the command is run in a subshell so changes to it's environment and working directory do not persist.
+        it's written base64 encoded and `eval`ed, so a command that isn't valid shell, like an unbalanced quote, fails
+        by itself rather than leaving the shell waiting for more input or ending the session.
+        """
+        self.lock.acquire()
+        deadline = None if timeout is None else time.time() + timeout
+        stderr_redirect = " 2>&1" if combine_stderr else ""
+        encoded = base64.b64encode(command.encode("utf-8")).decode("ascii")
+        script = "\n".join(
+            [
+                "( eval \"$(printf %%s '%s' | base64 -d)\" ) < /dev/null%s"
+                % (encoded, stderr_redirect),
+                "printf '%%s %%d\\n' '%s' $?" % self.sentinel,
+                "printf '%%s\\n' '%s' >&2" % self.sentinel,
+                "",
+            ]
+        )
+        self.client.eagain_write(self.host_output.channel.write, script.encode("utf-8"))
+
+        status = {"return_code": None}
+
+        def stdout():
+            return_code = yield from self._read_until_sentinel(self.stdout, deadline)
+            status["return_code"] = int(return_code)
+
+        def stderr():
+            yield from self._read_until_sentinel(self.stderr, deadline)
+
+        def get_return_code():
+            try:
+                # ensure both pipes have been read up to the sentinel
+                for _ in stdout_gen:
+                    pass
+                for _ in stderr_gen:
+                    pass
+                return status["return_code"]
+            finally:
+                self.lock.release()
+
+        stdout_gen, stderr_gen = stdout(), stderr()
+        return {
+            "return_code": get_return_code,
+            "command": command,
+            "stdout": stdout_gen,
+            "stderr": stderr_gen,
+        }
+
+
+def _session_execute(
+    command,
+    user,
+    key_filename,
+    host_string,
+    port,
+    use_sudo,
+    combine_stderr,
+    timeout,
+    keepalive_seconds=None,
+):
+    """executes the given `command` within a long-lived shell session on the remote host.
+    the session is created if it doesn't exist and closed when the current context manager is left.
+    """
+    client_kwargs = {
+        "user": user,
+        "host_string": host_string,
+        "key_filename": key_filename,
+        "port": port,
+        "keepalive_seconds": keepalive_seconds,
+    }
+    client = _ssh_client(**client_kwargs)
+    session_key = (_ssh_client_key(_ssh_client_kwargs(**client_kwargs)), use_sudo)
+
+    env = state.ENV
+    session_map = env.get("ssh_session", {})
+    session = session_map.get(session_key)
+    if not session or not session.alive or session.client is not client:
+        # no session, or the session died, or the connection was replaced
+        session = RemoteShellSession(client, use_sudo)
+        session_map[session_key] = session
+        env["ssh_session"] = session_map
+        state.add_cleanup(session.close)
+
+    return session.execute(command, combine_stderr, timeout)
+
+
+# fields in a `line_template` that require the current time
+_TIME_FIELDS = {"year", "month", "day", "hour", "minute", "second", "ms"}
+
+
+@lru_cache(maxsize=32)
+def _compile_line_template(template, display_prefix=True):
+    """returns a function that renders the given `template` for a `line` of output, it's `pipe` and `host`.
+    the template is parsed once and only the fields it references are calculated when rendering.
     """
+    if not display_prefix:
+        try:
+            template = template[template.index("{line}") :]
+        except ValueError:  # "substring not found"
+            msg = "'display_prefix' option ignored: '{line}' not found in 'line_template' setting"
+            LOG.warning(msg)
+
+    fields = set()
+    for _, field_name, _, _ in string.Formatter().parse(template):
+        if field_name:
+            fields.add(re.match(r"\w*", field_name).group())
+
+    fmt = template.format
+    if not fields & _TIME_FIELDS:
+        return lambda line, pipe, host: fmt(line=line, pipe=pipe, host=host)
+
+    def render(line, pipe, host):
+        dt = datetime.now()
+        return fmt(
+            line=line,
+            pipe=pipe,
+            host=host,
+            year=dt.year,
+            month=dt.month,
+            day=dt.day,
+            hour=dt.hour,
+            minute=dt.minute,
+            second=dt.second,
+            ms=dt.microsecond,
+        )
+
+    return render
+
+
+class _BufferedWriter:
+    """collects text written to `output_pipe` and writes it in one go once `max_bytes` are waiting or when flushed.
+    a `max_bytes` of `0` writes and flushes every line."""
+
+    def __init__(self, output_pipe, max_bytes):
+        self.output_pipe = output_pipe
+        self.max_bytes = max_bytes
+        self.pending = []
+        self.size = 0
+
+    def write(self, text):
+        self.pending.append(text)
+        self.size += len(text)
+        if self.size >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.output_pipe.write("".join(self.pending))
+            self.pending = []
+            self.size = 0
+        self.output_pipe.flush()
 
+
+def _line_printer(output_pipe, **kwargs):
+    """returns a function that does the work of `_print_line` for each line given to it.
+    settings are resolved once rather than once per-line.
+    use `writer` to write to something other than `output_pipe` directly, like a `_BufferedWriter`.
+    """
     base_kwargs = {
         "discard_output": False,
         "quiet": False,
+        "host_string": "",
         "line_template": "[{host}] {pipe}: {line}\n",  # "1.2.3.4  err: Foo not found\n"
         "display_prefix": True,  # strips everything in `line_template` before "{line}"
         "custom_pipe": None,
+        "writer": None,
     }
     global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
+    discard_output = final_kwargs["discard_output"]
 
-    if not final_kwargs["quiet"]:
-        # useful values that can be part of the template
-        pipe_type = "err" if output_pipe == sys.stderr else "out"
-        if final_kwargs["custom_pipe"]:
-            pipe_type = final_kwargs["custom_pipe"]  # like "run"
+    if final_kwargs["quiet"]:
+        return lambda line: None if discard_output else line
 
-        dt = datetime.now()
-        template_kwargs = {
-            "line": line,
-            "year": dt.year,
-            "month": dt.month,
-            "day": dt.day,
-            "hour": dt.hour,
-            "minute": dt.minute,
-            "second": dt.second,
-            "ms": dt.microsecond,
-            "host": state.ENV.get("host_string", ""),
-            "pipe": pipe_type,
-        }
+    # useful values that can be part of the template
+    pipe_type = "err" if output_pipe == sys.stderr else "out"
+    if final_kwargs["custom_pipe"]:
+        pipe_type = final_kwargs["custom_pipe"]  # like "run"
+    host = final_kwargs["host_string"] or ""
+
+    render = _compile_line_template(
+        final_kwargs["line_template"], final_kwargs["display_prefix"]
+    )
+    write = (final_kwargs["writer"] or output_pipe).write
+
+    def print_line(line):
+        write(render(line, pipe_type, host))
+        if not discard_output:
+            return line  # free of any formatting
+
+    return print_line
 
-        # render template and write to given pipe
-        template = final_kwargs["line_template"]
 
-        if not final_kwargs["display_prefix"]:
+def _print_line(output_pipe, line, **kwargs):
+    """writes the given `line` (string) to the given `output_pipe` (file-like object)
+    if `quiet` is True, `line` is *not* written to `output_pipe`.
+    if `discard_output` is True, `line` is *not* returned and output does *not* accumulate in memory.
+    """
+    return _line_printer(output_pipe, **kwargs)(line)
+
+
+class IdleTimeout(pssh.exceptions.Timeout):
+    "raised when a command produces no output for longer than it's `idle_timeout`."
+    pass
+
+
+def _drain_concurrently(buffers, on_idle=None, idle_timeout=None):
+    """reads each of the given `buffers`, a list of (`name`, `iterable`) pairs, in it's own greenlet.
+    yields a triple of (`name`, `line`, `timestamp`) for each line in the order they arrive.
+    a slow or idle buffer never holds up the reading of another.
+    `on_idle` is called whenever all lines read so far have been yielded and we're about to wait for more.
+    raises an `IdleTimeout` if no line arrives within `idle_timeout` seconds.
+    """
+    queue = gevent.queue.Queue()
+
+    def reader(name, result_buffer):
+        try:
+            for line in result_buffer:
+                queue.put(("line", name, line, time.time()))
+            queue.put(("done", name, None, None))
+        except Exception as exc:
+            queue.put(("error", name, exc, None))
+
+    greenlets = [gevent.spawn(reader, name, buf) for name, buf in buffers]
+    try:
+        remaining = len(greenlets)
+        while remaining:
+            if on_idle and queue.empty():
+                on_idle()
             try:
-                template = template[template.index("{line}") :]
-            except ValueError:  # "substring not found"
-                msg = "'display_prefix' option ignored: '{line}' not found in 'line_template' setting"
-                LOG.warning(msg)
+                event, name, value, timestamp = queue.get(timeout=idle_timeout)
+            except gevent.queue.Empty:
+                raise IdleTimeout("no output for %s seconds" % idle_timeout)
+            if event == "error":
+                raise value
+            if event == "done":
+                remaining -= 1
+                continue
+            yield name, value, timestamp
+    finally:
+        gevent.killall(greenlets)
+
+
+def _iter_all_output(result, on_line=None, idle_timeout=None, **kwargs):
+    """reads the `stdout` and `stderr` of the given `result` concurrently, printing each line as `_print_line` would.
+    yields a triple of (`pipe`, `line`, `timestamp`) in the order the lines arrive, where `pipe` is 'out' or 'err'.
+    if `on_line` is given it is called with the type of pipe and the line.
+    raises an `IdleTimeout` if there is no output for `idle_timeout` seconds.
+
+    printed lines are buffered while output is arriving faster than it can be printed, up to `output_buffer_bytes`,
+    and flushed as soon as there is nothing more to read."""
+    base_kwargs = {"output_buffer_bytes": 65536}
+    global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
+    writers = {
+        "out": _BufferedWriter(sys.stdout, final_kwargs["output_buffer_bytes"]),
+        "err": _BufferedWriter(sys.stderr, final_kwargs["output_buffer_bytes"]),
+    }
+    printers = {
+        pipe: _line_printer(writer.output_pipe, writer=writer, **kwargs)
+        for pipe, writer in writers.items()
+    }
 
-        output_pipe.write(template.format(**template_kwargs))
+    def flush():
+        for writer in writers.values():
+            writer.flush()
 
-    if not final_kwargs["discard_output"]:
-        return line  # free of any formatting
+    buffers = [("out", result["stdout"]), ("err", result["stderr"])]
+    try:
+        lines = _drain_concurrently(buffers, on_idle=flush, idle_timeout=idle_timeout)
+        for pipe, line, timestamp in lines:
+            printers[pipe](line)
+            if on_line:
+                on_line(pipe, line)
+            yield pipe, line, timestamp
+    finally:
+        flush()
 
 
 def _process_output(output_pipe, result_buffer, **kwargs):
@@ -267,7 +879,8 @@ def _process_output(output_pipe, result_buffer, **kwargs):
     # use `quiet=True` to hide the printing of output to stdout/stderr
     # use `discard_output=True` to discard the results as soon as they are read.
     # `stderr` results may be empty if `combine_stderr` in call to `remote` was `True`
-    new_results = [_print_line(output_pipe, line, **kwargs) for line in result_buffer]
+    print_line = _line_printer(output_pipe, **kwargs)
+    new_results = [print_line(line) for line in result_buffer]
     output_pipe.flush()
     if "discard_output" in kwargs and not kwargs["discard_output"]:
         return new_results
@@ -322,11 +935,188 @@ def abort(result, err_msg, **kwargs):
     raise exc
 
 
+#
+# output capture
+#
+
+
+class TruncatedLines(list):
+    "a list of captured lines where `dropped` lines between the first and last lines captured were discarded."
+    dropped = 0
+
+
+class _BoundedCapture:
+    "keeps the first `head` and the last `tail` items appended to it, counting those discarded."
+
+    def __init__(self, head=None, tail=None):
+        self.head_size = head or 0
+        self.head = []
+        self.tail = collections.deque(maxlen=tail or 0)
+        self.dropped = 0
+
+    def append(self, item):
+        if len(self.head) < self.head_size:
+            self.head.append(item)
+            return
+        if len(self.tail) == self.tail.maxlen:
+            self.dropped += 1
+        self.tail.append(item)
+
+    def finish(self):
+        result = TruncatedLines(self.head)
+        result.extend(self.tail)
+        result.dropped = self.dropped
+        return result
+
+
+def _remove_spill_file(path):
+    "removes a file of spilled output, if it still exists."
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class SpilledLines(collections.abc.Sequence):
+    """a read-only, lazily indexed, view of the newline separated lines in the file at `path`.
+    the file is memory-mapped on first access and removed when this object is closed or garbage collected.
+    when pickled, for example as part of a result returned from `execute.parallel`, the process that
+    unpickles it becomes responsible for removing the file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._mmap = None
+        self._offsets = None
+        self._finalizer = weakref.finalize(self, _remove_spill_file, path)
+
+    def _data(self):
+        if self._mmap is None:
+            with open(self.path, "rb") as fh:
+                self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def _index(self):
+        "offsets of the start of each line, built on first use."
+        if self._offsets is None:
+            data = self._data()
+            offsets = array.array("Q")
+            pos, end = 0, len(data)
+            while pos < end:
+                offsets.append(pos)
+                pos = data.find(b"\n", pos) + 1
+            self._offsets = offsets
+        return self._offsets
+
+    def __len__(self):
+        return len(self._index())
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        start = self._index()[i]
+        data = self._data()
+        return data[start : data.find(b"\n", start)].decode("utf-8")
+
+    def __iter__(self):
+        # a sequential scan doesn't need the index
+        data = self._data()
+        pos, end = 0, len(data)
+        while pos < end:
+            eol = data.find(b"\n", pos)
+            yield data[pos:eol].decode("utf-8")
+            pos = eol + 1
+
+    def __reduce__(self):
+        self._finalizer.detach()
+        return (SpilledLines, (self.path,))
+
+    def close(self):
+        "releases the memory-map and removes the file."
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._finalizer()
+
+
+class _SpillCapture:
+    "keeps lines in memory until they exceed `threshold` bytes and then writes them all to a temporary file."
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.lines = []
+        self.size = 0
+        self.fh = None
+        self.spilled = None
+
+    def _spill(self):
+        fd, path = tempfile.mkstemp(prefix="threadbare-", suffix=".out")
+        self.spilled = SpilledLines(path)
+        self.fh = os.fdopen(fd, "wb")
+        for line in self.lines:
+            self.fh.write(line.encode("utf-8") + b"\n")
+        self.lines = None
+
+    def append(self, line):
+        if self.fh:
+            self.fh.write(line.encode("utf-8") + b"\n")
+            return
+        self.lines.append(line)
+        self.size += len(line.encode("utf-8")) + 1
+        if self.size > self.threshold:
+            self._spill()
+
+    def finish(self):
+        if not self.fh:
+            return self.lines
+        self.fh.close()
+        return self.spilled
+
+
+class _ListCapture(list):
+    "keeps everything."
+
+    def finish(self):
+        return list(self)
+
+
+def _capture_buffer(capture_head=None, capture_tail=None, capture_spill_bytes=None):
+    """returns an object that captures lines of output given to it's `append` method according to the given policy.
+    calling `finish` returns the captured lines:
+    * a `TruncatedLines` list if either `capture_head` or `capture_tail` are set
+    * a `SpilledLines` view if `capture_spill_bytes` is set and output exceeded that many bytes
+    * a plain list otherwise"""
+    bounded = capture_head is not None or capture_tail is not None
+    ensure(
+        not (bounded and capture_spill_bytes is not None),
+        "'capture_spill_bytes' can't be used with 'capture_head' or 'capture_tail'",
+        ValueError,
+    )
+    if bounded:
+        return _BoundedCapture(capture_head, capture_tail)
+    if capture_spill_bytes is not None:
+        return _SpillCapture(capture_spill_bytes)
+    return _ListCapture()
+
+
 # https://github.com/mathiasertl/fabric/blob/master/fabric/state.py#L338
 # https://github.com/mathiasertl/fabric/blob/master/fabric/operations.py#L898-L901
 # https://github.com/mathiasertl/fabric/blob/master/fabric/operations.py#L975
 def remote(command, **kwargs):
-    "preprocesses given `command` and options before sending it to `_execute` to be executed on remote host"
+    """preprocesses given `command` and options before sending it to `_execute` to be executed on remote host.
+    use `on_line` to have a function called with each line of output as it arrives, see `_iter_all_output`.
+    use `interleave_output=True` to have the result include an `output` list of (`timestamp`, `pipe`, `line`)
+    triples with `stdout` and `stderr` lines in the order they arrived.
+    use `capture_head`, `capture_tail` or `capture_spill_bytes` to bound the memory used by captured output.
+
+    use `idle_timeout` to give up on a command that produces no output for that many seconds.
+    use `until`, a regular expression, to stop reading output as soon as a line matches it. the result's `matched` is
+    the matching line. the command is then killed unless `detach=True`, in which case it's left running on the remote
+    host writing it's output to the file given in the result's `detached`.
+
+    with `compression` set output of at least `compression_threshold` bytes is compressed on the remote host as it's
+    produced and decompressed as it arrives, see `_compression_codec`. output then arrives in blocks rather than line
+    by line, so it isn't compressed when it's discarded, given to `on_line` or the command may be stopped early.
+    """
 
     # Fabric function signature for `run`
     # shell=True # done
@@ -342,24 +1132,137 @@ def remote(command, **kwargs):
 
     # parameters we're interested in and their default values
     base_kwargs = _ssh_default_settings()
-    base_kwargs.update({"display_running": True, "discard_output": False})
+    base_kwargs.update(
+        {
+            "display_running": True,
+            "discard_output": False,
+            "on_line": None,
+            "interleave_output": False,
+            "idle_timeout": None,
+            "until": None,
+            "detach": False,
+        }
+    )
+    base_kwargs.update(_capture_default_settings())
+    base_kwargs.update(_compression_default_settings())
+    global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
+
+    # compressed output arrives in blocks as the codec produces them, not line by line
+    codec = None
+    stoppable = any(
+        final_kwargs.get(key) for key in ["idle_timeout", "until", "detach"]
+    )
+    if final_kwargs["compression"] and not (
+        final_kwargs["discard_output"] or final_kwargs["on_line"] or stoppable
+    ):
+        codec = _compression_codec(**kwargs)
+    wrap_fn = None
+    if codec:
+        marker = "__threadbare_compressed_%s__" % uuid.uuid4().hex
+        wrap_fn = partial(
+            compress_wrap_command,
+            marker=marker,
+            compress_command=codec["compress"],
+            threshold=final_kwargs["compression_threshold"],
+            combine_stderr=final_kwargs["combine_stderr"],
+        )
+
+    command, result = _remote_execute(command, final_kwargs, wrap_fn)
+    if codec:
+        result["command"] = command
+        result["stdout"] = _decompressed_lines(
+            result["stdout"], marker, codec, **kwargs
+        )
+    return _remote_result(result, command, final_kwargs)
+
+
+def remote_stream(command, **kwargs):
+    """exactly the same as `remote`, but returns a generator that yields a pair of (`pipe`, `line`) for each
+    line of output as it arrives, where `pipe` is either 'out' or 'err'.
+    output is not accumulated, use it to process very large amounts of output in constant memory.
+
+    lines are yielded in the order they arrive. there are no 'err' lines if `combine_stderr` is `True`.
+    the generator's return value is the final result, without any output:
+
+        result = yield from remote_stream(command, warn_only=True)"""
+    base_kwargs = _ssh_default_settings()
+    base_kwargs.update({"display_running": True, "on_line": None, "idle_timeout": None})
     global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
+    final_kwargs["discard_output"] = True
+
+    command, result = _remote_execute(command, final_kwargs)
+    output_kwargs = subdict(
+        final_kwargs, ["quiet", "discard_output", "on_line", "idle_timeout"]
+    )
+    timed_out = False
+    try:
+        for pipe, line, _ in _iter_all_output(result, **output_kwargs):
+            yield pipe, line
+    except pssh.exceptions.Timeout as exc:
+        if "kill" not in result:
+            raise
+        timed_out = exc
+
+    result.update({"stdout": None, "stderr": None})
+    if timed_out:
+        return _remote_timed_out(result, command, final_kwargs, timed_out)
+    return _remote_return_code(result, command, final_kwargs)
+
+
+def _remote_execute(command, final_kwargs, wrap_fn=None):
+    """wraps the given `command` and starts it on the remote host, either with `_execute` or within a session.
+    returns a pair of (`command`, `result`), where `command` is the final command executed.
+    `wrap_fn` is applied to `command` before anything else, but is left out of the command that is printed and
+    returned so it reads like the command that was given.
+    """
+    wrapped_command = wrap_fn(command) if wrap_fn else command
+
+    def wrap(wrapper_fn, *args):
+        "wraps both the command given and the command executed with `wrapper_fn`"
+        return wrapper_fn(command, *args), wrapper_fn(wrapped_command, *args)
 
     # wrap the command up
     # https://github.com/mathiasertl/fabric/blob/master/fabric/operations.py#L920-L925
     if final_kwargs["remote_working_dir"]:
-        command = cwd_wrap_command(command, final_kwargs["remote_working_dir"])
+        command, wrapped_command = wrap(
+            cwd_wrap_command, final_kwargs["remote_working_dir"]
+        )
+
+    # commands that may be stopped before they finish are never run within a session, see `_remote_killable`.
+    stoppable = any(
+        final_kwargs.get(key) for key in ["timeout", "idle_timeout", "until", "detach"]
+    )
+
+    # a session only lasts as long as the current context manager, outside of one there is no benefit.
+    use_session = final_kwargs["use_session"] and not state.ENV.read_only
+    if use_session and not stoppable:
+        _print_running(command, sys.stdout, **final_kwargs)
+        session_kwargs = subdict(
+            final_kwargs,
+            [
+                "user",
+                "key_filename",
+                "host_string",
+                "port",
+                "keepalive_seconds",
+                "use_sudo",
+                "combine_stderr",
+                "timeout",
+            ],
+        )
+        return command, _session_execute(wrapped_command, **session_kwargs)
+
     if final_kwargs["use_shell"]:
-        command = shell_wrap_command(command)
+        command, wrapped_command = wrap(shell_wrap_command)
     if final_kwargs["use_sudo"]:
-        command = sudo_wrap_command(command)
+        command, wrapped_command = wrap(sudo_wrap_command)
 
     # if use_pty is True, stdout and stderr are combined and stderr will yield nothing.
     # - https://parallel-ssh.readthedocs.io/en/latest/advanced.html#combined-stdout-stderr
     use_pty = final_kwargs["combine_stderr"]
 
     # values `remote` specifically passes to `_execute`
-    execute_kwargs = {"command": command, "use_pty": use_pty}
+    execute_kwargs = {"command": wrapped_command, "use_pty": use_pty}
     execute_kwargs = merge(final_kwargs, execute_kwargs)
     execute_kwargs = subdict(
         execute_kwargs,
@@ -369,6 +1272,7 @@ def remote(command, **kwargs):
             "key_filename",
             "host_string",
             "port",
+            "keepalive_seconds",
             "use_pty",
             "timeout",
         ],
@@ -378,24 +1282,175 @@ def remote(command, **kwargs):
 
     # run command
     _print_running(command, sys.stdout, **final_kwargs)
+    if not (final_kwargs["timeout"] or stoppable):
+        return command, _execute(**execute_kwargs)
+
+    # the timeout only bounds how long we read output for. the command is made killable so it doesn't carry on
+    # running on the remote host after we've given up on it.
+    marker = "__threadbare_pgid_%s__" % uuid.uuid4().hex
+    if final_kwargs.get("detach"):
+        wrapped_command = detach_wrap_command(wrapped_command, marker)
+    execute_kwargs["command"] = pgid_wrap_command(wrapped_command, marker)
     result = _execute(**execute_kwargs)
+    return command, _remote_killable(
+        result,
+        marker,
+        execute_kwargs,
+        final_kwargs["use_sudo"],
+        final_kwargs.get("detach", False),
+    )
+
+
+def _remote_killable(result, marker, execute_kwargs, use_sudo=False, detached=False):
+    """strips the process group ID printed by a command wrapped with `pgid_wrap_command` from the given `result`s
+    output and adds a `kill` function to the result that kills the command's process group on the remote host.
+    the process ID and output file of a command wrapped with `detach_wrap_command` are added to the result as `detached`.
+    output printed before the marker, by a login shell's profile for example, is passed through.
+    """
+    process = {"pgid": None}
+    lines = iter(result["stdout"])
+
+    def stdout():
+        for line in lines:
+            idx = line.find(marker)
+            if idx == -1:
+                yield line
+                continue
+            if idx > 0:
+                # output before the marker didn't end with a newline
+                yield line[:idx]
+            bits = line[idx:].split(" ", 2)
+            if len(bits) == 2:
+                process["pgid"] = int(bits[1])
+            else:
+                result["detached"] = {"pid": int(bits[1]), "output_file": bits[2]}
+            if process["pgid"] is not None and (not detached or "detached" in result):
+                break
+        yield from lines
+
+    def kill():
+        if process["pgid"] is None:
+            LOG.warning("remote process can't be killed, it's process group is unknown")
+            return
+        # a new channel on the same connection
+        command = "kill -s KILL -- -%s" % process["pgid"]
+        if use_sudo:
+            command = sudo_wrap_command(command)
+        kill_kwargs = {"command": command, "use_pty": False, "timeout": None}
+        kill_result = _execute(**merge(execute_kwargs, kill_kwargs))
+        for _ in _drain_concurrently(
+            [("out", kill_result["stdout"]), ("err", kill_result["stderr"])]
+        ):
+            pass
+        kill_result["return_code"]()
+
+    result.update({"stdout": stdout(), "kill": kill})
+    return result
+
+
+def _remote_result(result, command, final_kwargs):
+    """consumes the output of a command started by `remote` and waits for it to finish.
+    returns the final result or raises an exception if the command failed. see `abort`.
+    """
 
     # handle stdout/stderr streams
-    output_kwargs = subdict(final_kwargs, ["quiet", "discard_output"])
-    stdout = _process_output(sys.stdout, result["stdout"], **output_kwargs)
-    stderr = _process_output(sys.stderr, result["stderr"], **output_kwargs)
+    # both are read at the same time so a command writing heavily to one doesn't stall waiting on the other.
+    output_kwargs = subdict(final_kwargs, ["quiet", "discard_output", "on_line"])
+    capture_kwargs = subdict(final_kwargs, _capture_default_settings().keys())
+    interleave_kwargs = subdict(capture_kwargs, ["capture_head", "capture_tail"])
+    output = {
+        "out": _capture_buffer(**capture_kwargs),
+        "err": _capture_buffer(**capture_kwargs),
+        "all": _capture_buffer(**interleave_kwargs),
+    }
+    until = final_kwargs.get("until")
+    if until:
+        until = re.compile(until)
+        result["matched"] = None
+    timed_out = False
+    lines = _iter_all_output(
+        result, idle_timeout=final_kwargs.get("idle_timeout"), **output_kwargs
+    )
+    try:
+        for pipe, line, timestamp in lines:
+            if not final_kwargs["discard_output"]:
+                output[pipe].append(line)
+                if final_kwargs.get("interleave_output"):
+                    output["all"].append((timestamp, pipe, line))
+            if until and until.search(line):
+                result["matched"] = line
+                break
+    except pssh.exceptions.Timeout as exc:
+        if "kill" not in result:
+            raise
+        timed_out = exc
+    finally:
+        lines.close()
+
+    if final_kwargs["discard_output"]:
+        output = {"out": None, "err": None, "all": None}
+    else:
+        output = {key: val.finish() for key, val in output.items()}
+    result.update({"stdout": output["out"], "stderr": output["err"]})
+    if final_kwargs.get("interleave_output"):
+        result["output"] = output["all"]
+    if timed_out:
+        return _remote_timed_out(result, command, final_kwargs, timed_out)
+    if result.get("matched") is not None:
+        return _remote_matched(result)
+    return _remote_return_code(result, command, final_kwargs)
+
+
+def _remote_matched(result):
+    """stops a command started by `remote` once a line of it's output has matched `until`.
+    a detached command keeps running, only our reading of it's output is stopped.
+    returns the final result, without a return code."""
+    result.pop("kill")()
+    result.update(
+        {"return_code": None, "failed": False, "succeeded": True, "timed_out": False}
+    )
+    return result
+
+
+def _remote_timed_out(result, command, final_kwargs, exc=None):
+    """kills a command started by `remote` that didn't finish within it's `timeout` or produced no output within it's
+    `idle_timeout`. returns the final result, without a return code, or raises an exception. see `abort`.
+    """
+    result.pop("kill")()
+    result.update(
+        {"return_code": None, "failed": True, "succeeded": False, "timed_out": True}
+    )
+    err_msg = "remote() timed out after %s seconds while executing %r" % (
+        final_kwargs["timeout"],
+        command,
+    )
+    if isinstance(exc, IdleTimeout):
+        err_msg = (
+            "remote() timed out after %s seconds without output while executing %r"
+            % (
+                final_kwargs["idle_timeout"],
+                command,
+            )
+        )
+    return abort(result, err_msg, **final_kwargs)
+
+
+def _remote_return_code(result, command, final_kwargs):
+    """waits for the command started by `remote` to finish once its output has been consumed.
+    returns the final result or raises an exception if the command failed. see `abort`.
+    """
 
     # command must have finished before we have access to return code
     return_code = result["return_code"]()
     result.update(
         {
-            "stdout": stdout,
-            "stderr": stderr,
             "return_code": return_code,
             "failed": return_code > 0,
             "succeeded": return_code == 0,
         }
     )
+    if result.pop("kill", None):
+        result["timed_out"] = False
 
     if result["succeeded"]:
         return result
@@ -418,6 +1473,321 @@ def remote_sudo(command, **kwargs):
     return remote(command, **kwargs)
 
 
+def remote_many(command_list, **kwargs):
+    """runs each command in `command_list` concurrently on a single host, each on a separate channel of the same SSH
+    connection. at most `max_channels` commands are run at once. OpenSSH allows 10 channels per-connection by default,
+    see `MaxSessions` in `man sshd_config`.
+
+    returns a list of `remote` results in the same order as `command_list`.
+    if any command fails (and `warn_only` is `False`) the first failure is raised after all commands have finished.
+    """
+    base_kwargs = {"max_channels": 10}
+    global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
+    ensure(
+        isinstance(command_list, list),
+        "given value for `command_list` must be a list, not %r" % type(command_list),
+        ValueError,
+    )
+    ensure(final_kwargs["max_channels"] > 0, "`max_channels` must be at least 1")
+
+    def remote_fn(command):
+        # exceptions are returned rather than raised so gevent doesn't print them as unhandled
+        try:
+            return remote(command, **kwargs), None
+        except BaseException as exc:
+            return None, exc
+
+    # a new scope ensures a connection is stored and shared between commands, even outside of a context manager
+    with state.settings():
+        if not state.ENV.get("ssh_broker"):
+            # connect once, before any command needs it
+            _ssh_client(**kwargs)
+        pool = gevent.pool.Pool(final_kwargs["max_channels"])
+        greenlet_list = [pool.spawn(remote_fn, command) for command in command_list]
+        gevent.joinall(greenlet_list)
+
+    results = []
+    for greenlet in greenlet_list:
+        result, exc = greenlet.value
+        if exc:
+            raise exc
+        results.append(result)
+    return results
+
+
+def _batch_script(command_list, sentinel, stop_on_failure=True, combine_stderr=True):
+    """returns a single shell script that runs each command in `command_list` in turn.
+    the output of each command is delimited on stdout and stderr by lines beginning with `sentinel`.
+    the 'end' line on stdout includes the command's return code and it's start and end times in nanoseconds.
+    """
+    stderr_redirect = " 2>&1" if combine_stderr else ""
+    script = []
+    for idx, command in enumerate(command_list):
+        script.extend(
+            [
+                "printf '%%s begin %%d\\n' '%s' %d" % (sentinel, idx),
+                "printf '%%s begin %%d\\n' '%s' %d >&2" % (sentinel, idx),
+                "__tb_start=$(date +%s%N)",
+                # the newline before the closing parenthesis guards against trailing comments
+                "( %s\n) < /dev/null%s" % (command, stderr_redirect),
+                "__tb_rc=$?",
+                "printf '%%s end %%d %%d %%s %%s\\n' '%s' %d $__tb_rc $__tb_start $(date +%%s%%N)"
+                % (sentinel, idx),
+                "printf '%%s end %%d\\n' '%s' %d >&2" % (sentinel, idx),
+            ]
+        )
+        if stop_on_failure:
+            script.append("[ $__tb_rc -eq 0 ] || exit $__tb_rc")
+    return "\n".join(script)
+
+
+def _parse_batch_output(command_list, sentinel, stdout, stderr, return_code=0):
+    """parses the output of a script generated by `_batch_script` into a list of results, one per-command run.
+    a command that started but never finished, because the script itself was killed or had a syntax error, has
+    failed with the script's `return_code`."""
+    results = [
+        {
+            "command": command,
+            "stdout": [],
+            "stderr": [],
+            "return_code": None,
+            "started": False,
+            "finished": False,
+        }
+        for command in command_list
+    ]
+
+    for pipe, lines in [("stdout", stdout), ("stderr", stderr)]:
+        current = None
+        for line in lines:
+            idx = line.find(sentinel)
+            if idx == -1:
+                if current is not None:
+                    results[current][pipe].append(line)
+                # anything else is noise from the shell itself, like a login profile
+                continue
+            if idx > 0 and current is not None:
+                # command output didn't end with a newline
+                results[current][pipe].append(line[:idx])
+            marker = line[idx + len(sentinel) :].split()
+            if marker[0] == "begin":
+                current = int(marker[1])
+                results[current]["started"] = True
+                continue
+            current = None
+            if pipe == "stdout":
+                result = results[int(marker[1])]
+                result["finished"] = True
+                result["return_code"] = int(marker[2])
+                try:
+                    result["duration"] = (int(marker[4]) - int(marker[3])) / 1e9
+                except (ValueError, IndexError):
+                    # `date` doesn't support '%N', BSD for example
+                    result["duration"] = None
+
+    # commands that weren't run because an earlier command failed are dropped
+    results = [result for result in results if result.pop("started")]
+    for result in results:
+        if not result.pop("finished"):
+            result.update({"return_code": return_code or None, "duration": None})
+        result["failed"] = result["return_code"] != 0
+        result["succeeded"] = result["return_code"] == 0
+    return results
+
+
+def remote_batch(command_list, **kwargs):
+    """runs each command in `command_list` on the remote host, one after the other, in a single execution.
+    returns a list of results, one per-command run, with the command's 'stdout', 'stderr', 'return_code' and 'duration'.
+
+    when `stop_on_failure` is `True` (default) no further commands are run after a command fails, like
+    `single_command`. when `False` every command is run regardless.
+    if any command fails, or the script running them fails, an error is raised unless `warn_only` is `True`.
+    see `abort`.
+    """
+    base_kwargs = {
+        "stop_on_failure": True,
+        "combine_stderr": True,
+        "quiet": False,
+        "display_running": True,
+        "discard_output": False,
+        "warn_only": False,
+        "abort_exception": RuntimeError,
+    }
+    global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
+    ensure(
+        isinstance(command_list, list) and command_list,
+        "given value for `command_list` must be a non-empty list",
+        ValueError,
+    )
+
+    sentinel = "__threadbare_%s__" % uuid.uuid4().hex
+    script = _batch_script(
+        command_list,
+        sentinel,
+        final_kwargs["stop_on_failure"],
+        final_kwargs["combine_stderr"],
+    )
+    remote_kwargs = merge(
+        kwargs,
+        {
+            # output is delimited by the script itself
+            "combine_stderr": False,
+            "quiet": True,
+            "display_running": False,
+            "discard_output": False,
+            "warn_only": True,
+        },
+    )
+    script_result = remote(script, **remote_kwargs)
+    results = _parse_batch_output(
+        command_list,
+        sentinel,
+        script_result["stdout"],
+        script_result["stderr"],
+        script_result["return_code"],
+    )
+
+    output_kwargs = subdict(final_kwargs, ["quiet", "discard_output"])
+    for result in results:
+        _print_running(result["command"], sys.stdout, **final_kwargs)
+        result["stdout"] = _process_output(
+            sys.stdout, result["stdout"], **output_kwargs
+        )
+        result["stderr"] = _process_output(
+            sys.stderr, result["stderr"], **output_kwargs
+        )
+
+    failures = [result for result in results if result["failed"]]
+    if failures:
+        err_msg = (
+            "remote_batch() encountered an error (return code %s) while executing %r"
+            % (
+                failures[0]["return_code"],
+                failures[0]["command"],
+            )
+        )
+    elif script_result["return_code"] != 0:
+        # the script died between commands, with a syntax error for example
+        err_msg = (
+            "remote_batch() encountered an error (return code %s) while executing %s commands"
+            % (script_result["return_code"], len(command_list))
+        )
+    else:
+        return results
+
+    # if `warn_only` is True this function may still return a result
+    return abort(results, err_msg, **final_kwargs)
+
+
+def _wait_until_script(
+    condition_command, sentinel, max_wait, interval, backoff=1, max_interval=None
+):
+    """returns a single shell script that runs `condition_command` every `interval` seconds until it succeeds or
+    `max_wait` seconds have passed, multiplying the interval by `backoff` after each attempt up to `max_interval`.
+    the output of the final attempt is printed followed by a line beginning with `sentinel` with the final state,
+    'ok' or 'timeout', the number of attempts and the condition's last return code."""
+    script = [
+        "__tb_interval=%s" % interval,
+        "__tb_attempts=0",
+        "__tb_deadline=$(( $(date +%%s) + %d ))" % math.ceil(max_wait),
+        "while :; do",
+        "__tb_attempts=$((__tb_attempts + 1))",
+        # the newline before the closing parenthesis guards against trailing comments
+        "__tb_output=$( ( %s\n) < /dev/null 2>&1 )" % condition_command,
+        "__tb_rc=$?",
+        "if [ $__tb_rc -eq 0 ]; then __tb_state=ok; break; fi",
+        "__tb_remaining=$(( __tb_deadline - $(date +%s) ))",
+        "if [ $__tb_remaining -le 0 ]; then __tb_state=timeout; break; fi",
+        'sleep $(awk "BEGIN { i = $__tb_interval; r = $__tb_remaining; print (i < r) ? i : r }")',
+        '__tb_interval=$(awk "BEGIN { i = $__tb_interval * %s; m = %s; print (m > 0 && i > m) ? m : i }")'
+        % (backoff, max_interval or 0),
+        "done",
+        '[ -z "$__tb_output" ] || printf \'%s\\n\' "$__tb_output"',
+        "printf '%%s %%s %%d %%d\\n' '%s' $__tb_state $__tb_attempts $__tb_rc"
+        % sentinel,
+    ]
+    return "\n".join(script)
+
+
+def wait_until(
+    condition_command, max_wait=60, interval=1, backoff=1, max_interval=None, **kwargs
+):
+    """runs `condition_command` on the remote host every `interval` seconds until it succeeds or `max_wait` seconds
+    have passed. the polling happens on the remote host in a single execution, only the final state is returned.
+    with a `backoff` greater than 1 the interval is multiplied by it after each attempt, up to `max_interval`.
+
+    returns the result of the final attempt, with it's output, 'return_code' and the number of 'attempts'.
+    if the condition never succeeded 'timed_out' is `True` and an error is raised unless `warn_only` is `True`.
+    the condition command itself is not interrupted, use the `timeout` command to bound a condition that may hang.
+    a `timeout` setting bounds reading the output of the whole execution, like `remote`, so it should be longer than
+    `max_wait`.
+    """
+    base_kwargs = {
+        "quiet": False,
+        "display_running": True,
+        "discard_output": False,
+        "warn_only": False,
+        "abort_exception": RuntimeError,
+    }
+    global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
+    ensure(max_wait > 0, "`max_wait` must be greater than zero", ValueError)
+    ensure(interval > 0, "`interval` must be greater than zero", ValueError)
+    ensure(backoff >= 1, "`backoff` must be 1 or greater", ValueError)
+
+    sentinel = "__threadbare_%s__" % uuid.uuid4().hex
+    script = _wait_until_script(
+        condition_command, sentinel, max_wait, interval, backoff, max_interval
+    )
+    remote_kwargs = merge(
+        kwargs,
+        {
+            # the final state is parsed from the output
+            "combine_stderr": False,
+            "quiet": True,
+            "display_running": False,
+            "discard_output": False,
+            "warn_only": True,
+        },
+    )
+    _print_running(condition_command, sys.stdout, **final_kwargs)
+    result = remote(script, **remote_kwargs)
+
+    state_line = first([line for line in result["stdout"] if sentinel in line])
+    if state_line is None:
+        # the script itself failed to run
+        err_msg = "wait_until() failed (return code %s) while waiting for %r" % (
+            result["return_code"],
+            condition_command,
+        )
+        return abort(result, err_msg, **final_kwargs)
+
+    _, final_state, attempts, return_code = state_line.split()
+    output_kwargs = subdict(final_kwargs, ["quiet", "discard_output"])
+    stdout = [line for line in result["stdout"] if sentinel not in line]
+    result.update(
+        {
+            "command": condition_command,
+            "stdout": _process_output(sys.stdout, stdout, **output_kwargs),
+            "return_code": int(return_code),
+            "attempts": int(attempts),
+            "succeeded": final_state == "ok",
+            "failed": final_state != "ok",
+            "timed_out": final_state != "ok",
+        }
+    )
+    if result["succeeded"]:
+        return result
+
+    err_msg = "wait_until() timed out after %s seconds (%s attempts) waiting for %r" % (
+        max_wait,
+        attempts,
+        condition_command,
+    )
+
+    # if `warn_only` is True this function may still return a result
+    return abort(result, err_msg, **final_kwargs)
+
+
 # https://github.com/mathiasertl/fabric/blob/master/fabric/contrib/files.py#L15
 def remote_file_exists(path, **kwargs):
     "returns True if given path exists on remote system"
@@ -448,31 +1818,331 @@ def remote_file_exists(path, **kwargs):
     }
     global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
 
+    cache = _stat_cache(**kwargs)
+    cache_key = (path, final_kwargs["use_sudo"])
+    if cache is not None and cache_key in cache:
+        return cache[cache_key]
+
     # do not raise an exception if remote file doesn't exist
     final_kwargs["warn_only"] = True
 
     remote_fn = remote_sudo if final_kwargs["use_sudo"] else remote
     command = "test -e %s" % path
-    return remote_fn(command, **final_kwargs)["return_code"] == 0
+    exists = remote_fn(command, **final_kwargs)["return_code"] == 0
+    if cache is not None:
+        cache[cache_key] = exists
+    return exists
+
+
+def remote_files_exist(path_list, **kwargs):
+    """returns a map of each path in `path_list` to `True` if it exists on the remote system.
+    all paths are checked with a single command."""
+    base_kwargs = {
+        "use_sudo": False,
+    }
+    global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
+    ensure(
+        isinstance(path_list, list),
+        "given value for `path_list` must be a list",
+        ValueError,
+    )
+
+    cache = _stat_cache(**kwargs)
+    if cache is None:
+        cache = {}
+    use_sudo = final_kwargs["use_sudo"]
+    results = {
+        path: cache[(path, use_sudo)] for path in path_list if (path, use_sudo) in cache
+    }
+    unknown_path_list = [
+        path for path in dict.fromkeys(path_list) if path not in results
+    ]
+    if not unknown_path_list:
+        return results
+
+    # one line of output per-path, '1' if it exists, '0' if it doesn't
+    command = (
+        'for path in %s; do if [ -e "$path" ]; then echo 1; else echo 0; fi; done'
+        % " ".join('"%s"' % path for path in unknown_path_list)
+    )
+    final_kwargs["warn_only"] = True
+    remote_fn = remote_sudo if use_sudo else remote
+    # anything before the last line per-path is noise from the shell itself, like a login profile
+    stdout = remote_fn(command, **final_kwargs)["stdout"][-len(unknown_path_list) :]
+    ensure(
+        len(stdout) == len(unknown_path_list),
+        "unexpected output checking remote paths: %r" % (stdout,),
+        NetworkError,
+    )
+    for path, line in zip(unknown_path_list, stdout):
+        results[path] = line == "1"
+        cache[(path, use_sudo)] = results[path]
+    return results
+
+
+def remote_checksums(path_list, **kwargs):
+    """returns a map of each path in `path_list` to the sha256 checksum of it's contents on the remote system, or
+    `None` if it isn't a file or can't be read. all paths are checksummed with a single command.
+    results are kept in the stat cache when `stat_cache` is `True`, see `_stat_cache`.
+    """
+    base_kwargs = {
+        "use_sudo": False,
+    }
+    global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
+    ensure(
+        isinstance(path_list, list),
+        "given value for `path_list` must be a list",
+        ValueError,
+    )
+
+    cache = _stat_cache(**kwargs)
+    if cache is None:
+        cache = {}
+    use_sudo = final_kwargs["use_sudo"]
+    results = {
+        path: cache[(path, use_sudo, "sha256")]
+        for path in path_list
+        if (path, use_sudo, "sha256") in cache
+    }
+    unknown_path_list = [
+        path for path in dict.fromkeys(path_list) if path not in results
+    ]
+    if not unknown_path_list:
+        return results
+
+    # one line of output per-path, the checksum or '-'
+    command = (
+        'for path in %s; do if [ -f "$path" ] && sum=$(sha256sum < "$path"); then echo "${sum%%%% *}"; else echo -; fi; done'
+        % " ".join('"%s"' % path for path in unknown_path_list)
+    )
+    final_kwargs["warn_only"] = True
+    remote_fn = remote_sudo if use_sudo else remote
+    # anything before the last line per-path is noise from the shell itself, like a login profile
+    stdout = remote_fn(command, **final_kwargs)["stdout"][-len(unknown_path_list) :]
+    ensure(
+        len(stdout) == len(unknown_path_list),
+        "unexpected output checksumming remote paths: %r" % (stdout,),
+        NetworkError,
+    )
+    for path, line in zip(unknown_path_list, stdout):
+        results[path] = None if line == "-" else line
+        cache[(path, use_sudo, "sha256")] = results[path]
+    return results
+
+
+class _StatCache(dict):
+    """a map of host to known remote paths that is shared with nested context managers rather than copied, so paths
+    written to within a nested context manager (like the one `upload` uses) are forgotten in the enclosing one.
+    """
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def _stat_cache(**kwargs):
+    """returns the cache of known remote paths for the host in `kwargs` when the `stat_cache` setting is `True`.
+    the cache maps a pair of (`path`, `use_sudo`) to whether that path exists and a triple of
+    (`path`, `use_sudo`, 'sha256') to it's checksum, see `remote_checksums`. it lasts as long as the context
+    manager it was created in, like `use_session`. returns `None` if the cache is disabled or outside of a context
+    manager."""
+    base_kwargs = {"stat_cache": False}
+    global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
+    if not final_kwargs["stat_cache"] or state.ENV.read_only:
+        return None
+    host_key = _ssh_client_key(_ssh_client_kwargs(**kwargs))
+    env = state.ENV
+    cache_map = env.get("ssh_stat_cache", _StatCache())
+    cache = cache_map.setdefault(host_key, {})
+    env["ssh_stat_cache"] = cache_map
+    return cache
+
+
+def _stat_cache_forget(path_list, recursive=False, **kwargs):
+    """removes the given paths from the stat cache after they've been written to. see `_stat_cache`.
+    their parent directories are removed too, as writing to a path may have created them.
+    with `recursive=True` every path beneath them is removed as well, like the files of an uploaded directory.
+    """
+    cache = _stat_cache(**kwargs)
+    if cache is None:
+        return
+    path_set = set(path_list)
+    for path in path_list:
+        parent = os.path.dirname(path.rstrip("/"))
+        while parent and parent not in path_set:
+            path_set.add(parent)
+            parent = os.path.dirname(parent)
+    prefixes = tuple(path.rstrip("/") + "/" for path in path_list) if recursive else ()
+    for key in list(cache):
+        if key[0] in path_set or key[0].startswith(prefixes):
+            del cache[key]
+
+
+def _exit_code(status):
+    """returns the return code for the given wait `status`, negative if the process was killed by a signal, like
+    `subprocess.Popen`. `os.waitstatus_to_exitcode` isn't available before Python 3.9.
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
 
 
 # https://github.com/mathiasertl/fabric/blob/master/fabric/operations.py#L1157
+class _SpawnedProcess:
+    """a process started with `os.posix_spawnp`, supporting the subset of `subprocess.Popen` used by `local`.
+
+    gevent's `subprocess.Popen` forks the current process and then execs the command, the cost of which grows with
+    the memory used by the parent. `posix_spawn` is implemented with `vfork` by glibc and avoids copying the parent.
+    the process is waited on cooperatively using gevent's child watcher.
+
+    `stdout` and `stderr` may be `subprocess.PIPE`, `subprocess.DEVNULL`, `None` (inherited) and, for `stderr`,
+    `subprocess.STDOUT`. `stdin` is always inherited. `new_session` is the same as `Popen`s `start_new_session`.
+    """
+
+    def __init__(self, args, stdout=None, stderr=None, new_session=False):
+        self.args = args
+        self.returncode = None
+        self.stdout = self.stderr = None
+        self._exited = gevent.event.Event()
+
+        file_actions = []
+        child_fds = []
+        for fd, stream in [(1, stdout), (2, stderr)]:
+            if stream == subprocess.PIPE:
+                read_fd, write_fd = os.pipe()
+                child_fds.append(write_fd)
+                file_actions.append((os.POSIX_SPAWN_DUP2, write_fd, fd))
+                file_actions.append((os.POSIX_SPAWN_CLOSE, read_fd))
+                reader = gevent.fileobject.FileObjectPosix(read_fd, "rb")
+                if fd == 1:
+                    self.stdout = reader
+                else:
+                    self.stderr = reader
+            elif stream == subprocess.DEVNULL:
+                file_actions.append(
+                    (os.POSIX_SPAWN_OPEN, fd, os.devnull, os.O_WRONLY, 0)
+                )
+            elif stream == subprocess.STDOUT:
+                file_actions.append((os.POSIX_SPAWN_DUP2, 1, 2))
+
+        # the child's exit status is collected by gevent, the watcher must exist before the hub next runs.
+        loop = gevent.get_hub().loop
+        loop.install_sigchld()
+        try:
+            self.pid = os.posix_spawnp(
+                args[0],
+                args,
+                os.environ,
+                file_actions=file_actions,
+                setsid=new_session,
+            )
+        finally:
+            for fd in child_fds:
+                os.close(fd)
+        self._watcher = loop.child(self.pid, False)
+        self._watcher.start(self._on_exit)
+
+    def _on_exit(self):
+        self._watcher.stop()
+        self.returncode = _exit_code(self._watcher.rstatus)
+        self._exited.set()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        self._exited.wait(timeout)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            os.kill(self.pid, sig)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+def _kill_process(proc, process_group=False):
+    """kills the given local `proc`. if `process_group` is `True` the process was started in it's own session and
+    the whole process group is killed, including anything the process started."""
+    try:
+        if process_group:
+            os.killpg(proc.pid, signal.SIGKILL)
+            return
+    except ProcessLookupError:
+        return  # already finished
+    except PermissionError:
+        # a command run with sudo leaves the process group owned by root, the process itself may still be killable
+        LOG.warning(
+            "not permitted to kill process group %s, killing process instead" % proc.pid
+        )
+    try:
+        if proc.poll() is None:
+            proc.kill()
+    except ProcessLookupError:
+        pass  # already finished
+    except PermissionError:
+        LOG.warning(
+            "not permitted to kill process %s, it may still be running" % proc.pid
+        )
+
+
+def _local_lines(pipe):
+    "yields each decoded line read from the given `pipe` as it's read. yields nothing if there is no pipe."
+    if pipe is None:
+        return
+    with pipe:
+        for raw_line in pipe:
+            yield from raw_line.decode("utf-8").splitlines()
+
+
+def _local_capture(proc, stream=False, on_line=None, **kwargs):
+    """reads the `stdout` and `stderr` pipes of the given `proc` concurrently until they're closed and waits for it to finish.
+    if `stream` is `True` each line is also printed as it's read, like `remote` output.
+    returns a pair of captured (`stdout`, `stderr`) lines. see `_capture_buffer`."""
+    capture_kwargs = subdict(kwargs, _capture_default_settings().keys())
+    output = {
+        "out": _capture_buffer(**capture_kwargs),
+        "err": _capture_buffer(**capture_kwargs),
+    }
+    result = {"stdout": _local_lines(proc.stdout), "stderr": _local_lines(proc.stderr)}
+    output_kwargs = {
+        "quiet": not stream,
+        "host_string": "localhost",
+        "on_line": on_line,
+    }
+    for pipe, line, _ in _iter_all_output(result, **output_kwargs):
+        output[pipe].append(line)
+    proc.wait()
+    return output["out"].finish(), output["err"].finish()
+
+
 def local(command, **kwargs):
-    "preprocesses given `command` and options before executing it locally using Python's `subprocess.Popen`"
+    """preprocesses given `command` and options before executing it locally using Python's `subprocess.Popen`.
+    use `stream=True` to have output printed as it arrives, formatted with `line_template`, and captured at the same time.
+    use `on_line` to have a function called with each line of captured output as it arrives.
+    use `capture_head`, `capture_tail` or `capture_spill_bytes` to bound the memory used by captured output.
+    """
     base_kwargs = {
         "use_sudo": False,
         "use_shell": True,
         "combine_stderr": True,
         "capture": False,
+        "stream": False,
+        "on_line": None,
+        # a login shell reads the user's profile before running the command.
+        "login_shell": True,
+        # start commands with `os.posix_spawn` rather than `fork`. see `_SpawnedProcess`.
+        "use_posix_spawn": False,
         "timeout": None,
         "quiet": False,
         "display_running": True,
         "warn_only": False,  # https://github.com/mathiasertl/fabric/blob/master/fabric/state.py#L301-L305
         "abort_exception": RuntimeError,
     }
+    base_kwargs.update(_capture_default_settings())
     global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
 
-    if final_kwargs["capture"]:
+    if final_kwargs["capture"] or final_kwargs["stream"]:
         if final_kwargs["combine_stderr"]:
             out_stream = subprocess.PIPE
             err_stream = subprocess.STDOUT
@@ -493,7 +2163,7 @@ def local(command, **kwargs):
         raise ValueError("when shell=False, given command *must* be a list")
 
     if final_kwargs["use_shell"]:
-        command = shell_wrap_command(command)
+        command = shell_wrap_command(command, login=final_kwargs["login_shell"])
 
     if final_kwargs["use_sudo"]:
         if final_kwargs["use_shell"]:
@@ -503,19 +2173,49 @@ def local(command, **kwargs):
             # nothing uses local+noshell+sudo (at time of writing)
             command = ["sudo", "--non-interactive"] + command
 
-    proc = subprocess.Popen(
-        command, shell=final_kwargs["use_shell"], stdout=out_stream, stderr=err_stream
-    )
-    _print_running(command, sys.stdout, **final_kwargs)
-    if final_kwargs["timeout"]:
-        timer = Timer(final_kwargs["timeout"], proc.kill)
-        try:
-            timer.start()  # proximity matters
-            stdout, stderr = proc.communicate()
-        finally:
-            timer.cancel()
+    # a command that may time out is given it's own session and process group so anything it starts can be killed too.
+    timeout = final_kwargs["timeout"]
+    new_session = bool(timeout)
+    if final_kwargs["use_posix_spawn"]:
+        args = ["/bin/sh", "-c", command] if final_kwargs["use_shell"] else command
+        proc = _SpawnedProcess(
+            args, stdout=out_stream, stderr=err_stream, new_session=new_session
+        )
     else:
-        stdout, stderr = proc.communicate()
+        proc = subprocess.Popen(
+            command,
+            shell=final_kwargs["use_shell"],
+            stdout=out_stream,
+            stderr=err_stream,
+            start_new_session=new_session,
+        )
+    _print_running(command, sys.stdout, **final_kwargs)
+    capture_kwargs = subdict(
+        final_kwargs, ["on_line"] + list(_capture_default_settings().keys())
+    )
+    capture_kwargs["stream"] = final_kwargs["stream"] and not final_kwargs["quiet"]
+
+    timed_out = False
+
+    def on_timeout():
+        nonlocal timed_out
+        timed_out = True
+        _kill_process(proc, process_group=True)
+
+    # timers are scheduled by the gevent hub's event loop rather than a thread per-command.
+    timer = None
+    if timeout:
+        timer = gevent.get_hub().loop.timer(timeout)
+        timer.start(on_timeout)
+    try:
+        stdout, stderr = _local_capture(proc, **capture_kwargs)
+    except BaseException:
+        # interrupted, by `local_many` failing fast for example. don't leave the command running.
+        _kill_process(proc, process_group=new_session)
+        raise
+    finally:
+        if timer:
+            timer.close()
 
     # https://github.com/mathiasertl/fabric/blob/master/fabric/operations.py#L1240-L1244
     result = {
@@ -523,9 +2223,11 @@ def local(command, **kwargs):
         "failed": proc.returncode != 0,
         "succeeded": proc.returncode == 0,
         "command": command,
-        "stdout": (stdout or b"").decode("utf-8").splitlines(),
-        "stderr": (stderr or b"").decode("utf-8").splitlines(),
+        "stdout": stdout,
+        "stderr": stderr,
     }
+    if timeout:
+        result["timed_out"] = timed_out
 
     if result["succeeded"]:
         return result
@@ -534,11 +2236,66 @@ def local(command, **kwargs):
         result["return_code"],
         command,
     )
+    if timed_out:
+        err_msg = "local() timed out after %s seconds while executing %r" % (
+            timeout,
+            command,
+        )
 
     # if `warn_only` is True this function may still return a result
     return abort(result, err_msg, **final_kwargs)
 
 
+def local_many(command_list, **kwargs):
+    """runs each command in `command_list` locally and concurrently using `local`, at most `max_concurrency` at once.
+    output is printed line by line as it arrives, see `local(stream=True)`, unless `stream=False` is given.
+
+    returns a list of `local` results in the same order as `command_list`.
+    if any command fails (and `warn_only` is `False`) the first failure is raised after all commands have finished.
+    if `fail_fast` is `True`, the first failure kills any running commands and no more are started. their results
+    are `None`."""
+    base_kwargs = {
+        "max_concurrency": os.cpu_count() or 1,
+        "fail_fast": False,
+        "stream": True,
+    }
+    global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
+    ensure(
+        isinstance(command_list, list),
+        "given value for `command_list` must be a list, not %r" % type(command_list),
+        ValueError,
+    )
+    ensure(final_kwargs["max_concurrency"] > 0, "`max_concurrency` must be at least 1")
+
+    local_kwargs = merge(kwargs, {"stream": final_kwargs["stream"]})
+    semaphore = gevent.lock.BoundedSemaphore(final_kwargs["max_concurrency"])
+    outcomes = [(None, None)] * len(command_list)
+
+    def local_fn(idx, command):
+        # exceptions are stored rather than raised so gevent doesn't print them as unhandled
+        with semaphore:
+            try:
+                outcomes[idx] = local(command, **local_kwargs), None
+            except Exception as exc:
+                outcomes[idx] = getattr(exc, "result", None), exc
+        return idx
+
+    greenlet_list = [
+        gevent.spawn(local_fn, idx, command) for idx, command in enumerate(command_list)
+    ]
+    for greenlet in gevent.iwait(greenlet_list):
+        result, exc = outcomes[greenlet.value]
+        failed = exc or (result and result["failed"])
+        if failed and final_kwargs["fail_fast"]:
+            gevent.killall(greenlet_list)
+            break
+
+    for result, exc in outcomes:
+        if exc:
+            raise exc
+    return [result for result, exc in outcomes]
+
+
 def single_command(cmd_list):
     "given a list of commands to run, returns a single command."
     # `remote` and `local` will do any escaping as necessary
@@ -643,11 +2400,17 @@ def _rsync_upload(local_path, remote_path, **kwargs):
     return " ".join(cmd)
 
 
-def rsync_upload(local_path, remote_path, **kwargs):
-    "copies `local_path` to `remote_path` using values in the current `state.ENV`."
+def rsync_upload(local_path, remote_path, remote_dir_exists=None, **kwargs):
+    """copies `local_path` to `remote_path` using values in the current `state.ENV`.
+    the parent directory of `remote_path` is created if it doesn't exist. pass `remote_dir_exists` if that's already
+    known to save checking it again."""
     remote_dir = os.path.dirname(remote_path)
-    if not remote_file_exists(remote_dir):
+    if remote_dir_exists is None:
+        remote_dir_exists = remote_file_exists(remote_dir)
+    if not remote_dir_exists:
         remote("mkdir -p %r" % remote_dir)
+        _stat_cache_forget([remote_dir])
+    _stat_cache_forget([remote_path])
     return execute_rsync_command(_rsync_upload(local_path, remote_path, **kwargs))
 
 
@@ -696,10 +2459,741 @@ def rsync_download(remote_path, local_path, **kwargs):
     return execute_rsync_command(_rsync_download(remote_path, local_path, **kwargs))
 
 
+def _channel_read(client, read_fn):
+    "yields chunks of bytes from `read_fn`, a channel's `read` or `read_stderr` method, until the stream ends."
+    while True:
+        size, data = read_fn()
+        if size == LIBSSH2_ERROR_EAGAIN:
+            client.poll()
+            continue
+        if size <= 0:
+            return
+        yield data
+
+
+class _ChannelFile:
+    """a file-like object for a command executed on a new channel of `client`.
+    writing to it writes to the command's stdin and reading from it reads the command's stdout.
+    unlike `_execute` output is not decoded or split into lines, so it's safe for binary data.
+
+    stdout and stderr share the channel's window, so whenever we'd otherwise wait on the channel both are read.
+    a command writing a lot to stderr can't stall waiting for us to read it.
+    """
+
+    def __init__(self, client, command):
+        self.client = client
+        self.channel = client.execute(command)
+        self.buffer = bytearray()
+        self.stderr = []
+        self.eof = False
+
+    def _read_available(self):
+        """reads whatever stdout and stderr is available without waiting.
+        returns `True` if anything was read or stdout has ended."""
+        progress = False
+        if not self.eof:
+            size, data = self.channel.read()
+            if size > 0:
+                self.buffer.extend(data)
+                progress = True
+            elif size != LIBSSH2_ERROR_EAGAIN:
+                self.eof = progress = True
+        size, data = self.channel.read_stderr()
+        if size > 0:
+            self.stderr.append(data)
+            progress = True
+        return progress
+
+    def _wait(self):
+        "reads what's available or waits until something is."
+        if not self._read_available():
+            self.client.poll()
+
+    def write(self, data):
+        total = len(data)
+        while data:
+            rc, written = self.channel.write(data)
+            data = data[written:]
+            if rc == LIBSSH2_ERROR_EAGAIN:
+                self._wait()
+        return total
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) < size) and not self.eof:
+            self._wait()
+        size = len(self.buffer) if size < 0 else size
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def chunks(self):
+        "yields chunks of stdout as they arrive until it ends."
+        while True:
+            if self.buffer:
+                data = bytes(self.buffer)
+                self.buffer.clear()
+                yield data
+            elif self.eof:
+                return
+            else:
+                self._wait()
+
+    def send_eof(self):
+        "tells the command there is nothing more to read from it's stdin."
+        self.client._eagain(self.channel.send_eof)
+
+    def close(self):
+        """waits for the command to finish, discarding any unread output.
+        returns a pair of (`return_code`, `stderr`)."""
+        for _ in self.chunks():
+            pass
+        self.stderr.extend(_channel_read(self.client, self.channel.read_stderr))
+        self.client._eagain(self.channel.wait_eof)
+        self.client.close_channel(self.channel)
+        self.client._eagain(self.channel.wait_closed)
+        return self.channel.get_exit_status(), b"".join(self.stderr)
+
+
+def _pipe_execute(client, command, stdin=(), stdout_fn=None):
+    """executes `command` on a new channel of `client`, writing each chunk of bytes in `stdin` to it.
+    each chunk of bytes written to stdout is given to `stdout_fn` or collected if no `stdout_fn` is given.
+    stderr is read at the same time, see `_ChannelFile`.
+    returns a triple of (`return_code`, `stdout`, `stderr`), where `stdout` is empty if a `stdout_fn` was given.
+    """
+    pipe = _ChannelFile(client, command)
+    try:
+        for chunk in stdin:
+            pipe.write(chunk)
+    except Exception:
+        # the command is left to finish with what it was given rather than waiting on input that will never come
+        pipe.send_eof()
+        pipe.close()
+        raise
+    pipe.send_eof()
+
+    stdout = []
+    stdout_fn = stdout_fn or stdout.append
+    for chunk in pipe.chunks():
+        stdout_fn(chunk)
+    return_code, stderr = pipe.close()
+    return return_code, b"".join(stdout), stderr
+
+
+def _read_chunks(local_file, chunk_size=65536):
+    "yields the contents of `local_file` in chunks of `chunk_size` bytes."
+    with open(local_file, "rb") as fh:
+        yield from iter(partial(fh.read, chunk_size), b"")
+
+
+def _transfer_script(script, use_sudo=False):
+    """returns the given shell `script` wrapped in a non-login shell, so it runs the same whatever the remote user's
+    login shell is, and as root if `use_sudo` is `True`."""
+    script = shell_wrap_command(script, login=False)
+    if not use_sudo:
+        return script
+    return sudo_wrap_command(script)
+
+
+def _is_stream(local_path):
+    "returns `True` if `local_path` is a readable file-like object or an iterable of chunks rather than a path."
+    if isinstance(local_path, (str, bytes, os.PathLike)):
+        return False
+    return hasattr(local_path, "read") or hasattr(local_path, "__iter__")
+
+
+def _stream_chunks(stream, chunk_size=65536):
+    """yields the contents of `stream` in chunks of at most `chunk_size` bytes.
+    `stream` is either a readable file-like object, read from the start if it's seekable, or an iterable of chunks.
+    chunks that are strings are encoded as UTF-8."""
+    if hasattr(stream, "read"):
+        if hasattr(stream, "seekable") and stream.seekable():
+            stream.seek(0)
+        chunks = iter(lambda: stream.read(chunk_size), None)
+    else:
+        chunks = iter(stream)
+    for chunk in chunks:
+        if not chunk:
+            if hasattr(stream, "read"):
+                # end of file
+                return
+            continue
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        yield chunk
+
+
+# codecs in order of preference. each pairs local (de)compression with the equivalent remote command.
+_CODECS = {
+    "zstd": {
+        "name": "zstd",
+        "compressor": lambda: zstandard.ZstdCompressor().compressobj(),
+        "decompressor": lambda: zstandard.ZstdDecompressor().decompressobj(),
+        "compress": "zstd -q -c",
+        "decompress": "zstd -q -d -c",
+    },
+    "gzip": {
+        "name": "gzip",
+        # a `wbits` of 31 reads and writes the gzip format
+        "compressor": lambda: zlib.compressobj(6, zlib.DEFLATED, 31),
+        "decompressor": lambda: zlib.decompressobj(31),
+        "compress": "gzip -c",
+        "decompress": "gzip -d -c",
+    },
+}
+
+
+def _compression_codec(**kwargs):
+    """returns the codec used to compress transfers and command output for the host in `kwargs`, or `None` if the
+    `compression` setting is disabled or no codec is available both locally and on the remote host.
+    the commands available on each host are looked up once per-process."""
+    base_kwargs = _compression_default_settings()
+    global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
+    compression = final_kwargs["compression"]
+    if not compression:
+        return None
+    preferred = list(_CODECS) if compression is True else [compression]
+    ensure(
+        all(name in _CODECS for name in preferred),
+        "unhandled compression %r; supported compression: %s"
+        % (compression, ", ".join(_CODECS)),
+        ValueError,
+    )
+
+    host_key = _ssh_client_key(_ssh_client_kwargs(**kwargs))
+    if host_key not in COMPRESSION_COMMANDS:
+        probe_kwargs = {
+            "compression": False,
+            "warn_only": True,
+            "quiet": True,
+            "display_running": False,
+        }
+        result = remote(
+            "for cmd in %s; do command -v $cmd; done" % " ".join(_CODECS),
+            **merge(subdict(kwargs, _ssh_default_settings().keys()), probe_kwargs),
+        )
+        COMPRESSION_COMMANDS[host_key] = {
+            os.path.basename(path) for path in result["stdout"]
+        }
+
+    available = COMPRESSION_COMMANDS[host_key]
+    if zstandard is None:
+        available = available - {"zstd"}
+    return first([_CODECS[name] for name in preferred if name in available])
+
+
+def _compress_chunks(chunks, codec, stats):
+    "yields the given `chunks` of bytes compressed with `codec`, counting bytes before and after in `stats`."
+    compressor = codec["compressor"]()
+    for chunk in chunks:
+        stats["uncompressed"] += len(chunk)
+        chunk = compressor.compress(chunk)
+        if chunk:
+            stats["compressed"] += len(chunk)
+            yield chunk
+    chunk = compressor.flush()
+    stats["compressed"] += len(chunk)
+    yield chunk
+
+
+def _decompressed_lines(lines, marker, codec, **kwargs):
+    """yields the lines of output of a command wrapped with `compress_wrap_command`.
+    output following the `marker` is base64 encoded and compressed with `codec`, anything else is yielded as-is.
+    """
+    lines = iter(lines)
+    for line in lines:
+        if line.strip() == marker:
+            break
+        yield line
+    else:
+        return
+
+    start = time.time()
+    stats = {"uncompressed": 0, "compressed": 0}
+    decompressor = codec["decompressor"]()
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    pending = ""
+    for line in lines:
+        # a pty may add a carriage return
+        line = line.strip()
+        stats["compressed"] += len(line) + 1
+        chunk = decompressor.decompress(base64.b64decode(line))
+        stats["uncompressed"] += len(chunk)
+        pending += decoder.decode(chunk)
+        *complete, pending = pending.split("\n")
+        yield from complete
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+    _record_compression(stats, start, **kwargs)
+
+
+def _record_compression(stats, start, **kwargs):
+    """counts the bytes before and after compression in `stats` for the host in `kwargs`, see `compression_report`.
+    the time saved is estimated from how long the compressed bytes took to transfer since `start`.
+    does nothing if `stats` is `None`, as nothing was compressed."""
+    if stats is None:
+        return
+    seconds = time.time() - start
+    host = handle({"host_string": None}, kwargs)[2]["host_string"]
+    uncompressed, compressed = stats["uncompressed"], stats["compressed"]
+    seconds_saved = (
+        seconds * (uncompressed - compressed) / compressed if compressed else 0
+    )
+    _incr_metric(host, "compressed-transfers")
+    _incr_metric(host, "compression-bytes-uncompressed", uncompressed)
+    _incr_metric(host, "compression-bytes-compressed", compressed)
+    _incr_metric(host, "compression-seconds-saved", seconds_saved)
+
+
+# the number of bytes sent is written after a file uploaded by `_pipe_upload` as this many decimal digits
+_UPLOAD_TRAILER_BYTES = 20
+
+
+def _pipe_upload(
+    client, local_file, remote_file, overwrite=True, use_sudo=False, codec=None
+):
+    """copies `local_file` to `remote_file` by writing it to a remote `cat` over a single channel.
+    `local_file` may also be a stream of bytes, see `_stream_chunks`, that is read in chunks without a temporary file.
+    checking for an existing file, creating the parent directory and verifying the number of bytes written all happen
+    on the remote host within the same command, rather than as separate commands either side of the transfer.
+    the file is written to a temporary file beside `remote_file` that is only moved into place once it's complete,
+    keeping the mode and owner of any file it replaces.
+    with `use_sudo=True` the remote command runs as root, without a temporary copy in `/tmp`.
+    with a `codec` the file is compressed as it's sent and decompressed on the remote host, see `_compression_codec`.
+    returns the number of bytes before and after compression if a `codec` was given."""
+    # the remote command always reads everything we write, even when it's refusing to write the file.
+    # the size of the file isn't known until a stream has been read, so the number of bytes sent is written after
+    # them as a fixed-width trailer that is checked and removed before the file is moved into place.
+    script = "\n".join(
+        [
+            'path="%s"; tmp=' % remote_file,
+            "trap 'rm -f \"$tmp\"' EXIT; trap 'exit 1' HUP INT TERM PIPE",
+            'if [ %d = 0 ] && [ -e "$path" ]; then cat > /dev/null; echo exists; exit 1; fi'
+            % overwrite,
+            'dir=$(dirname "$path")',
+            'mkdir -p "$dir" && tmp=$(mktemp "$dir/.threadbare.XXXXXX") && %s > "$tmp" '
+            "|| { cat > /dev/null; echo failed; exit 1; }"
+            % (codec["decompress"] if codec else "cat"),
+            'size=$(($(wc -c < "$tmp") - %d))' % _UPLOAD_TRAILER_BYTES,
+            'if [ "$(tail -c %d "$tmp")" != "$(printf %%0%dd "$size")" ]; then echo short $size; exit 1; fi'
+            % (_UPLOAD_TRAILER_BYTES, _UPLOAD_TRAILER_BYTES),
+            'truncate -s "$size" "$tmp" || { echo failed; exit 1; }',
+            'if [ -e "$path" ]; then chmod --reference="$path" "$tmp"; chown --reference="$path" "$tmp" 2> /dev/null; '
+            'else chmod "$(printf %o $((0666 & ~$(umask))))" "$tmp"; fi',
+            'mv -f -T "$tmp" "$path" || { echo failed; exit 1; }',
+            "echo ok $size",
+        ]
+    )
+    script = _transfer_script(script, use_sudo)
+    chunks = (
+        _stream_chunks(local_file)
+        if _is_stream(local_file)
+        else _read_chunks(local_file)
+    )
+    sent = []
+
+    def counted(chunks):
+        for chunk in chunks:
+            sent.append(len(chunk))
+            yield chunk
+        yield b"%0*d" % (_UPLOAD_TRAILER_BYTES, sum(sent))
+
+    chunks = counted(chunks)
+    stats = {"uncompressed": 0, "compressed": 0}
+    if codec:
+        chunks = _compress_chunks(chunks, codec, stats)
+    return_code, stdout, stderr = _pipe_execute(client, script, stdin=chunks)
+    status = stdout.decode("utf-8").split()
+    if status[:1] == ["exists"]:
+        raise NetworkError(
+            "Remote file exists and 'overwrite' is set to 'False'. Refusing to write: %s"
+            % (remote_file,)
+        )
+    if status[:1] == ["short"]:
+        raise NetworkError(
+            "failed to upload file %s: %s of %s bytes written"
+            % (remote_file, status[1], sum(sent))
+        )
+    if return_code != 0 or status[:1] != ["ok"]:
+        raise NetworkError(
+            "failed to upload file %s: %s"
+            % (remote_file, stderr.decode("utf-8", "replace").strip())
+        )
+    if codec:
+        # the trailer isn't part of the file
+        stats["uncompressed"] -= _UPLOAD_TRAILER_BYTES
+        return stats
+
+
+def _is_writable(local_path):
+    "returns `True` if `local_path` is a writable file-like object or a callback rather than a path."
+    return hasattr(local_path, "write") or callable(local_path)
+
+
+def _stream_writer(local_file):
+    """returns a pair of functions, one that gives chunks of bytes to `local_file`, a writable file-like object or a
+    callback, and one to call once every chunk has been given.
+    text streams, like `io.StringIO`, are given strings decoded as UTF-8. a character left incomplete by the final
+    chunk raises a `UnicodeDecodeError` once every chunk has been given."""
+    write = local_file.write if hasattr(local_file, "write") else local_file
+    if isinstance(local_file, io.TextIOBase):
+        # a multi-byte character may be split across chunks
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        return (
+            lambda chunk: write(decoder.decode(chunk)),
+            lambda: write(decoder.decode(b"", final=True)),
+        )
+    return write, lambda: None
+
+
+def _decompressing_writer(write, codec, stats):
+    """returns a function that gives chunks of bytes read from a remote command to `write`.
+    the first byte written by the command is 'z' if the rest is compressed with `codec`, and '-' if it isn't.
+    bytes before and after decompression are counted in `stats`."""
+    decompress = []
+
+    def writer(chunk):
+        if not decompress:
+            compressed, chunk = chunk[:1] == b"z", chunk[1:]
+            stats["compressed"] = compressed
+            decompress.append(
+                codec["decompressor"]().decompress if compressed else bytes
+            )
+        stats["compressed-bytes"] += len(chunk)
+        chunk = decompress[0](chunk)
+        stats["uncompressed-bytes"] += len(chunk)
+        write(chunk)
+
+    return writer
+
+
+def _pipe_download(
+    client, remote_file, local_file, use_sudo=False, codec=None, threshold=0
+):
+    """copies `remote_file` to `local_file` by reading the output of a remote `cat` over a single channel.
+    `local_file` may also be a writable file-like object or a callback that is given each chunk as it arrives,
+    see `_stream_writer`. otherwise it's written to a temporary file beside `local_file` that replaces it once the
+    download has succeeded. with `use_sudo=True` the file is read as root, without a temporary copy in `/tmp`.
+    with a `codec` a remote file of at least `threshold` bytes is compressed on the remote host and decompressed as
+    it arrives, see `_compression_codec`. returns the number of bytes before and after compression if it was.
+    """
+    command = 'cat "%s"' % remote_file
+    if codec:
+        command = (
+            'path="%s"; if [ $(wc -c < "$path") -ge %d ]; then printf z; %s < "$path"; '
+            'else printf -- -; cat "$path"; fi'
+        ) % (remote_file, threshold, codec["compress"])
+    command = _transfer_script(command, use_sudo)
+    stats = {"compressed": False, "uncompressed-bytes": 0, "compressed-bytes": 0}
+
+    def stdout_fn(write):
+        if codec:
+            return _decompressing_writer(write, codec, stats)
+        return write
+
+    if _is_writable(local_file):
+        write, finish = _stream_writer(local_file)
+        return_code, _, stderr = _pipe_execute(
+            client, command, stdout_fn=stdout_fn(write)
+        )
+        if return_code == 0:
+            finish()
+    else:
+        local_dir = os.path.dirname(os.path.abspath(local_file))
+        os.makedirs(local_dir, exist_ok=True)
+        # written beside `local_file` and only moved over it once the download has succeeded
+        temp_file = os.path.join(local_dir, ".threadbare.%s" % uuid.uuid4().hex)
+        try:
+            fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            with open(fd, "wb") as fh:
+                return_code, _, stderr = _pipe_execute(
+                    client, command, stdout_fn=stdout_fn(fh.write)
+                )
+            if return_code == 0:
+                if os.path.exists(local_file):
+                    os.chmod(temp_file, os.stat(local_file).st_mode & 0o7777)
+                os.replace(temp_file, local_file)
+        finally:
+            if os.path.exists(temp_file):
+                os.unlink(temp_file)
+    if return_code != 0:
+        raise NetworkError(
+            "failed to download file %s: %s"
+            % (remote_file, stderr.decode("utf-8", "replace").strip())
+        )
+    if stats["compressed"]:
+        return {
+            "uncompressed": stats["uncompressed-bytes"],
+            "compressed": stats["compressed-bytes"],
+        }
+
+
+def _tar_upload(
+    client,
+    local_dir,
+    remote_dir,
+    overwrite=True,
+    compress=False,
+    use_sudo=False,
+    members=None,
+):
+    """copies the contents of `local_dir` into `remote_dir` as a tar archive streamed to a remote `tar` over a single
+    channel. `remote_dir` is created if it doesn't exist and file permissions are preserved.
+    with `compress=True` the archive is compressed with gzip. with `use_sudo=True` the remote `tar` runs as root.
+    `members` is a list of paths relative to `local_dir` to copy rather than everything, directories are not recursed.
+    """
+    script = "\n".join(
+        [
+            'path="%s"' % remote_dir,
+            'if [ %d = 0 ] && [ -e "$path" ]; then cat > /dev/null; echo exists; exit 1; fi'
+            % overwrite,
+            'mkdir -p "$path" && tar -x -p %s -f - -C "$path" || { cat > /dev/null; echo failed; exit 1; }'
+            % ("-z" if compress else ""),
+            "echo ok",
+        ]
+    )
+    pipe = _ChannelFile(client, _transfer_script(script, use_sudo))
+    with tarfile.open(fileobj=pipe, mode="w|gz" if compress else "w|") as tar:
+        if members is None:
+            tar.add(local_dir, arcname=".")
+        else:
+            tar.add(local_dir, arcname=".", recursive=False)
+            for rel_path in members:
+                tar.add(
+                    os.path.join(local_dir, rel_path),
+                    arcname="./" + rel_path,
+                    recursive=False,
+                )
+    pipe.send_eof()
+    status = pipe.read().decode("utf-8").split()
+    return_code, stderr = pipe.close()
+    if status[:1] == ["exists"]:
+        raise NetworkError(
+            "Remote directory exists and 'overwrite' is set to 'False'. Refusing to write: %s"
+            % (remote_dir,)
+        )
+    if return_code != 0 or status[:1] != ["ok"]:
+        raise NetworkError(
+            "failed to upload directory %s: %s"
+            % (remote_dir, stderr.decode("utf-8", "replace").strip())
+        )
+
+
+def _contained_tar_members(tar, local_dir):
+    """yields each member of `tar` as it's read, raising a `tarfile.TarError` for any that would be extracted outside
+    of `local_dir` or link to a path outside of it.
+    for Pythons without extraction filters, see `tarfile.tar_filter`."""
+    local_dir = os.path.realpath(local_dir)
+
+    def contained(path):
+        path = os.path.realpath(path)
+        return path == local_dir or path.startswith(local_dir + os.sep)
+
+    for member in tar:
+        path = os.path.join(local_dir, member.name)
+        ensure(
+            not os.path.isabs(member.name) and contained(path),
+            "refusing to extract %r outside of %s" % (member.name, local_dir),
+            tarfile.TarError,
+        )
+        if member.issym():
+            # relative to the link itself
+            target = os.path.join(os.path.dirname(path), member.linkname)
+        elif member.islnk():
+            # relative to the root of the archive
+            target = os.path.join(local_dir, member.linkname)
+        else:
+            target = None
+        ensure(
+            target is None
+            or (not os.path.isabs(member.linkname) and contained(target)),
+            "refusing to extract %r linking outside of %s" % (member.name, local_dir),
+            tarfile.TarError,
+        )
+        yield member
+
+
+def _tar_download(
+    client,
+    remote_dir,
+    local_dir,
+    overwrite=True,
+    compress=False,
+    use_sudo=False,
+    members=None,
+):
+    """copies the contents of `remote_dir` into `local_dir` as a tar archive streamed from a remote `tar` over a
+    single channel. `local_dir` is created if it doesn't exist and file permissions are preserved.
+    with `compress=True` the archive is compressed with gzip. with `use_sudo=True` the remote `tar` runs as root.
+    `members` is a list of paths relative to `remote_dir` to copy rather than everything, directories are not recursed.
+    """
+    if not overwrite and os.path.exists(local_dir):
+        raise NetworkError(
+            "Local directory exists and 'overwrite' is set to 'False'. Refusing to write: %s"
+            % (local_dir,)
+        )
+    os.makedirs(local_dir, exist_ok=True)
+    command = 'tar -c %s -f - -C "%s" .' % ("-z" if compress else "", remote_dir)
+    if members is not None:
+        # the paths are written to the remote `tar`, separated by NUL bytes
+        command = 'tar -c %s -f - -C "%s" --no-recursion --null -T -' % (
+            "-z" if compress else "",
+            remote_dir,
+        )
+    pipe = _ChannelFile(client, _transfer_script(command, use_sudo))
+    if members is not None:
+        pipe.write(b"".join(member.encode("utf-8") + b"\0" for member in members))
+    pipe.send_eof()
+    try:
+        with tarfile.open(fileobj=pipe, mode="r|gz" if compress else "r|") as tar:
+            # the 'tar' filter refuses members that would be extracted outside of `local_dir`
+            if hasattr(tarfile, "tar_filter"):
+                extract_kwargs = {"filter": "tar"}
+            else:
+                extract_kwargs = {"members": _contained_tar_members(tar, local_dir)}
+            tar.extractall(local_dir, **extract_kwargs)
+    except tarfile.TarError as exc:
+        # the remote `tar` failed, the reason is on stderr
+        return_code, stderr = pipe.close()
+        raise NetworkError(
+            "failed to download directory %s: %s"
+            % (remote_dir, stderr.decode("utf-8", "replace").strip() or exc)
+        )
+    return_code, stderr = pipe.close()
+    if return_code != 0:
+        raise NetworkError(
+            "failed to download directory %s: %s"
+            % (remote_dir, stderr.decode("utf-8", "replace").strip())
+        )
+
+
+def _local_checksum(local_path):
+    "returns the sha256 checksum of the contents of `local_path`."
+    digest = hashlib.sha256()
+    for chunk in _read_chunks(local_path):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _skip_identical(local_path, remote_path, use_sudo=False, **kwargs):
+    """returns `True` if `local_path` and `remote_path` have the same contents and the transfer can be skipped.
+    skipped transfers and the bytes not transferred are counted, see `metrics`."""
+    if not os.path.isfile(local_path):
+        return False
+    remote_checksum = remote_checksums([remote_path], use_sudo=use_sudo, **kwargs)[
+        remote_path
+    ]
+    if remote_checksum is None or remote_checksum != _local_checksum(local_path):
+        return False
+    _count_skipped([local_path], **kwargs)
+    return True
+
+
+def _count_skipped(local_path_list, **kwargs):
+    "counts the transfer of each file in `local_path_list` as skipped, see `metrics`."
+    host = handle({"host_string": None}, kwargs)[2]["host_string"]
+    for local_path in local_path_list:
+        _incr_metric(host, "transfers-skipped")
+        _incr_metric(host, "transfer-bytes-skipped", os.path.getsize(local_path))
+
+
+def _changed_upload_members(local_dir, remote_dir, use_sudo=False, **kwargs):
+    """returns the paths beneath `local_dir`, relative to it, that need uploading to `remote_dir`, an empty list if
+    there is nothing to upload or `None` if everything should be.
+    every remote file is checksummed with a single command, see `remote_checksums`. directories are always included so
+    changed files have somewhere to go. skipped files are counted, see `metrics`."""
+    dir_list, file_list, other_list = [], [], []
+    for dirpath, dirnames, filenames in os.walk(local_dir):
+        dirnames.sort()
+        rel_dir = os.path.relpath(dirpath, local_dir)
+        if rel_dir != ".":
+            dir_list.append(rel_dir)
+        for name in dirnames + sorted(filenames):
+            rel_path = os.path.normpath(os.path.join(rel_dir, name))
+            path = os.path.join(local_dir, rel_path)
+            if os.path.isfile(path) and not os.path.islink(path):
+                file_list.append(rel_path)
+            elif os.path.islink(path) or not os.path.isdir(path):
+                # symlinks and anything else that can't be checksummed
+                other_list.append(rel_path)
+    if not file_list:
+        return None
+
+    remote_path_map = {
+        rel_path: "%s/%s" % (remote_dir.rstrip("/"), rel_path) for rel_path in file_list
+    }
+    checksums = remote_checksums(
+        list(remote_path_map.values()), use_sudo=use_sudo, **kwargs
+    )
+    changed_list, skipped_list = [], []
+    for rel_path in file_list:
+        local_path = os.path.join(local_dir, rel_path)
+        if checksums[remote_path_map[rel_path]] == _local_checksum(local_path):
+            skipped_list.append(local_path)
+        else:
+            changed_list.append(rel_path)
+    # an empty directory may be missing remotely
+    empty_dir_list = [
+        rel_dir
+        for rel_dir in dir_list
+        if not any(path.startswith(rel_dir + os.sep) for path in file_list)
+    ]
+    _count_skipped(skipped_list, **kwargs)
+    if not changed_list and not other_list and not empty_dir_list:
+        return []
+    return dir_list + changed_list + other_list
+
+
+# a line of `sha256sum` output, the checksum and the path
+_SHA256SUM_LINE = re.compile(r"^([0-9a-f]{64})  (\./.*)$")
+
+
+def _changed_download_members(remote_dir, local_dir, use_sudo=False, **kwargs):
+    """returns the paths beneath `remote_dir`, relative to it, that need downloading to `local_dir`, an empty list if
+    there is nothing to download or `None` if everything should be.
+    every remote file is listed and checksummed with a single command. directories are always included so changed
+    files have somewhere to go. skipped files are counted, see `metrics`."""
+    marker = "__threadbare_checksums_%s__" % uuid.uuid4().hex
+    # checksums for files, anything else is just listed
+    command = (
+        "echo '%s'; cd \"%s\" && find . -mindepth 1 \\( -type f -exec sha256sum {} + \\) -o -print"
+        % (marker, remote_dir)
+    )
+    remote_fn = remote_sudo if use_sudo else remote
+    result = remote_fn(command, **merge(kwargs, {"warn_only": True, "quiet": True}))
+    stdout = result["stdout"]
+    if not result["succeeded"] or marker not in stdout:
+        return None
+
+    changed_list, other_list, skipped_list = [], [], []
+    # anything before the marker is noise from the shell itself, like a login profile
+    for line in stdout[stdout.index(marker) + 1 :]:
+        match = _SHA256SUM_LINE.match(line)
+        if match:
+            checksum, rel_path = match.groups()
+            local_path = os.path.join(local_dir, rel_path)
+            if os.path.isfile(local_path) and checksum == _local_checksum(local_path):
+                skipped_list.append(local_path)
+            else:
+                changed_list.append(rel_path)
+        elif line.startswith("./"):
+            other_list.append(line)
+        else:
+            # a path with a newline in it or escaped by `sha256sum`, download everything rather than guess
+            return None
+
+    _count_skipped(skipped_list, **kwargs)
+    if not changed_list and all(
+        os.path.lexists(os.path.join(local_dir, rel_path)) for rel_path in other_list
+    ):
+        return []
+    return other_list + changed_list
+
+
 def _transfer_fn(client, direction, **kwargs):
     """returns the `client` object's appropriate transfer *method* given a `direction`.
     `direction` is either 'upload' or 'download'.
-    Also accepts the `transfer_protocol` keyword parameter that is either 'rsync' (default), 'scp' or 'sftp'.
+    Also accepts the `transfer_protocol` keyword parameter that is either 'rsync' (default), 'scp', 'sftp' or 'pipe'.
     """
     base_kwargs = {
         "overwrite": True,
@@ -708,26 +3202,40 @@ def _transfer_fn(client, direction, **kwargs):
         # - https://github.com/ParallelSSH/parallel-ssh/issues/177
         # however, SCP is buggy and may randomly hang or complete without uploading anything.
         # take slow and reliable over fast and buggy.
-        "transfer_protocol": "rsync",  # "sftp",  # "scp"
+        # "pipe" uploads small files in a single command, see `_pipe_upload`.
+        "transfer_protocol": "rsync",  # "sftp",  # "scp", # "pipe"
     }
     global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
 
     def upload_fn(fn):
         @wraps(fn)
         def wrapper(local_file, remote_file):
-            if remote_file_exists(remote_file) and not final_kwargs["overwrite"]:
+            if final_kwargs["transfer_protocol"] == "pipe":
+                # checks and directory creation are part of the transfer itself, see `_pipe_upload`.
+                fn(local_file, remote_file)
+                _stat_cache_forget([remote_file], **kwargs)
+                return
+
+            # `rsync_upload` needs to know if the parent directory exists, it's checked at the same time.
+            path_list = [remote_file]
+            remote_dir = os.path.dirname(remote_file)
+            if final_kwargs["transfer_protocol"] == "rsync" and remote_dir:
+                path_list.append(remote_dir)
+            exists = remote_files_exist(path_list)
+            if exists[remote_file] and not final_kwargs["overwrite"]:
                 raise NetworkError(
                     "Remote file exists and 'overwrite' is set to 'False'. Refusing to write: %s"
                     % (remote_file,)
                 )
 
             if final_kwargs["transfer_protocol"] == "rsync":
-                fn(local_file, remote_file)
+                fn(local_file, remote_file, remote_dir_exists=exists.get(remote_dir))
             else:
                 # https://github.com/ParallelSSH/parallel-ssh/blob/8b7bb4bcb94d913c3b7da77db592f84486c53b90/pssh/clients/native/parallel.py#L524
                 g = fn(local_file, remote_file)
                 if g:
                     gevent.joinall(g, raise_error=True)
+            _stat_cache_forget([remote_file], **kwargs)
 
             # lsh@2020-04, local testing didn't reveal anything but small files uploaded via SCP SCP during CI
             # were either missing or had empty bodies. SFTP seemed to be fine.
@@ -750,7 +3258,7 @@ def _transfer_fn(client, direction, **kwargs):
                     "Local file exists and 'overwrite' is set to 'False'. Refusing to write: %s"
                     % (local_file,)
                 )
-            if final_kwargs["transfer_protocol"] == "rsync":
+            if final_kwargs["transfer_protocol"] in ["rsync", "pipe"]:
                 fn(remote_file, local_file)
             else:
                 # https://github.com/ParallelSSH/parallel-ssh/blob/d812ff32d828009ddb94f458fe43920c22df4c0e/pssh/clients/native/single.py#L558
@@ -764,12 +3272,14 @@ def _transfer_fn(client, direction, **kwargs):
         "sftp": partial(client.copy_file, recurse=True),
         "scp": partial(client.scp_send, recurse=True),
         "rsync": rsync_upload,
+        "pipe": partial(_pipe_upload, client, overwrite=final_kwargs["overwrite"]),
     }
 
     download_backends = {
         "sftp": client.copy_remote_file,
         "scp": client.scp_recv,
         "rsync": rsync_download,
+        "pipe": partial(_pipe_download, client),
     }
 
     direction_map = {"upload": upload_backends, "download": download_backends}
@@ -795,75 +3305,64 @@ def _transfer_fn(client, direction, **kwargs):
 
 
 # https://github.com/mathiasertl/fabric/blob/master/fabric/operations.py#L419
-# use_sudo hack: https://github.com/mathiasertl/fabric/blob/master/fabric/operations.py#L453-L458
-def _download_as_root_hack(remote_path, local_path, **kwargs):
-    """as root, creates a temporary copy of the file that can be downloaded by a
-    regular user and then removes the temporary file.
-    warning: don't try to download anything huge `with_sudo` as the file is duplicated.
-    warning: the privileged file will be available in /tmp until the download is complete
-    """
-
-    if not remote_file_exists(remote_path, use_sudo=True, **kwargs):
-        raise EnvironmentError("remote file does not exist: %s" % (remote_path,))
-    client = _ssh_client(**kwargs)
-
-    cmd = single_command(
-        [
-            # create a temporary file with the suffix '-threadbare'
-            'tempfile=$(mktemp --suffix "-threadbare")',
-            # copy the target file to this temporary file
-            'cp "%s" "$tempfile"' % remote_path,
-            # ensure it's readable by the user doing the downloading
-            'chmod +r "$tempfile"',
-            # emit the name of the temporary file so we can find it to download it
-            'echo "$tempfile"',
-        ]
-    )
-    result = remote_sudo(cmd, **kwargs)
-    remote_tempfile = result["stdout"][-1]
-    remote_path = remote_tempfile
-
-    transfer_fn = _transfer_fn(client, "download", **kwargs)
-
-    try:
-        transfer_fn(remote_tempfile, local_path)
-        return local_path
-
-    except (pssh.exceptions.SFTPError, pssh.exceptions.SCPError) as exc:
-        # permissions or network issues may cause these
-        raise WrappedNetworkError(exc)
-
-    finally:
-        remote_sudo('rm -f "%s"' % remote_tempfile, **kwargs)
-
-
-# https://github.com/mathiasertl/fabric/blob/master/fabric/operations.py#L419
-# use_sudo hack: https://github.com/mathiasertl/fabric/blob/master/fabric/operations.py#L453-L458
 def download(remote_path, local_path, use_sudo=False, **kwargs):
     """downloads file at `remote_path` to `local_path`, overwriting the local path if it exists.
-    avoid `use_sudo` if at all possible"""
+    with `skip_identical=True` nothing is downloaded if the local file already has the same contents.
+    a directory is downloaded as a tar archive streamed over a single channel, see `_tar_download`.
+    `local_path` may also be a writable file-like object or a callback. the remote file is streamed into it in chunks
+    as it arrives, without a temporary file, see `_pipe_download`.
+    with `use_sudo=True` the remote file is read as root and streamed, the `transfer_protocol` is ignored.
+    with `compression` set the remote file is streamed, compressed if it's at least `compression_threshold` bytes, and
+    the `transfer_protocol` is ignored. see `_compression_codec` and `compression_report`.
+    """
+    base_kwargs = {"skip_identical": False, "overwrite": True, "compress": False}
+    base_kwargs.update(_compression_default_settings())
+    global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
+    skip_identical = final_kwargs["skip_identical"]
 
     with state.settings(quiet=True):
-        if remote_path.endswith("/"):
-            raise ValueError("directory downloads are not supported")
-
         # do not raise an exception if remote path is a directory
         result = remote(
             'test -d "%s"' % remote_path, use_sudo=use_sudo, warn_only=True, quiet=True
         )
         remote_path_is_dir = result["succeeded"]
         if remote_path_is_dir:
-            raise ValueError("directory downloads are not supported")
+            if _is_writable(local_path):
+                raise ValueError(
+                    "directories cannot be downloaded into a file-like object"
+                )
+            local_path = os.path.abspath(local_path)
+            tar_kwargs = subdict(final_kwargs, ["overwrite", "compress"])
+            if _compression_codec(**kwargs):
+                tar_kwargs["compress"] = True
+            if skip_identical and os.path.isdir(local_path):
+                tar_kwargs["members"] = _changed_download_members(
+                    remote_path, local_path, use_sudo, **kwargs
+                )
+                if tar_kwargs["members"] == []:
+                    return local_path
+            client = _ssh_client(**kwargs)
+            _tar_download(
+                client, remote_path, local_path, use_sudo=use_sudo, **tar_kwargs
+            )
+            return local_path
 
-        temp_file, data_buffer = None, None
-        if hasattr(local_path, "read"):
-            # given a file-like object to download file into.
-            # 1. write the remote file to local temporary file
-            # 2. read temporary file into the given buffer
-            # 3. delete the temporary file
+        if not remote_file_exists(remote_path, use_sudo=use_sudo, **kwargs):
+            raise EnvironmentError("remote file does not exist: %s" % (remote_path,))
 
-            data_buffer = local_path
-            temp_file, local_path = tempfile.mkstemp(suffix="-threadbare")
+        codec = _compression_codec(**kwargs)
+        pipe_kwargs = {
+            "use_sudo": use_sudo,
+            "codec": codec,
+            "threshold": final_kwargs["compression_threshold"],
+        }
+        if _is_writable(local_path):
+            start = time.time()
+            stats = _pipe_download(
+                _ssh_client(**kwargs), remote_path, local_path, **pipe_kwargs
+            )
+            _record_compression(stats, start, **kwargs)
+            return local_path
 
         if not os.path.isabs(local_path):
             local_path = os.path.abspath(local_path)
@@ -871,112 +3370,102 @@ def download(remote_path, local_path, use_sudo=False, **kwargs):
         if os.path.isdir(local_path):
             local_path = os.path.join(local_path, os.path.basename(remote_path))
 
-        if use_sudo:
-            local_path = _download_as_root_hack(remote_path, local_path, **kwargs)
+        if skip_identical and _skip_identical(
+            local_path, remote_path, use_sudo, **kwargs
+        ):
+            return local_path
 
-        else:
-            if not remote_file_exists(remote_path, **kwargs):
-                raise EnvironmentError(
-                    "remote file does not exist: %s" % (remote_path,)
+        client = _ssh_client(**kwargs)
+        if use_sudo or codec:
+            # streamed through a remote `sudo cat` rather than copied somewhere readable first
+            if not final_kwargs["overwrite"] and os.path.exists(local_path):
+                raise NetworkError(
+                    "Local file exists and 'overwrite' is set to 'False'. Refusing to write: %s"
+                    % (local_path,)
                 )
-            client = _ssh_client(**kwargs)
-            transfer_fn = _transfer_fn(client, "download", **kwargs)
+            start = time.time()
+            stats = _pipe_download(client, remote_path, local_path, **pipe_kwargs)
+            _record_compression(stats, start, **kwargs)
+            return local_path
 
-            try:
-                transfer_fn(remote_path, local_path)
-            except (pssh.exceptions.SFTPError, pssh.exceptions.SCPError) as exc:
-                # permissions or network issues may cause these
-                raise WrappedNetworkError(exc)
-
-        if temp_file:
-            flags = "r" if isinstance(data_buffer, io.StringIO) else "rb"
-            with open(local_path, flags) as fh:
-                data = fh.read()
-            data_buffer.write(data)
-            # deletes the *temporary file*. `temp_file` is a file descriptor
-            os.unlink(local_path)
-            return data_buffer
+        transfer_fn = _transfer_fn(client, "download", **kwargs)
+        try:
+            transfer_fn(remote_path, local_path)
+        except (pssh.exceptions.SFTPError, pssh.exceptions.SCPError) as exc:
+            # permissions or network issues may cause these
+            raise WrappedNetworkError(exc)
 
         return local_path
 
 
-def _upload_as_root_hack(local_path, remote_path, **kwargs):
-    """uploads file at `local_path` to a remote temporary file then moves the file to `remote_path` as root.
-    does not alter any permissions or attributes on the file"""
-
-    client = _ssh_client(**kwargs)
-
-    cmd = single_command(
-        [
-            # create a temporary file with the suffix '-threadbare'
-            'tempfile=$(mktemp --suffix "-threadbare")',
-            'echo "$tempfile"',
-        ]
-    )
-    result = remote(cmd, **kwargs)
-    remote_temp_path = result["stdout"][-1]
-    ensure(
-        remote_file_exists(remote_temp_path, **kwargs),
-        "remote temporary file %r (%s) does not exist"
-        % (remote_temp_path, remote_path),
-    )
-
-    transfer_fn = _transfer_fn(client, "upload", **kwargs)
-
-    try:
-        transfer_fn(local_path, remote_temp_path)
-        move_file_into_place = 'mv "%s" "%s"' % (remote_temp_path, remote_path)
-        remote_sudo(move_file_into_place, **kwargs)
-        ensure(
-            remote_file_exists(remote_path, use_sudo=True, **kwargs),
-            "remote path does not exist: %s" % (remote_path),
-        )
-    except (pssh.exceptions.SFTPError, pssh.exceptions.SCPError) as exc:
-        # permissions or network issues may cause these
-        raise WrappedNetworkError(exc)
-
-
-def _write_bytes_to_temporary_file(local_path):
-    """if `local_path` is a file-like object, write the contents to an *actual* file and
-    return a pair of new local filename and a function that removes the temporary file when called.
-    """
-    if hasattr(local_path, "read"):
-        # `local_path` is a file-like object
-        local_bytes = local_path
-        local_bytes.seek(0)  # reset internal pointer
-        temp_file, local_path = tempfile.mkstemp(suffix="-threadbare")
-        with os.fdopen(temp_file, "wb") as fh:
-            data = local_bytes.getvalue()
-            # data may be a string or it may be bytes.
-            # if it's a string we assume it's a UTF-8 string.
-            if isinstance(data, str):
-                data = bytes(data, "utf-8")
-            fh.write(data)
-        cleanup = lambda: os.unlink(local_path)
-        return local_path, cleanup
-    return local_path, None
-
-
 def upload(local_path, remote_path, use_sudo=False, **kwargs):
-    "uploads file at `local_path` to the given `remote_path`, overwriting anything that may be at that path"
+    """uploads file at `local_path` to the given `remote_path`, overwriting anything that may be at that path.
+    with `skip_identical=True` nothing is uploaded if the remote file already has the same contents.
+    a directory is uploaded as a tar archive streamed over a single channel, see `_tar_upload`.
+    `local_path` may also be any readable file-like object or an iterable of chunks of bytes or strings. these are
+    streamed to the remote file in chunks, without a temporary file, see `_pipe_upload`.
+    with `use_sudo=True` the remote file is written as root and streamed, the `transfer_protocol` is ignored.
+    with `compression` set the local file is streamed, compressed if it's at least `compression_threshold` bytes, and
+    the `transfer_protocol` is ignored. streams are always compressed. see `_compression_codec` and
+    `compression_report`.
+    """
+    base_kwargs = {"skip_identical": False, "overwrite": True, "compress": False}
+    base_kwargs.update(_compression_default_settings())
+    global_kwargs, user_kwargs, final_kwargs = handle(base_kwargs, kwargs)
+    skip_identical = final_kwargs["skip_identical"]
+    overwrite = final_kwargs["overwrite"]
     # todo: this setting is dubious, don't count on it hanging around
     with state.settings(quiet=True):
 
-        # bytes handling
-        local_path, cleanup_fn = _write_bytes_to_temporary_file(local_path)
-        if cleanup_fn:
-            state.add_cleanup(cleanup_fn)
+        codec = _compression_codec(**kwargs)
 
-        if os.path.isdir(local_path):
-            raise ValueError("folders cannot be uploaded")
+        if _is_stream(local_path):
+            client = _ssh_client(**kwargs)
+            start = time.time()
+            stats = _pipe_upload(
+                client, local_path, remote_path, overwrite, use_sudo, codec
+            )
+            _record_compression(stats, start, **kwargs)
+            _stat_cache_forget([remote_path], **kwargs)
+            return
 
-        if use_sudo:
-            return _upload_as_root_hack(local_path, remote_path, **kwargs)
+        if os.path.isdir(local_path):
+            tar_kwargs = subdict(final_kwargs, ["overwrite", "compress"])
+            if codec:
+                tar_kwargs["compress"] = True
+            if skip_identical:
+                tar_kwargs["members"] = _changed_upload_members(
+                    local_path, remote_path, use_sudo, **kwargs
+                )
+                if tar_kwargs["members"] == []:
+                    return
+            client = _ssh_client(**kwargs)
+            _tar_upload(
+                client, local_path, remote_path, use_sudo=use_sudo, **tar_kwargs
+            )
+            _stat_cache_forget([remote_path], recursive=True, **kwargs)
+            return
 
         if not os.path.exists(local_path):
             raise EnvironmentError("local file does not exist: %s" % (local_path,))
 
+        if skip_identical and _skip_identical(
+            local_path, remote_path, use_sudo, **kwargs
+        ):
+            return
+
         client = _ssh_client(**kwargs)
+        if use_sudo or codec:
+            # streamed through a remote `sudo` rather than moved into place from a temporary file
+            if os.path.getsize(local_path) < final_kwargs["compression_threshold"]:
+                codec = None
+            start = time.time()
+            stats = _pipe_upload(
+                client, local_path, remote_path, overwrite, use_sudo, codec
+            )
+            _record_compression(stats, start, **kwargs)
+            _stat_cache_forget([remote_path], **kwargs)
+            return
 
         try:
             transfer_fn = _transfer_fn(client, "upload", **kwargs)